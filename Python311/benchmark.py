@@ -0,0 +1,591 @@
+import sys,os
+import contextlib
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import snow
+
+# Benchmarks for the RHEM-Snow python codes (snow.py), run on synthetic cligen
+# records so that they do not depend on any particular station
+#
+# Usage: python benchmark.py [<benchmark name> ...]
+# where <benchmark name> is one of the names in BENCHMARKS (all benchmarks are
+# run if no name is given)
+
+def write_cligen_file(fname, nyears, latitude=44.9, elevation=1520., seed=0, warming=0.):
+
+    # Function to write a synthetic cligen storm file (15 header lines followed
+    # by one line per day, in the same format as cligen v5.3)
+    #
+    # Inputs
+    #   fname: name of the file to write
+    #   nyears: number of years in the record (starting in year 1, and including
+    #   the leap days that cligen generates on the 100th, 200th, ... year)
+    #   latitude, elevation: station latitude [degrees] and elevation [m]
+    #   seed: seed for the random number generator
+    #   warming: shift of the daily temperatures [C]
+
+    rng = np.random.default_rng(seed)
+
+    # cligen treats every 4th year as a leap year
+    years = np.arange(1, nyears + 1)
+    month_length = np.tile([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31], nyears)
+    month_length[1::12] += np.mod(years, 4) == 0
+    year = np.repeat(np.repeat(years, 12), month_length)
+    mon = np.repeat(np.tile(np.arange(1, 13), nyears), month_length)
+    day = np.arange(len(year)) - np.repeat(np.cumsum(month_length) - month_length, month_length) + 1
+    year_start = np.cumsum(np.where(np.mod(years, 4) == 0, 366, 365)) - np.where(np.mod(years, 4) == 0, 366, 365)
+    doy = np.arange(len(year)) - year_start[year - 1] + 1
+    n = len(year)
+
+    season = -np.cos(2 * np.pi * (doy - 15) / 365)
+    tmax = 12 + warming + 15 * season + rng.normal(0, 4, n)
+    tmin = tmax - 10 - rng.uniform(0, 6, n)
+    tdew = tmin - rng.uniform(0, 4, n)
+    rad = np.maximum(30, 400 + 260 * season + rng.normal(0, 60, n))
+    wet = rng.random(n) < 0.25
+    prcp = np.where(wet, np.round(rng.exponential(6, n), 1), 0)
+    dur = np.where(wet, rng.uniform(0.5, 12, n), 0)
+    tp = np.where(wet, rng.uniform(0.05, 0.95, n), 0)
+    ip = np.where(wet, rng.uniform(1.1, 12, n), 0)
+    wind = rng.uniform(0, 8, n)
+    wdir = rng.uniform(0, 360, n)
+
+    header = ['5.32300', '   1   0   0', '   Station:  SYNTHETIC  CLIGEN VER. 5.32300 -r:    0 -I: 0',
+              ' Latitude Longitude Elevation (m) Obs. Years   Beginning year  Years simulated Command Line:',
+              '    %.2f  -116.10        %d          50           1         %d' % (latitude, elevation, nyears),
+              ' Observed monthly ave max temperature (C)', '    1.0  4.1  8.8 13.9 19.2 24.6 30.6 30.0 24.3 16.6  7.7  1.7',
+              ' Observed monthly ave min temperature (C)', '  -10.2 -8.1 -4.9 -1.5  2.1  5.5  8.4  7.4  2.9 -1.5 -5.3 -9.1',
+              ' Observed monthly ave solar radiation (Langleys/day)', '  178.0 268.0 391.0 508.0 600.0 669.0 701.0 607.0 478.0 330.0 198.0 150.0',
+              ' Observed monthly ave precipitation (mm)', '   46.4 36.6 38.1 35.2 41.4 31.5 14.9 19.1 22.1 27.6 41.4 44.8',
+              ' da mo year  prcp  dur   tp     ip  tmax  tmin  rad  w-vl w-dir  tdew',
+              '             (mm)  (h)               (C)   (C) (l/d) (m/s)(Deg)   (C)']
+    table = np.array([day, mon, year, prcp, dur, tp, ip, tmax, tmin, rad, wind, wdir, tdew]).T
+    fmt = '%3d%3d%5d%6.1f%6.2f%5.2f%6.2f%6.1f%6.1f%5.0f.%5.1f%5.0f.%6.1f'
+    np.savetxt(fname, table, fmt=fmt, header='\n'.join(header), comments='')
+
+@contextlib.contextmanager
+def quiet():
+
+    # Silence the progress messages that are printed by snow.py
+
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+def timeit(fun, *args, repeat=3):
+
+    # Return the best wall time [s] (and the result) of calling fun(*args)
+
+    best = np.inf
+    for i in range(repeat):
+        t = time.perf_counter()
+        with quiet():
+            result = fun(*args)
+        best = min(best, time.perf_counter() - t)
+    return best, result
+
+def forcing_inputs(workdir, nyears, nlocs):
+
+    # Write (or reuse) a synthetic cligen file, and set up the arguments of
+    # get_forcing_cligen for nlocs copies of it
+
+    fname = os.path.join(workdir, 'synthetic_%dyr.stm' % nyears)
+    if not os.path.exists(fname):
+        write_cligen_file(fname, nyears)
+    model_pars = snow.default_model_pars(nlocs)
+    model_pars['slope'][:] = np.linspace(0, 30, nlocs)
+    model_pars['aspect'][:] = np.linspace(0, 360, nlocs)
+    return [fname] * nlocs, model_pars
+
+def bench_forcing(workdir):
+
+    # Scaling of get_forcing_cligen with the number of locations and the length
+    # of the record (storm files are read from the cache, so this mostly
+    # measures the forcing preprocessing)
+
+    print('get_forcing_cligen')
+    print('%8s %8s %12s %16s' % ('years', 'nlocs', 'time (s)', 'us/location-day'))
+    for nyears, nlocs in [(30, 1), (30, 10), (30, 100), (30, 1000), (10, 1), (100, 1), (300, 1), (300, 10)]:
+        forcing_files, model_pars = forcing_inputs(workdir, nyears, nlocs)
+        with quiet():
+            snow.get_forcing_cligen(forcing_files, model_pars)      # Fill the cache
+        t, (TS_vec, forcing_data) = timeit(snow.get_forcing_cligen, forcing_files, model_pars)
+        print('%8d %8d %12.3f %16.3f' % (nyears, nlocs, t, t / (len(TS_vec) * nlocs) * 1E6))
+
+def bench_forcing_cold(workdir):
+
+    # get_forcing_cligen with an empty cache, so that the storm files are
+    # parsed (in ReadWorkers processes) and written to the cache, with one and
+    # with all processors
+
+    print('get_forcing_cligen, cold cache (%d processors)' % os.cpu_count())
+    print('%8s %8s %12s %12s %10s' % ('years', 'nlocs', '1 proc (s)', 'all (s)', 'speedup'))
+    CacheDir, ReadWorkers = snow.CacheDir, snow.ReadWorkers
+    for nyears, nlocs in [(30, 1), (30, 10), (30, 100), (300, 1), (300, 10)]:
+        forcing_files, model_pars = forcing_inputs(workdir, nyears, nlocs)
+        # (copies of the storm file with different first lines, which are not
+        # read, so that each copy is parsed)
+        with open(forcing_files[0]) as f:
+            lines = f.readlines()
+        forcing_files = [os.path.join(workdir, 'cold_%dyr_%d.stm' % (nyears, i)) for i in range(nlocs)]
+        for i, fname in enumerate(forcing_files):
+            with open(fname, 'w') as f:
+                f.writelines(['%s copy %d\n' % (lines[0].rstrip(), i)] + lines[1:])
+        times = []
+        for snow.ReadWorkers in [1, 0]:
+            snow.CacheDir = tempfile.mkdtemp(dir=workdir)
+            t, result = timeit(snow.get_forcing_cligen, forcing_files, model_pars, repeat=1)
+            times.append(t)
+        print('%8d %8d %12.3f %12.3f %10.2f' % (nyears, nlocs, times[0], times[1], times[0] / times[1]))
+    snow.CacheDir, snow.ReadWorkers = CacheDir, ReadWorkers
+
+def bench_solar(workdir):
+
+    # Time to get clear sky radiation for a 300 year record, when the tables
+    # for each terrain are computed, loaded from the cache, or already in memory
+
+    print('solarradiation (300 years)')
+    print('%8s %12s %12s %12s' % ('nterrain', 'compute (s)', 'cache (s)', 'memory (s)'))
+    TS_vec, calendar = snow.get_calendar(*np.loadtxt(forcing_inputs(workdir, 300, 1)[0][0], skiprows=15, usecols=(2, 1, 0)).T)
+    for nlocs in [1, 10, 100, 1000]:
+        latitude = np.linspace(30, 50, nlocs)
+        slope = np.linspace(0, 30, nlocs)
+        aspect = np.linspace(0, 360, nlocs)
+        snow.solar_tables.clear()
+        snow.UseCache = False
+        t_compute, result = timeit(snow.solarradiation, calendar['doy'], latitude, slope, aspect, repeat=1)
+        snow.UseCache = True
+        with quiet():
+            snow.solarradiation(calendar['doy'], latitude, slope, aspect)
+        snow.solar_tables.clear()
+        t_cache, result = timeit(snow.solarradiation, calendar['doy'], latitude, slope, aspect, repeat=1)
+        t_memory, result = timeit(snow.solarradiation, calendar['doy'], latitude, slope, aspect)
+        print('%8d %12.3f %12.3f %12.3f' % (nlocs, t_compute, t_cache, t_memory))
+
+def bench_solar_methods(workdir):
+
+    # Speed and accuracy of the 'hourly' and 'daily' clear sky radiation
+    # methods, for a set of latitudes, slopes and aspects.  The reference is the
+    # 'daily' method with 200 quadrature points
+
+    print('clearsky_radiation methods (latitudes -60 to 60, slopes 0 to 45 degrees)')
+    latitude, slope, aspect = np.meshgrid(np.arange(-60, 61, 10.), [0, 10, 20, 30, 45.], [0, 90, 180, 270.], indexing='ij')
+    latitude, slope, aspect = latitude.ravel(), slope.ravel(), aspect.ravel()
+    reference, day_length = snow.clearsky_radiation(latitude, slope.copy(), aspect.copy(), 'daily', 200)
+    print('%12s %10s %16s %16s %16s' % ('method', 'time (s)', 'mean |err| W/m2', 'max |err| W/m2', 'mean err W/m2'))
+    for method, order in [('hourly', 0), ('daily', 4), ('daily', 8), ('daily', 16)]:
+        t, (srad, day_length) = timeit(snow.clearsky_radiation, latitude, slope.copy(), aspect.copy(), method, order)
+        name = method if method == 'hourly' else method + ' (%d)' % order
+        print('%12s %10.4f %16.3f %16.3f %16.3f' % (name, t, np.mean(np.abs(srad - reference)), np.max(np.abs(srad - reference)), np.mean(srad - reference)))
+
+def bench_model(workdir):
+
+    # Time of run_model with the numpy time loop and with the compiled (numba)
+    # kernel, and the largest difference between the two.  The first call of
+    # the kernel includes loading (or compiling) it
+
+    print('run_model')
+    print('%8s %8s %12s %12s %12s %16s' % ('years', 'nlocs', 'numpy (s)', 'first (s)', 'numba (s)', 'max |diff| swe'))
+    UseNumba = snow.UseNumba
+    for nyears, nlocs in [(30, 1), (30, 100), (300, 1), (300, 10)]:
+        forcing_files, model_pars = forcing_inputs(workdir, nyears, nlocs)
+        with quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+        snow.UseNumba = False
+        t_numpy, output_numpy = timeit(snow.run_model, TS_vec, forcing_data, model_pars, repeat=1)
+        snow.UseNumba = True
+        t_first, output = timeit(snow.run_model, TS_vec, forcing_data, model_pars, repeat=1)
+        t_numba, output = timeit(snow.run_model, TS_vec, forcing_data, model_pars)
+        print('%8d %8d %12.3f %12.3f %12.3f %16.3g' % (nyears, nlocs, t_numpy, t_first, t_numba, np.nanmax(np.abs(output['swe'] - output_numpy['swe']))))
+    snow.UseNumba = UseNumba
+
+def bench_precision(workdir):
+
+    # Annual water balance of the model in single (float32) vs double (float64)
+    # precision: mean annual totals [mm/year] in double precision, and the mean
+    # and largest absolute differences of the annual totals (over all years
+    # and locations), and the memory used by the forcing data and outputs
+
+    nyears, nlocs = 100, 10
+    variables = ['rainfall', 'snowfall', 'melt', 'snowpack_sublimation', 'canopy_sublimation', 'ET', 'infil_runoff', 
+                 'sat_runoff', 'perc', 'q_vadose', 'q_phreatic']
+    forcing_files, model_pars = forcing_inputs(workdir, nyears, nlocs)
+    SinglePrecision = snow.SinglePrecision
+    totals = {}
+    for precision in [False, True]:
+        snow.SinglePrecision = precision
+        with quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+        t, model_output = timeit(snow.run_model, TS_vec, forcing_data, model_pars, repeat=1)
+        nbytes = sum(forcing_data[var].nbytes for var in forcing_data if var != 'calendar') + sum(model_output[var].nbytes for var in model_output)
+        year = forcing_data['calendar']['year']
+        totals[precision] = {}
+        for var in variables:
+            x = forcing_data[var] if var in forcing_data else model_output[var]
+            x = np.asarray(x, dtype=float)
+            totals[precision][var] = np.array([np.sum(x[year == y, :], axis=0) for y in np.unique(year)[:-1]])
+        print('%s: run_model %.3f s, forcing data and outputs %.1f MB' % ('float32' if precision else 'float64', t, nbytes / 1E6))
+    snow.SinglePrecision = SinglePrecision
+
+    print('Annual water balance, float32 vs float64 (%d years, %d locations)' % (nyears, nlocs))
+    print('%22s %16s %16s %16s' % ('variable', 'mean (mm/yr)', 'mean |diff|', 'max |diff|'))
+    for var in variables:
+        diff = np.abs(totals[True][var] - totals[False][var])
+        print('%22s %16.3f %16.5f %16.5f' % (var, np.mean(totals[False][var]), np.mean(diff), np.max(diff)))
+
+def bench_allocations(workdir):
+
+    # Memory allocated in each time step (day) of the numpy version of the
+    # model, measured with tracemalloc (see CountAllocations).  The time steps
+    # write into buffers that are allocated before the time loop, so this must
+    # be 0 for any number of locations (the run is timed first, which also fills
+    # the caches that numpy and Python allocate the first time an operation is
+    # run)
+
+    print('run_model_numpy (1 year)')
+    print('%8s %12s %16s %16s %8s' % ('nlocs', 'time (s)', 'max (bytes/day)', 'days allocating', 'result'))
+    UseNumba, CountAllocations = snow.UseNumba, snow.CountAllocations
+    snow.UseNumba = False
+    failed = []
+    for nlocs in [1, 100, 10000]:
+        forcing_files, model_pars = forcing_inputs(workdir, 1, nlocs)
+        with quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+        snow.CountAllocations = False
+        t, output = timeit(snow.run_model, TS_vec, forcing_data, model_pars, repeat=1)
+        snow.CountAllocations = True
+        with quiet():
+            snow.run_model(TS_vec, forcing_data, model_pars)
+        days = np.count_nonzero(snow.step_allocations)
+        if days > 0:
+            failed.append(nlocs)
+        print('%8d %12.3f %16.0f %16d %8s' % (nlocs, t, np.max(snow.step_allocations), days, 'FAIL' if days > 0 else 'ok'))
+    snow.UseNumba, snow.CountAllocations = UseNumba, CountAllocations
+    assert not failed, 'The time steps allocate memory for nlocs = %s' % failed
+
+def bench_ensemble(workdir):
+
+    # Throughput of parameter ensembles at one station (30 years): each member
+    # as a separate get_forcing_cligen and run_model call, vs. one
+    # get_forcing_cligen call and run_ensemble for all members
+
+    print('run_ensemble (30 years, 1 station, outputs swe and melt)')
+    print('%10s %14s %14s %16s %16s' % ('members', 'separate (s)', 'ensemble (s)', 'separate (1/s)', 'ensemble (1/s)'))
+    forcing_files, model_pars = forcing_inputs(workdir, 30, 1)
+    outputs = ['swe', 'melt']
+    with quiet():
+        snow.get_forcing_cligen(forcing_files, model_pars)      # Fill the cache
+    def separate(n_members):
+        for i in range(n_members):
+            model_pars['lai'][:] = 3. * i / n_members
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+            snow.run_model(TS_vec, forcing_data, model_pars, outputs)
+    def ensemble(n_members):
+        TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+        return snow.run_ensemble(TS_vec, forcing_data, model_pars, {'lai': np.linspace(0, 3, n_members)}, outputs)
+    t_single, result = timeit(separate, 1)
+    for n_members in [1, 10, 100, 1000]:
+        t_separate = t_single * n_members
+        t_ensemble, result = timeit(ensemble, n_members)
+        print('%10d %14.3f %14.3f %16.1f %16.1f' % (n_members, t_separate, t_ensemble, n_members / t_separate, n_members / t_ensemble))
+
+def bench_shards(workdir):
+
+    # Scaling of run_model and get_ts_data with the number of processes (see
+    # run_shards), for 16 locations with 10 year records.  The speedup is
+    # relative to running both in this process (ModelWorkers = 1), and the
+    # times are the best of 3 runs
+
+    print('run_shards (10 years, 16 locations, %d processors)' % os.cpu_count())
+    print('%10s %12s %10s' % ('processes', 'time (s)', 'speedup'))
+    forcing_files, model_pars = forcing_inputs(workdir, 10, 16)
+    with quiet():
+        TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+    def single():
+        model_output = snow.run_model(TS_vec, forcing_data, model_pars, snow.COUPLED_OUTPUTS)
+        return snow.get_ts_data(forcing_data, model_output, 1/288)
+    t_single, result = timeit(single)
+    print('%10d %12.3f %10.2f' % (1, t_single, 1))
+    ModelWorkers = snow.ModelWorkers
+    for nworkers in [2, 4, 8, 16]:
+        snow.ModelWorkers = nworkers
+        t, result = timeit(snow.run_shards, TS_vec, forcing_data, model_pars, snow.COUPLED_OUTPUTS, 1/288)
+        print('%10d %12.3f %10.2f' % (nworkers, t, t_single / t))
+    snow.ModelWorkers = ModelWorkers
+
+def bench_append(workdir):
+
+    # Time to extend a 30 year record by one year at one station: a complete
+    # run of the 31 years, vs. a run in append mode (AppendMode) of the added
+    # year, continuing a run of the first 30 years
+
+    print('run (30 years + 1 added year, 1 station)')
+    print('%10s %12s %10s' % ('run', 'time (s)', 'speedup'))
+    fname = os.path.join(workdir, 'synthetic_31yr.stm')
+    if not os.path.exists(fname):
+        write_cligen_file(fname, 31)
+    with open(fname) as f:
+        lines = f.readlines()
+    n30 = 15 + sum(int(line[6:11]) <= 30 for line in lines[15:])
+    settings = snow.GetSiteSpecificParameters, snow.AppendMode
+    snow.GetSiteSpecificParameters = False
+    args = ['Loam'], [5.], [270.]
+
+    snow.AppendMode = False
+    t_complete, result = timeit(snow.run, [fname], [os.path.join(workdir, 'complete')], *args, repeat=1)
+    print('%10s %12.3f %10.2f' % ('complete', t_complete, 1))
+
+    snow.AppendMode = True
+    append_file = os.path.join(workdir, 'append', 'synthetic.stm')
+    os.makedirs(os.path.dirname(append_file), exist_ok=True)
+    with open(append_file, 'w') as f:
+        f.writelines(lines[:n30])
+    with quiet():
+        snow.run([append_file], [os.path.join(workdir, 'append')], *args)
+    with open(append_file, 'a') as f:
+        f.writelines(lines[n30:])
+    t_append, result = timeit(snow.run, [append_file], [os.path.join(workdir, 'append')], *args, repeat=1)
+    print('%10s %12.3f %10.2f' % ('append', t_append, t_complete / t_append))
+    snow.GetSiteSpecificParameters, snow.AppendMode = settings
+
+def bench_active(workdir):
+
+    # Time of the numpy version of run_model with and without the compaction of
+    # the snow physics to the cells with snow (see CompactSnowPhysics), on a
+    # grid of stations from cold (snow most of the winter) to warm (rarely any
+    # snow), and the largest difference between the two (should be 0)
+
+    print('run_model_numpy, CompactSnowPhysics (10 years, mixed climate grid)')
+    print('%8s %12s %12s %10s %14s %16s' % ('nlocs', 'full (s)', 'compact (s)', 'speedup', 'active cells', 'max |diff|'))
+    settings = snow.UseNumba, snow.CompactSnowPhysics
+    snow.UseNumba = False
+    for nlocs in [10, 100, 1000]:
+        forcing_files = []
+        for warming in np.linspace(-5, 15, 10):
+            fname = os.path.join(workdir, 'synthetic_10yr_%+.0fC.stm' % warming)
+            if not os.path.exists(fname):
+                write_cligen_file(fname, 10, warming=warming)
+            forcing_files.append(fname)
+        forcing_files = [forcing_files[i] for i in np.arange(nlocs) * 10 // nlocs]
+        model_pars = snow.default_model_pars(nlocs)
+        with quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+        snow.CompactSnowPhysics = False
+        t_full, output_full = timeit(snow.run_model, TS_vec, forcing_data, model_pars, repeat=1)
+        snow.CompactSnowPhysics = True
+        t_compact, output = timeit(snow.run_model, TS_vec, forcing_data, model_pars, repeat=1)
+        active = np.mean((output['swe'] > 0) | (output['canopy_snow_storage'] > 0) | (forcing_data['snowfall'] > 0))
+        diff = max(np.nanmax(np.abs(output[var] - output_full[var])) for var in output)
+        print('%8d %12.3f %12.3f %10.2f %13.0f%% %16.3g' % (nlocs, t_full, t_compact, t_full / t_compact, 100 * active, diff))
+    snow.UseNumba, snow.CompactSnowPhysics = settings
+
+def bench_reducers(workdir):
+
+    # Time and peak memory (tracemalloc) of run_model for one station when the
+    # daily outputs are kept and annual statistics are computed afterwards, vs.
+    # reducers that compute the same statistics in the time loop (outputs=[])
+
+    print('run_model reducers (1 station, annual peak SWE and melt, sublimation and runoff totals)')
+    print('%8s %12s %12s %16s %16s %12s' % ('years', 'daily (s)', 'reducers (s)', 'daily (MB)', 'reducers (MB)', 'max |diff|'))
+    reducers = {'peak_swe': ['swe', 'max', 'year'], 'total_melt': ['melt', 'sum', 'year'], 'total_sublimation': ['snowpack_sublimation', 'sum', 'year'],
+                'total_runoff': ['infil_runoff', 'sum', 'year']}
+    def daily(TS_vec, forcing_data, model_pars):
+        model_output = snow.run_model(TS_vec, forcing_data, model_pars, [reducers[name][0] for name in reducers])
+        starts = snow.reducer_periods(forcing_data['calendar'], 'year')
+        return {name: (np.maximum if reducers[name][1] == 'max' else np.add).reduceat(model_output[reducers[name][0]], starts, axis=0) for name in reducers}
+    def reduced(TS_vec, forcing_data, model_pars):
+        return snow.run_model(TS_vec, forcing_data, model_pars, [], reducers=reducers)
+    def peak(fun, *args):
+        tracemalloc.start()
+        with quiet():
+            result = fun(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak / 1E6, result
+    for nyears in [30, 300, 3000]:
+        forcing_files, model_pars = forcing_inputs(workdir, nyears, 1)
+        with quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+        t_daily, result_daily = timeit(daily, TS_vec, forcing_data, model_pars, repeat=1)
+        t_reducers, result = timeit(reduced, TS_vec, forcing_data, model_pars, repeat=1)
+        m_daily, result_daily = peak(daily, TS_vec, forcing_data, model_pars)
+        m_reducers, result = peak(reduced, TS_vec, forcing_data, model_pars)
+        diff = max(np.max(np.abs(result[name][:-1] - result_daily[name][:-1])) for name in reducers)
+        print('%8d %12.3f %12.3f %16.1f %16.1f %12.3g' % (nyears, t_daily, t_reducers, m_daily, m_reducers, diff))
+
+def bench_disaggregation(workdir):
+
+    # Time of get_ts_data (5 minute rainfall and snowmelt), with the diurnal
+    # melt curves from a table of day lengths rounded to 0.01 hours
+    # (MeltCurveStep = 0.01) and with one curve for each day length
+    # (MeltCurveStep = 0, the default), the largest difference of the 5 minute
+    # melt between the two, and the memory of the sparse timeseries (only days
+    # with rainfall or melt) compared to full arrays
+
+    print('get_ts_data (5 minutes)')
+    print('%8s %8s %12s %12s %16s %12s %12s' % ('years', 'nlocs', 'table (s)', 'exact (s)', 'max |diff| melt', 'sparse (MB)', 'dense (MB)'))
+    MeltCurveStep = snow.MeltCurveStep
+    for nyears, nlocs in [(30, 1), (30, 10), (300, 1)]:
+        forcing_files, model_pars = forcing_inputs(workdir, nyears, nlocs)
+        with quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+            model_output = snow.run_model(TS_vec, forcing_data, model_pars, snow.COUPLED_OUTPUTS)
+        snow.MeltCurveStep = 0.01
+        t_table, (TSRainfall, TSMelt) = timeit(snow.get_ts_data, forcing_data, model_output, 1/288, repeat=1)
+        snow.MeltCurveStep = 0
+        t_exact, (TSRainfall, TSMelt_exact) = timeit(snow.get_ts_data, forcing_data, model_output, 1/288, repeat=1)
+        snow.MeltCurveStep = MeltCurveStep
+        diff = np.max(np.abs(TSMelt['values'] - TSMelt_exact['values']), initial=0)
+        m_sparse = (TSRainfall['values'].nbytes + TSMelt['values'].nbytes) / 2**20
+        m_dense = 2 * TSMelt['ndays'] * TSMelt['values'].shape[1] * nlocs * TSMelt['values'].itemsize / 2**20
+        print('%8d %8d %12.3f %12.3f %16.3g %12.1f %12.1f' % (nyears, nlocs, t_table, t_exact, diff, m_sparse, m_dense))
+
+def bench_resolution(workdir):
+
+    # Time and memory of get_ts_data for timesteps of the disaggregated
+    # timeseries (TSMinutes) from 1 to 30 minutes, 30 years at 10 locations
+
+    print('get_ts_data (30 years, 10 locations)')
+    print('%10s %12s %12s' % ('minutes', 'time (s)', 'memory (MB)'))
+    forcing_files, model_pars = forcing_inputs(workdir, 30, 10)
+    with quiet():
+        TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+        model_output = snow.run_model(TS_vec, forcing_data, model_pars, snow.COUPLED_OUTPUTS)
+    for minutes in [1, 5, 10, 15, 30]:
+        t, (TSRainfall, TSMelt) = timeit(snow.get_ts_data, forcing_data, model_output, minutes / 1440, repeat=1)
+        print('%10d %12.3f %12.1f' % (minutes, t, (TSRainfall['values'].nbytes + TSMelt['values'].nbytes) / 2**20))
+
+def bench_ts_workers(workdir):
+
+    # Scaling of get_ts_data with the number of threads that disaggregate
+    # blocks of days (DisaggregationWorkers), 30 years at 10 locations (best of
+    # 3 runs)
+
+    print('get_ts_data (30 years, 10 locations, %d processors)' % os.cpu_count())
+    print('%10s %12s %10s' % ('threads', 'time (s)', 'speedup'))
+    forcing_files, model_pars = forcing_inputs(workdir, 30, 10)
+    with quiet():
+        TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+        model_output = snow.run_model(TS_vec, forcing_data, model_pars, snow.COUPLED_OUTPUTS)
+    DisaggregationWorkers = snow.DisaggregationWorkers
+    for nworkers in [1, 2, 4, 8, 16]:
+        snow.DisaggregationWorkers = nworkers
+        t, result = timeit(snow.get_ts_data, forcing_data, model_output, 1/288)
+        if nworkers == 1:
+            t_single = t
+        print('%10d %12.3f %10.2f' % (nworkers, t, t_single / t))
+    snow.DisaggregationWorkers = DisaggregationWorkers
+
+def bench_max_intensity(workdir):
+
+    # Time to find the daily maximum 30 minute intensities (max_intensity) of
+    # the 5 minute net water input, with fixed and rolling windows, compared to
+    # a loop over the days and windows
+
+    print('max_intensity (5 minutes, 1 location)')
+    print('%8s %12s %12s %12s' % ('years', 'loop (s)', 'fixed (s)', 'rolling (s)'))
+    for nyears in [30, 300]:
+        forcing_files, model_pars = forcing_inputs(workdir, nyears, 1)
+        with quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+            model_output = snow.run_model(TS_vec, forcing_data, model_pars, snow.COUPLED_OUTPUTS)
+            TSPrecip = snow.add_sparse_ts(*snow.get_ts_data(forcing_data, model_output, 1/288))
+        def loop():
+            TS = snow.dense_ts(TSPrecip)
+            MaxIntensity = np.zeros((TSPrecip['ndays'], TSPrecip['nlocs']))
+            for i in range(TSPrecip['ndays']):
+                precip = TS[i*288:(i+1)*288, :]
+                precip_30 = np.zeros([48, precip.shape[1]])
+                for j in range(48):
+                    precip_30[j, :] = np.sum(precip[j*6:(j+1)*6, :], axis=0)
+                MaxIntensity[i, :] = np.max(precip_30, axis=0)
+            return MaxIntensity
+        t_loop, result_loop = timeit(loop, repeat=1)
+        t_fixed, result = timeit(snow.max_intensity, TSPrecip, 6)
+        assert np.array_equal(result, result_loop)
+        t_rolling, result = timeit(snow.max_intensity, TSPrecip, 6, True)
+        print('%8d %12.3f %12.4f %12.4f' % (nyears, t_loop, t_fixed, t_rolling))
+
+def bench_idf(workdir):
+
+    # Time and peak memory of the annual maximum intensities for 6 durations
+    # (idf_annual_maxima) of the 5 minute net water input, compared to the
+    # size of the full timeseries (as exported to the dump file)
+
+    print('idf_annual_maxima (5 minutes, 1 location)')
+    print('%8s %12s %16s %16s' % ('years', 'time (s)', 'peak mem (MB)', 'series (MB)'))
+    for nyears in [30, 300]:
+        forcing_files, model_pars = forcing_inputs(workdir, nyears, 1)
+        with quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+            model_output = snow.run_model(TS_vec, forcing_data, model_pars, snow.COUPLED_OUTPUTS)
+            TSPrecip = snow.add_sparse_ts(*snow.get_ts_data(forcing_data, model_output, 1/288))
+        args = TSPrecip, forcing_data['calendar']['year'], forcing_data['valid'], 1/288, [5, 10, 15, 30, 60, 120]
+        t, result = timeit(snow.idf_annual_maxima, *args)
+        tracemalloc.start()
+        snow.idf_annual_maxima(*args)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+        print('%8d %12.3f %16.1f %16.1f' % (nyears, t, peak, TSPrecip['ndays'] * 288 * 8 / 2**20))
+
+def bench_events(workdir):
+
+    # Time and peak memory to get the first event passed to the K2 program
+    # (find_events, and the first table of events of collect_ts_output),
+    # compared to building the tables of all of the events
+
+    print('collect_ts_output (5 minutes, 1 location)')
+    print('%8s %8s %14s %14s %16s %16s' % ('years', 'events', 'first (s)', 'all (s)', 'first (MB)', 'all (MB)'))
+    for nyears in [30, 300]:
+        forcing_files, model_pars = forcing_inputs(workdir, nyears, 1)
+        with quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+            model_output = snow.run_model(TS_vec, forcing_data, model_pars, snow.COUPLED_OUTPUTS)
+            TSPrecip = snow.add_sparse_ts(*snow.get_ts_data(forcing_data, model_output, 1/288))
+        calendar = forcing_data['calendar']
+        net_water_input = forcing_data['rainfall'][:, 0] - model_output['rain_on_snow'][:, 0] + model_output['melt'][:, 0]
+        sat = ice = np.zeros(len(net_water_input))
+        TSPrecip_days, TSPrecip_0 = snow.sparse_ts_location(TSPrecip, 0)
+        def events(first):
+            event_rows = snow.find_events(TSPrecip_days, TSPrecip_0, net_water_input, 1/288)
+            tables = snow.collect_ts_output(calendar['year'], calendar['month'], calendar['day'], 1/288, 'id', TSPrecip_days, TSPrecip_0, net_water_input, sat, ice, event_rows)
+            return next(tables) if first else list(tables)
+        result = []
+        for first in [True, False]:
+            t, tables = timeit(events, first)
+            tracemalloc.start()
+            tables = events(first)
+            result += [t, tracemalloc.get_traced_memory()[1] / 2**20]
+            tracemalloc.stop()
+        print('%8d %8d %14.4f %14.4f %16.1f %16.1f' % (nyears, np.sum([len(table['N']) for table in tables]), result[0], result[2], result[1], result[3]))
+
+BENCHMARKS = {}
+BENCHMARKS['forcing'] = bench_forcing
+BENCHMARKS['forcing_cold'] = bench_forcing_cold
+BENCHMARKS['solar'] = bench_solar
+BENCHMARKS['solar_methods'] = bench_solar_methods
+BENCHMARKS['model'] = bench_model
+BENCHMARKS['precision'] = bench_precision
+BENCHMARKS['allocations'] = bench_allocations
+BENCHMARKS['ensemble'] = bench_ensemble
+BENCHMARKS['shards'] = bench_shards
+BENCHMARKS['append'] = bench_append
+BENCHMARKS['active'] = bench_active
+BENCHMARKS['reducers'] = bench_reducers
+BENCHMARKS['disaggregation'] = bench_disaggregation
+BENCHMARKS['resolution'] = bench_resolution
+BENCHMARKS['ts_workers'] = bench_ts_workers
+BENCHMARKS['max_intensity'] = bench_max_intensity
+BENCHMARKS['idf'] = bench_idf
+BENCHMARKS['events'] = bench_events
+
+if __name__ == "__main__":
+
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS)
+    with tempfile.TemporaryDirectory() as workdir:
+        snow.CacheDir = os.path.join(workdir, 'Cache')
+        for name in names:
+            BENCHMARKS[name](workdir)
+            print('')
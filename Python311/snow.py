@@ -1,23 +1,46 @@
 import sys,os
+import hashlib
 import numpy as np
-from datetime import datetime
 from datetime import timedelta
 import scipy.io as sio
 import scipy.special as sp_spec
-import scipy.optimize as sp_optim
 import copy
 import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+try:
+    import numba
+except ImportError:
+    numba = None
 # import matplotlib.pyplot as plt
 
 np.seterr(all="ignore")
 
 GetSiteSpecificParameters = True    # Flag whether to look for site specific parametes (will look in a file called Parameters.csv)
 SaveDailyTable = True               # Flag whether to produce a daily output table of selected quantities (will produce a csv file)
+SaveIDFTable = False                # Flag whether to produce a table of the annual maximum intensities for the durations in IDFDurations (will produce a csv file)
+IDFDurations = [5, 10, 15, 30, 60, 120] # Durations of the annual maximum intensities [minutes] (multiples of TSMinutes)
 SaveAllRHEMSnowOutputs = False      # Flag whether to save all RHEM-Snow Model outputs (daily and 5 minute outputs will be saved in a .mat file) - mainly used for debugging
 SetInitialSaturation = True         # Flag whether to use set initial saturation (False uses RHEM-Snow to calculate this)
 SetInitialIceContent = True         # Flag whether to use set initial ice content (False uses RHEM-Snow to calculate this)
 Sat_i = 0.25                        # Initial fractional soil saturation (if used)
 Ice_i = 0                           # Initial fractional ice content (if used) 
+SolarMethod = 'hourly'              # Method for clear sky solar radiation: 'hourly' (hourly sums, Kumar et al. 1997) or 'daily' (integrated over the day, faster and works at polar latitudes)
+UseCache = True                     # Flag whether to cache parsed CLIGEN data on disk (repeat runs on the same station skip the text parsing)
+CacheDir = './Cache'                # Directory where cached data are stored
+CacheMaxSize = 1000                 # Maximum size of the cache directory [MB] (least recently used entries are removed first)
+ReadWorkers = 0                     # Number of processes used to parse the cligen files that are not in the cache (0: one per processor)
+UseNumba = True                     # Flag whether to run the model time loop as compiled code (needs numba; the numpy version is used otherwise)
+SinglePrecision = False             # Flag whether to store forcing data, model states and outputs, and disaggregated timeseries in single precision (float32, half the memory)
+ModelWorkers = 1                    # Number of processes used to run the model and disaggregate its outputs (locations are split into one shard per process; 0: one per processor, 1: no extra processes)
+CountAllocations = False            # Flag whether to measure the memory allocated in each time step of the numpy version of the model (uses tracemalloc, slower)
+AppendMode = False                  # Flag whether to continue the previous run in OutDir when rows have been added to the cligen files (only the added days are read and simulated)
+CompactSnowPhysics = True           # Flag whether the numpy version of the model runs the snow physics only for the cells with snow, canopy snow or snowfall (same results, faster when most cells are snow-free)
+TSMinutes = 5                       # Timestep of the disaggregated rainfall and snowmelt timeseries [minutes] (must divide 30, e.g. 1, 5, 10 or 15)
+MeltCurveStep = 0                   # Resolution of the day lengths [hours] of the table of diurnal melt curves used to disaggregate snowmelt (0: one curve for each different day length, as in the original code)
+RollingMaxIntensity = False         # Flag whether the maximum intensities of the daily table are for any 30 minutes of the day (rolling window) instead of the fixed half hours (0:00-0:30, 0:30-1:00, ...)
+DisaggregationWorkers = 1           # Number of threads used to disaggregate rainfall and snowmelt (blocks of days are disaggregated in parallel; 0: one per processor)
 
 def default_model_pars(nlocs):
     # Function to populate RHEM-Snow Parameters with their default values
@@ -140,23 +163,24 @@ def get_soil_pars(model_pars):
         
     return(model_pars)
 
-def solarradiation(doys,L,slop,asp):
+def clearsky_radiation(L,slop,asp,method='hourly',order=8):
     # PUPROSE: Calculate solar radiation for a digital elevation model (DEM)
     #          over one year for clear sky conditions in W/m2
     # -------------------------------------------------------------------
-    # USAGE: srad = solarradiation(doys,L,slop,asp)
-    # where: doys are the days to calculate solar radiation for
-    #        L is the latitude
+    # USAGE: srad, day_length = clearsky_radiation(L,slop,asp,method,order)
+    # where: L is the latitude
     #        slop is the slope in degrees
     #        asp in the aspect in degrees from north, clockwise
+    #        method is 'hourly' to add up the radiation of each sunshine hour
+    #        (the original approach), or 'daily' to integrate the radiation 
+    #        between sunrise and sunset over the hour angle with 
+    #        Gauss-Legendre quadrature (polar days and nights are supported
+    #        by limiting the sunrise hour angle to 0-pi)
+    #        order is the number of quadrature points (for method = 'daily')
     #
-    #       srad is the solar radiation in W/m2 over one year per grid cell
-    #
-    # EXAMPLE:
-    #       srad = solarradiation(peaks(50)*100,54.9:-0.1:50,1000,0.2);
-    #       - calculates the solar radiation for an example 50x50 peak surface.
-    #
-    # See also: GRADIENT, CART2POL
+    #       srad is the solar radiation in W/m2 for each day of the year 
+    #       (1-366) per grid cell
+    #       day_length is the day length in hours for each day of the year
     #
     # Note: Follows the approach of Kumar et al 1997. Calculates clear sky
     #       radiation corrected for the incident angle (selfshading) plus
@@ -174,6 +198,10 @@ def solarradiation(doys,L,slop,asp):
     # given slope and aspect, to separate solar irradiance for each day of
     # year, separately) by Patrick Broxton (broxtopd@arizona.edu) - March 2010
 
+    # All days, sunshine hours (or quadrature points), and grid cells are
+    # computed at once, as [hour x day x cell] arrays (hours after sunset on a
+    # given day and cell do not contribute)
+
     # PDB: get aspect into the expected convention
     asp2 = asp - 180
     asp = asp + 180
@@ -187,9 +215,6 @@ def solarradiation(doys,L,slop,asp):
     L=L*dr              # convert to radians
     fcirc = 360 * dr    # 360 degrees in radians 
     
-    srad = np.ones([len(doys), len(L)]) * np.nan
-    day_length = np.ones([len(doys), len(L)]) * np.nan
-
     ## some setup calculations
     sinL = np.sin(L)
     cosL = np.cos(L)
@@ -204,13 +229,13 @@ def solarradiation(doys,L,slop,asp):
     term2 = (cosL * cosSlop + sinL * sinSlop * cosAsp)
     term3 = sinSlop * sinAsp
     
-    ## loop over year
-    for d in range(1, 366+1):
-        #display(['Calculating melt for day ',num2str(d)])  
-        # clear sky solar radiation
-        I0 = S0 * (1 + 0.0344 * np.cos(fcirc*d/tau_a))  # extraterrestrial rad per day
-        # sun declination dS
-        dS = 23.45 * dr * np.sin(fcirc * ( (284+d)/tau_a ) ) #in radians, correct/verified
+    ## all days of the year
+    d = np.arange(1, 366+1)[:, np.newaxis]
+    # clear sky solar radiation
+    I0 = S0 * (1 + 0.0344 * np.cos(fcirc*d/tau_a))  # extraterrestrial rad per day
+    # sun declination dS
+    dS = 23.45 * dr * np.sin(fcirc * ( (284+d)/tau_a ) ) #in radians, correct/verified
+    if method == 'hourly':
         # angle at sunrise/sunset
         hsr = np.arccos(-tanL * np.tan(dS)).real  # angle at sunrise
         # this only works for latitudes up to 66.5 deg N! Workaround:
@@ -219,41 +244,271 @@ def solarradiation(doys,L,slop,asp):
         It_0 = 12 * (1 + hsr/np.pi) - 12 * (1 - hsr/np.pi)              # calc daylength
         It = np.round(12 * (1 + hsr/np.pi) - 12 * (1 - hsr/np.pi))      # calc daylength
         It[np.isnan(It)] = 0
-        ##  daily loop
-        I = 0
-        for t in np.arange(1, np.max(It[:]) + 1, n):  # loop over sunshine hours
-            # if accounting for shading should be included, calc hillshade here
-            # hourangle of sun hs  
-            hs = hsr - (np.pi * t / It)               # hs(t)
-            #solar angle and azimuth
-            sinAlpha = sinL * np.sin(dS) + cosL * np.cos(dS) * np.cos(hs)   # solar altitude angle
-            # correction  using atmospheric transmissivity taub_b
-            M = np.sqrt(1229 + ((614 * sinAlpha))**2) - 614 * sinAlpha      # Air mass ratio
-            tau_b = 0.56 * (np.exp(-0.65 * M) + np.exp(-0.095 * M))
-            tau_d = 0.271 - 0.294 * tau_b   # radiation diffusion coefficient for diffuse insolation
-            tau_r = 0.271 + 0.706 * tau_b   # reflectance transmitivity
-            # correct for local incident angle
-            cos_i = (np.sin(dS) * term1) + (np.cos(dS) * np.cos(hs) * term2) + (np.cos(dS) * term3 * np.sin(hs))
-            Is = I0 * tau_b # potential incoming shortwave radiation at surface normal (equator)
-            # R = potential clear sky solar radiation W m2
-            R = Is * cos_i
-            R[R < 0] = 0        # kick out negative values
-            Id = I0 * tau_d * cosSlop2 / 2 *sinAlpha        #diffuse radiation;
-            Ir = I0 * r * tau_r * sinSlop2 / 2 * sinAlpha # reflectance
-            R = R + Id + Ir
-            R[R < 0] = 0
-            I = I + R * It_0 / It       # solar radiation per day (sunshine hours)
-            # PDB - Correct for rounding error when discretizing into hours
+
+        ## all sunshine hours
+        t = np.arange(1, np.max(It) + 1, n)[:, np.newaxis, np.newaxis]
+        # if accounting for shading should be included, calc hillshade here
+        # hourangle of sun hs  
+        hs = hsr - (np.pi * t / It)               # hs(t)
+    else:
+        # angle at sunrise/sunset (0 during polar night, pi during polar day)
+        hsr = np.arccos(np.clip(-tanL * np.tan(dS), -1, 1))
+        It_0 = 24 * hsr / np.pi                   # calc daylength
+
+        ## quadrature points between sunrise and sunset
+        x, w = np.polynomial.legendre.leggauss(order)
+        hs = hsr * x[:, np.newaxis, np.newaxis]
+
+    #solar angle and azimuth
+    sinAlpha = sinL * np.sin(dS) + cosL * np.cos(dS) * np.cos(hs)   # solar altitude angle
+    # correction  using atmospheric transmissivity taub_b
+    M = np.sqrt(1229 + ((614 * sinAlpha))**2) - 614 * sinAlpha      # Air mass ratio
+    tau_b = 0.56 * (np.exp(-0.65 * M) + np.exp(-0.095 * M))
+    tau_d = 0.271 - 0.294 * tau_b   # radiation diffusion coefficient for diffuse insolation
+    tau_r = 0.271 + 0.706 * tau_b   # reflectance transmitivity
+    # correct for local incident angle
+    cos_i = (np.sin(dS) * term1) + (np.cos(dS) * np.cos(hs) * term2) + (np.cos(dS) * term3 * np.sin(hs))
+    Is = I0 * tau_b # potential incoming shortwave radiation at surface normal (equator)
+    # R = potential clear sky solar radiation W m2
+    R = Is * cos_i
+    R[R < 0] = 0        # kick out negative values
+    Id = I0 * tau_d * cosSlop2 / 2 *sinAlpha        #diffuse radiation;
+    Ir = I0 * r * tau_r * sinSlop2 / 2 * sinAlpha # reflectance
+    R = R + Id + Ir
+    R[R < 0] = 0
+
+    if method == 'hourly':
+        R = R * It_0 / It       # solar radiation per day (sunshine hours)
+        # PDB - Correct for rounding error when discretizing into hours
+        R[np.broadcast_to(t > It, R.shape)] = 0
+        I = np.sum(R, axis=0)   # (summed hour by hour)
 
         I = I/24
-        #  PDB add up radiation part melt for every day
-        NHours = It_0
-        srad[doys == d, :] = np.tile(I, [np.sum(doys == d), 1])
-        day_length[doys == d, :] = np.tile(NHours, [np.sum(doys == d), 1])
+    else:
+        # daily mean = 1/(2 pi) * integral of R over the hour angle from -hsr to hsr
+        I = hsr * np.sum(w[:, np.newaxis, np.newaxis] * R, axis=0) / (2 * np.pi)
+    #  PDB add up radiation part melt for every day
+    NHours = It_0
+
+    return I, NHours
+
+solar_tables = {}       # Clear sky radiation tables that have already been computed (see solarradiation)
+
+def solarradiation(doys,L,slop,asp,method='hourly'):
+    # Function to get the clear sky solar radiation (W/m2) and day length 
+    # (hours) for a set of days and locations (see clearsky_radiation)
+    #
+    # Inputs
+    #   doys: the days of year to get solar radiation for
+    #   L: latitude of each location
+    #   slop: slope of each location in degrees
+    #   asp: aspect of each location in degrees from north, clockwise
+    #   method: 'hourly' or 'daily' (see clearsky_radiation)
+    # Outputs
+    #   srad: the solar radiation in W/m2 [day x location]
+    #   day_length: the day length in hours [day x location]
+    #
+    # The radiation only depends on the day of year and the (latitude, slope,
+    # aspect) of a location, so a table covering days 1-366 is computed once 
+    # for each unique combination, and is kept in memory (and in CacheDir if
+    # UseCache is set) for later calls and runs.  
+
+    if method not in ['hourly', 'daily']:
+        raise ValueError('Unknown solar radiation method: ' + str(method))
+
+    nlocs = len(L)
+    L = np.broadcast_to(np.asarray(L, dtype=float), nlocs)
+    slop = np.broadcast_to(np.asarray(slop, dtype=float), nlocs)
+    asp = np.where(slop == 0, 0., np.broadcast_to(np.asarray(asp, dtype=float), nlocs))   # Aspect does not matter on flat ground
+    keys = list(zip([method] * nlocs, L.tolist(), slop.tolist(), asp.tolist()))
+
+    # Look for tables that are missing from memory in the cache
+    missing = []
+    for key in dict.fromkeys(keys):
+        if key in solar_tables:
+            continue
+        cache_file = os.path.join(CacheDir, 'solar_' + hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest() + '.npy')
+        try:
+            solar_tables[key] = np.load(cache_file)
+            os.utime(cache_file)     # Mark as recently used
+        except (OSError, ValueError):
+            missing.append(key)
+
+    # Compute the remaining tables (in blocks of locations, to limit the size
+    # of the [hour x day x location] arrays)
+    block = 512
+    for b in range(0, len(missing), block):
+        L_b, slop_b, asp_b = np.array([key[1:] for key in missing[b:b+block]]).T
+        srad_b, day_length_b = clearsky_radiation(L_b, slop_b, asp_b, method)
+        for k in range(len(L_b)):
+            key = missing[b+k]
+            solar_tables[key] = np.array([srad_b[:, k], day_length_b[:, k]])
+            if UseCache:
+                cache_file = os.path.join(CacheDir, 'solar_' + hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest() + '.npy')
+                try:
+                    os.makedirs(CacheDir, exist_ok=True)
+                    np.save(cache_file + '.tmp' + str(os.getpid()), solar_tables[key])
+                    os.replace(cache_file + '.tmp' + str(os.getpid()) + '.npy', cache_file)
+                except OSError:
+                    print('Could not write ' + cache_file)
+    if UseCache and len(missing) > 0:
+        trim_cache()
+
+    tables = np.array([solar_tables[key] for key in keys])      # [location x 2 x doy]
+    srad = tables[:, 0, :].T[doys - 1, :]
+    day_length = tables[:, 1, :].T[doys - 1, :]
 
     return srad, day_length
 
-def get_forcing_cligen(forcing_files,model_pars):
+def trim_cache():
+
+    # Function to keep the cache directory below CacheMaxSize by removing the
+    # least recently used entries (an entry is all of the files sharing the
+    # same name before the first '.')
+
+    entries = {}
+    for fname in os.listdir(CacheDir):
+        path = os.path.join(CacheDir, fname)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        key = fname.split('.')[0]
+        size, mtime, paths = entries.get(key, (0, 0, []))
+        entries[key] = (size + st.st_size, max(mtime, st.st_mtime), paths + [path])
+
+    total = sum([entry[0] for entry in entries.values()])
+    for size, mtime, paths in sorted(entries.values(), key=lambda entry: entry[1]):
+        if total <= CacheMaxSize * 1E6:
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total = total - size
+
+def read_cligen_file(cligen_file, offset=0, parse=True):
+
+    # Function to read the daily records and the station latitude/elevation
+    # from a cligen file.  If UseCache is set, the parsed records are stored in
+    # CacheDir as a binary .npy file keyed by a hash of the file contents, so
+    # that later runs on the same (unchanged) file can memory-map the records
+    # instead of parsing the text again.  Editing the file changes the hash, 
+    # so stale entries are never used (they are eventually removed by
+    # trim_cache)
+    #
+    # Inputs
+    #   cligen_file: path to the cligen file
+    #   offset: position [bytes] in the file of the first row to read (0: all
+    #   rows; rows read from an offset are not cached)
+    #   parse: flag whether to parse the file if its records are not in the
+    #   cache (False: return None instead)
+    # Outputs
+    #   cligen_data: array with one row per day and one column per cligen field
+    #   latitude: station latitude [degrees]
+    #   elevation: station elevation [meters]
+
+    if offset > 0:
+        if not parse:
+            return None
+        with open(cligen_file, 'rb') as f:
+            header = [f.readline() for i in range(15)]
+            f.seek(offset)
+            lines = [line for line in f.read().decode().splitlines() if line.strip()]
+        fields = header[4].split()
+        cligen_data = np.loadtxt(lines, ndmin=2) if lines else np.zeros((0, 13))
+        return cligen_data, float(fields[0]), float(fields[2])
+
+    with open(cligen_file, 'rb') as f:
+        raw = f.read()
+    
+    if UseCache:
+        key = hashlib.blake2b(raw, digest_size=16).hexdigest()
+        data_file = os.path.join(CacheDir, 'cligen_' + key + '.npy')
+        header_file = os.path.join(CacheDir, 'cligen_' + key + '.hdr')
+        try:
+            cligen_data = np.load(data_file, mmap_mode='r')
+            with open(header_file) as f:
+                latitude, elevation = [float(field) for field in f.read().split()]
+            os.utime(data_file)     # Mark as recently used
+            return cligen_data, latitude, elevation
+        except (OSError, ValueError):
+            pass
+    if not parse:
+        return None
+
+    lines = raw.decode().splitlines()
+    fields = lines[4].split()
+    latitude = float(fields[0])
+    elevation = float(fields[2])
+    cligen_data = np.loadtxt(lines, skiprows=15)
+
+    if UseCache:
+        # Write to temporary files first so that partially written entries are
+        # never read (e.g. if several processes share the same cache)
+        tmp = '.tmp' + str(os.getpid()) + '_' + str(id(raw))
+        try:
+            os.makedirs(CacheDir, exist_ok=True)
+            np.save(data_file + tmp, cligen_data)
+            with open(header_file + tmp, 'w') as f:
+                f.write(repr(latitude) + ' ' + repr(elevation))
+            os.replace(header_file + tmp, header_file)
+            os.replace(data_file + tmp + '.npy', data_file)
+            trim_cache()
+        except OSError:
+            print('Could not write ' + data_file)
+    
+    return cligen_data, latitude, elevation
+
+def parse_cligen_file(cligen_file, offset, use_cache, cache_dir):
+    # Function to parse a cligen file with read_cligen_file in a process started
+    # by get_forcing_cligen, with the cache settings of the calling process
+    global UseCache, CacheDir
+    UseCache, CacheDir = use_cache, cache_dir
+    return read_cligen_file(cligen_file, offset)
+
+def cligen_leap_days(year, mon, day):
+
+    # Function to find the leap days that cligen generates on the 100th, 200th,
+    # and 300th years (which are not leap years)
+
+    return np.logical_and(np.mod(year,400) > 0, np.logical_and(np.mod(year,100) == 0, np.logical_and(mon == 2, day == 29)))
+
+def get_calendar(year, mon, day):
+
+    # Function to build the calendar for a record of days (in one pass, 
+    # without creating a python datetime object for each day)
+    #
+    # Inputs
+    #   year, mon, day: year, month, and day of each day of the record
+    # Outputs
+    #   dates: array of dates (numpy datetime64)
+    #   calendar: structure with integer arrays of the year, month, day, and
+    #   day of year of each day (with the invalid cligen leap days moved to
+    #   February 28th)
+
+    year = np.asarray(year).astype(int)
+    mon = np.asarray(mon).astype(int)
+    day = np.asarray(day).astype(int)
+    day = np.where(cligen_leap_days(year, mon, day), 28, day)
+
+    dates = (year - 1970).astype('datetime64[Y]').astype('datetime64[M]') + (mon - 1)
+    dates = dates.astype('datetime64[D]') + (day - 1)
+
+    calendar = {}
+    calendar['year'] = year
+    calendar['month'] = mon
+    calendar['day'] = day
+    calendar['doy'] = (dates - dates.astype('datetime64[Y]')).astype(int) + 1
+    
+    return dates, calendar
+
+# Extremes of the solar radiation of a record that are used to correct the clear
+# sky radiation (see get_forcing_cligen; they are kept in forcing_data['record'])
+SOLAR_EXTREMES = ['srad_summer', 'R0_summer', 'srad_winter', 'R0_winter', 'R0_min', 'R0_max']
+
+def get_forcing_cligen(forcing_files,model_pars,solar_method=None,record=None):
 
     # Function to get cligen forcing data from one or more cligen files, prepare 
     # the data for RHEM-snow, and get their associated site-specific parameter 
@@ -263,21 +518,57 @@ def get_forcing_cligen(forcing_files,model_pars):
     #   forcing_files is a list of files to read forcing data from [each will be
     #   treated as a separate location]
     #   model_pars: structure with all of the model parameters 
+    #   solar_method: method used for clear sky solar radiation, 'hourly' or 
+    #   'daily' (see clearsky_radiation) [default: SolarMethod]
+    #   record: forcing_data['record'] of an earlier call on the same files
+    #   (only the rows that have been added to the files since are read)
     # Outputs
-    #   TS_vec: an array of matlab timestamps that the data is valid for
+    #   TS_vec: an array of dates (numpy datetime64) that the data is valid for
     #   forcing_data: structure with all of the model parameters
-
-    # Load Cligen Data
-
-    i = 0
-
-    non_blank_count = 0
-    with open(forcing_files[0]) as file:
-        for line in file:
-            if line.strip():
-                non_blank_count += 1
-    nrows = non_blank_count-15
+    #
+    # forcing_data['record'] holds the position in each file up to which it was
+    # read, the number of rows read so far, the last date, and the extremes of
+    # the solar radiation that are used to correct it (these are combined with
+    # the ones of the earlier rows, so that the added rows get the correction of
+    # the whole record).
+    #
+    # Files with records of different lengths are padded (with nan) to the 
+    # length of the longest record, and forcing_data['valid'] marks the days 
+    # that have data at each location.  All records are assumed to start on the
+    # same day.
+
+    # Load Cligen Data (the files that are not in the cache are parsed in a
+    # pool of processes, as np.loadtxt holds the GIL)
+
+    if record is not None:
+        if np.any(record['nrows'] != record['nrows'][0]):
+            raise ValueError('Records of different lengths can not be extended')
+        offsets = [int(offset) for offset in record['offset']]
+    else:
+        offsets = [0] * len(forcing_files)
+    sizes = []
+    for cligen_file in forcing_files:
+        print('Reading data from ' + cligen_file)
+        sizes.append(os.path.getsize(cligen_file))
+    cligen_records = [read_cligen_file(cligen_file, offset, parse=False) for cligen_file, offset in zip(forcing_files, offsets)]
+    parse = [i for i in range(len(forcing_files)) if cligen_records[i] is None]
+    nworkers = min(ReadWorkers if ReadWorkers > 0 else os.cpu_count(), len(parse))
+    if nworkers > 1:
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            parsed = list(pool.map(parse_cligen_file, [forcing_files[i] for i in parse], [offsets[i] for i in parse], [UseCache] * len(parse), [CacheDir] * len(parse)))
+    else:
+        parsed = [read_cligen_file(forcing_files[i], offsets[i]) for i in parse]
+    for i, cligen_record in zip(parse, parsed):
+        cligen_records[i] = cligen_record
+
+    nvalid = np.array([len(cligen_record[0]) for cligen_record in cligen_records])
+    nrows = np.max(nvalid)
+    if nrows == 0:
+        raise ValueError('No rows have been added to the cligen files')
     nlocs = len(forcing_files)
+    ref = np.argmax(nvalid)                 # Location with the longest record (used for the dates)
+
+    valid = np.arange(nrows)[:, np.newaxis] < nvalid
     
     day = np.ones([nrows, nlocs]) * np.nan
     mon = np.ones([nrows, nlocs]) * np.nan
@@ -292,48 +583,33 @@ def get_forcing_cligen(forcing_files,model_pars):
     wind = np.ones([nrows, nlocs]) * np.nan
     tdpt = np.ones([nrows, nlocs]) * np.nan
     
-    for cligen_file in forcing_files:
-    
-        print('Reading data from ' + forcing_files[i])
-
-        f = open(cligen_file)
-        for t in range(5):
-            tline = f.readline()
-        f.close
-        
-        fields = tline.split()
-        model_pars['latitude'][i] = fields[0]
-        model_pars['elevation'][i] = fields[2]
-
-        cligen_data = np.loadtxt(open(cligen_file, 'rb'), skiprows=15)
-        day[:, i] = cligen_data[:, 0]     # day of simulation
-        mon[:, i] = cligen_data[:, 1]     # month of simulation
-        year[:, i] = cligen_data[:, 2]    # year of simulation
-        prcp[:, i] = cligen_data[:, 3]    # daily precipitation amount [mm of water]
-        stmdur[:, i] = cligen_data[:, 4]  # duration of precipitation [hr]
-        timep[:, i] = cligen_data[:, 5]   # ratio of time to rainfall peak / rainfall duration
-        ip[:, i] = cligen_data[:, 6]      # ratio of maximum rainfall intensity / average rainfall intensity
-        tmax[:, i] = cligen_data[:, 7]    # maximum daily temperature [degrees C]
-        tmin[:, i] = cligen_data[:, 8]    # minimum daily temperature [degrees C]
-        srad[:, i] = cligen_data[:, 9]    # daily solar radiation [langleys/day] - real
-        wind[:, i] = cligen_data[:, 10]   # wind speed
-        tdpt[:, i] = cligen_data[:, 12]   # dew point temperature [degrees C]
-        i = i+1
+    for i in range(nlocs):
+
+        cligen_data, model_pars['latitude'][i], model_pars['elevation'][i] = cligen_records[i]
+        n = nvalid[i]
+
+        day[:n, i] = cligen_data[:, 0]     # day of simulation
+        mon[:n, i] = cligen_data[:, 1]     # month of simulation
+        year[:n, i] = cligen_data[:, 2]    # year of simulation
+        prcp[:n, i] = cligen_data[:, 3]    # daily precipitation amount [mm of water]
+        stmdur[:n, i] = cligen_data[:, 4]  # duration of precipitation [hr]
+        timep[:n, i] = cligen_data[:, 5]   # ratio of time to rainfall peak / rainfall duration
+        ip[:n, i] = cligen_data[:, 6]      # ratio of maximum rainfall intensity / average rainfall intensity
+        tmax[:n, i] = cligen_data[:, 7]    # maximum daily temperature [degrees C]
+        tmin[:n, i] = cligen_data[:, 8]    # minimum daily temperature [degrees C]
+        srad[:n, i] = cligen_data[:, 9]    # daily solar radiation [langleys/day] - real
+        wind[:n, i] = cligen_data[:, 10]   # wind speed
+        tdpt[:n, i] = cligen_data[:, 12]   # dew point temperature [degrees C]
     
     print('Processing forcing data')
     
     # Fix problem where leap days appear on 100, 200, and 300th year
-    locs = np.logical_and(np.mod(year,400) > 0, np.logical_and(np.mod(year,100) == 0, np.logical_and(mon == 2, day == 29)))
-    day[locs] = 28
+    day[cligen_leap_days(year, mon, day)] = 28
     
-    TS_vec = []
-    for i in range(len(day)):
-        TS_vec.append(datetime(int(year[i, 0]),int(mon[i, 0]),int(day[i, 0])))
-    doys = []
-    for TS in TS_vec:
-        doys.append(TS.timetuple().tm_yday)
-    TS_vec = np.array(TS_vec)
-    doys = np.array(doys)
+    TS_vec, calendar = get_calendar(year[:, ref], mon[:, ref], day[:, ref])
+    doys = calendar['doy']
+    if record is not None and TS_vec[0] <= record['last_date']:
+        raise ValueError('The rows added to the cligen files do not continue the earlier record')
 
     # Humidity Conversions
     tmean = (tmax + tmin) / 2       # Average daily temperature (degrees C)
@@ -350,74 +626,77 @@ def get_forcing_cligen(forcing_files,model_pars):
     # Use a rainfall threshold (smooth function from T+1 to T-1)
     dh = 1
     
-    rainthresh_tmax = model_pars['RainThresh'] + model_pars['RainThresh_dh']/2
-    rainthresh_tmin = model_pars['RainThresh'] - model_pars['RainThresh_dh']/2
+    # All of the steps below operate on whole [day x location] arrays at once,
+    # with the per-location parameters broadcast across the days
+    rainthresh = np.asarray(model_pars['RainThresh'], dtype=float)
+    rainthresh_dh = np.asarray(model_pars['RainThresh_dh'], dtype=float)
+    rainthresh_tmax = rainthresh + rainthresh_dh/2
+    rainthresh_tmin = rainthresh - rainthresh_dh/2
     dx = rainthresh_tmax - rainthresh_tmin
     if model_pars['use_tdew_ppm']:
         T = tdpt
     else:
         T = tmean
     
-    f_s = np.zeros(T.shape)
-    for i in range(len(T[:,0])):
-        T_i = T[i,:]
-        fs = 1 - ((dh/dx) * (T[i,:]-rainthresh_tmin) - (dh * np.sin((2*np.pi/dx) * (T[i,:]-rainthresh_tmin))) / (2*np.pi))
-        fs[fs < 0] = 0
-        fs[fs > 1] = 1
-        f_s[i,:] = fs
+    # Snowfall fraction, limited to 0-1
+    f_s = np.clip(1 - ((dh/dx) * (T-rainthresh_tmin) - (dh * np.sin((2*np.pi/dx) * (T-rainthresh_tmin))) / (2*np.pi)), 0, 1)
 
     rainfall = prcp * (1-f_s)  # daily rainfall amount (mm of water) 
     snowfall = prcp * f_s      # daily snowfall amount (mm of water) 
 
     # Apply the snowfall multiplier if specified
-    if len(model_pars['snow_mult']) > 1:
-        for i in range(len(snowfall[0,:])):
-            snowfall[:,i] = snowfall[:,i] * model_pars['snow_mult'][i]
-    else:
-        snowfall = snowfall * model_pars['snow_mult'][0]
+    snowfall = snowfall * np.asarray(model_pars['snow_mult'], dtype=float)
 
     # Potential solar radiation and solar forcing index
     srad = srad * 0.484583         # Convert forcing solar radiation to W/m2
     # Compute potential solar forcing on flat vs inclined surface (for
     # correction on differently oriented slopes)
-    R0, day_length = solarradiation(doys, model_pars['latitude'], model_pars['slope']*0, model_pars['aspect'])
-    Rs, dummy = solarradiation(doys, model_pars['latitude'], model_pars['slope'], model_pars['aspect'])
+    if solar_method is None:
+        solar_method = SolarMethod
+    R0, day_length = solarradiation(doys, model_pars['latitude'], model_pars['slope']*0, model_pars['aspect'], solar_method)
+    Rs, dummy = solarradiation(doys, model_pars['latitude'], model_pars['slope'], model_pars['aspect'], solar_method)
     SFI = Rs / R0
+    SFI[R0 == 0] = 1        # No correction when the sun does not rise (polar night)
+    del Rs, dummy
     
     # Correct for min and max values based on observed solar data
-    T_summer = np.amax(srad[np.logical_and(doys > 150, doys < 200), :], axis=0) / np.amax(R0[np.logical_and(doys > 150, doys < 200), :], axis=0)
-    T_winter = np.amax(srad[np.logical_or(doys > 350, doys < 10), :], axis=0) / np.amax(R0[np.logical_or(doys > 350, doys < 10), :], axis=0)
-    frac = np.ones(R0.shape) * np.nan
-    for i in range(len(R0[0, :])):
-        frac[:, i] = (R0[:, i] - np.min(R0[:, i])) / (np.max(R0[:, i]) - np.min(R0[:, i]))
-
-    T_ti = frac * T_summer + (1-frac) * T_winter
-    R0 = R0 * T_ti
+    summer = np.logical_and(doys > 150, doys < 200)
+    winter = np.logical_or(doys > 350, doys < 10)
+    solar = {}
+    solar['srad_summer'] = np.nanmax(srad[summer, :], axis=0, initial=-np.inf)
+    solar['R0_summer'] = np.amax(R0[summer, :], axis=0, initial=-np.inf)
+    solar['srad_winter'] = np.nanmax(srad[winter, :], axis=0, initial=-np.inf)
+    solar['R0_winter'] = np.amax(R0[winter, :], axis=0, initial=-np.inf)
+    solar['R0_min'] = np.min(R0, axis=0)
+    solar['R0_max'] = np.max(R0, axis=0)
+    if record is not None:
+        for var in solar:
+            solar[var] = np.minimum(solar[var], record[var]) if var == 'R0_min' else np.maximum(solar[var], record[var])
+    T_summer = solar['srad_summer'] / solar['R0_summer']
+    T_winter = solar['srad_winter'] / solar['R0_winter']
+    R0_min = solar['R0_min']
+    frac = (R0 - R0_min) / (solar['R0_max'] - R0_min)
+    R0 = R0 * (frac * T_summer + (1-frac) * T_winter)
+    del frac
 
     # Incoming Longwave Radiation
 
     # Compute the longwave radiation input by first, computing 
     # cloud fraction (compare observed and potential solar radiation)
-    CF = np.ones(R0.shape) * np.nan
-    for i in range(len(srad[0, :])):
-        cf = (1 - (srad[:, i] / R0[:, i])) * (1 - model_pars['CloudTransmission'][i])
-        cf[cf < 0] = 0
-        cf[cf > 1] = 1
-        CF[:, i] = cf
+    CF = np.clip((1 - srad / R0) * (1 - np.asarray(model_pars['CloudTransmission'], dtype=float)), 0, 1)
 
     CF = np.maximum(np.minimum(1,prcp/25.4), CF)
     # Then, calculate incoming longwave radiation
     Eacls = 1.08 * (1 - np.exp(-(vapp/100)**(tmean/2016)))
     Ea = CF + (1-CF) * Eacls
     lrad = Ea * 5.67E-8 * (tmean + 273.15)**4
+    del CF, Eacls, Ea
 
     # Apply multiplier to shortwave radiation if specified
-    for i in range(len(srad[0, :])):
-        srad[:, i] = srad[:, i] * SFI[:, i] * model_pars['srad_mult'][i]
+    srad = srad * SFI * np.asarray(model_pars['srad_mult'], dtype=float)
 
     # Apply longwave radiation multiplier (if specified)
-    for i in range(len(lrad[0, :])):
-        lrad[:, i] = lrad[:, i] * model_pars['lrad_mult'][i]
+    lrad = lrad * np.asarray(model_pars['lrad_mult'], dtype=float)
             
     
     ## Put data in output structure
@@ -437,6 +716,9 @@ def get_forcing_cligen(forcing_files,model_pars):
     forcing_data['stmdur'] = stmdur
     forcing_data['timep'] = timep
     forcing_data['ip'] = ip
+    forcing_data['valid'] = valid
+    forcing_data['calendar'] = calendar
+    forcing_data['record'] = dict(solar, offset=np.array(sizes), nrows=nvalid + (record['nrows'] if record is not None else 0), last_date=TS_vec[-1])
 
     rad = forcing_data['srad'] / 1000000 * 3600 * 24    # MJ/day/m2
     latent_heat_flux = 2.26                             # MJ/kg  (2260 kj/g)
@@ -446,11 +728,150 @@ def get_forcing_cligen(forcing_files,model_pars):
     locs = forcing_data['tmean'] < -5                   # mm/day
     forcing_data['PET'][locs] = 0
     forcing_data['PET'] = forcing_data['PET'] * 1000   # PET is transformed in mm
+
+    # Store the forcing data in single precision (if specified).  The model
+    # states and outputs, and the disaggregated timeseries follow the
+    # precision of the forcing data
+    if SinglePrecision:
+        for var in forcing_data:
+            if var not in ['valid', 'calendar', 'record']:
+                forcing_data[var] = forcing_data[var].astype(np.float32)
     
     return TS_vec, forcing_data
 
+# Outputs of run_model: [description, units] (this is also the order in which
+# run_model_kernel computes them)
+MODEL_OUTPUTS = {}
+MODEL_OUTPUTS['swe']                        = ['Snow Water Equivalent', 'mm']
+MODEL_OUTPUTS['depth']                      = ['Snow Depth', 'mm']
+MODEL_OUTPUTS['density']                    = ['Snow Density', 'g/cm3']
+MODEL_OUTPUTS['rain_on_snow']               = ['Rain on Snow', 'mm/day']
+MODEL_OUTPUTS['snowpack_sublimation']       = ['Sublimation (from snowpack)', 'mm/day']
+MODEL_OUTPUTS['tsfall']                     = ['Snow throughfall (below canopy)', 'mm/day']
+MODEL_OUTPUTS['snow_unload']                = ['Snow unloading (from canopy)', 'mm/day']
+MODEL_OUTPUTS['melt_drip']                  = ['Melt Drip (from canopy)', 'mm/day']
+MODEL_OUTPUTS['canopy_sublimation']         = ['Sublimation (from canopy)', 'mm/day']
+MODEL_OUTPUTS['canopy_snow_storage']        = ['Canopy Snow Storage', 'mm']
+MODEL_OUTPUTS['melt']                       = ['Snowmelt', 'mm/day']
+MODEL_OUTPUTS['albedo']                     = ['Surface albedo', '-']
+MODEL_OUTPUTS['Tm']                         = ['Integrated snowpack temperature', 'C']
+MODEL_OUTPUTS['Ts']                         = ['Surface temperature', 'C']
+MODEL_OUTPUTS['Qsn']                        = ['Net shortwave radiation', 'W/m2']
+MODEL_OUTPUTS['Qle']                        = ['Outgoing Longwave Radiation', 'W/m2']
+MODEL_OUTPUTS['Qn']                         = ['Net Radiation', 'W/m2']
+MODEL_OUTPUTS['Qn_snow']                    = ['Net Radiation over snowpack', 'W/m2']
+MODEL_OUTPUTS['Qh']                         = ['Sensible heat', 'W/m2']
+MODEL_OUTPUTS['Qg']                         = ['Ground heat', 'W/m2']
+MODEL_OUTPUTS['Qe']                         = ['Latent heat', 'W/m2']
+MODEL_OUTPUTS['Qp']                         = ['Heat from precip', 'W/m2']
+MODEL_OUTPUTS['Qm']                         = ['Melt heat', 'W/m2']
+MODEL_OUTPUTS['Q']                          = ['Cold Content', 'J/m2']
+MODEL_OUTPUTS['T_soil']                     = ['Soil temperature', 'C']
+MODEL_OUTPUTS['ice_fraction_soil']          = ['Soil ice fraction', '%']
+MODEL_OUTPUTS['ET']                         = ['Actual evapotranspiration', 'mm/day']
+MODEL_OUTPUTS['SMC']                        = ['Soil moisture content', '%']
+MODEL_OUTPUTS['infil_runoff']               = ['Infiltration excess runoff', 'mm/day']
+MODEL_OUTPUTS['sat_runoff']                 = ['Saturation excess runoff', 'mm/day']
+MODEL_OUTPUTS['perc']                       = ['Percolation out of the top soil layer', 'mm/day']
+MODEL_OUTPUTS['caprise']                    = ['Capillary rise into the top soil layer', 'mm/day']
+MODEL_OUTPUTS['infiltration']               = ['Infiltration', 'mm/day']
+MODEL_OUTPUTS['x_vadose']                   = ['Water in the vadose zone', 'mm']
+MODEL_OUTPUTS['x_phreatic']                 = ['Water in the phreatic zone', 'mm']
+MODEL_OUTPUTS['q_vadose']                   = ['Outflow from the vadose zone', 'mm/day']
+MODEL_OUTPUTS['q_phreatic']                 = ['Outflow from the phreatic zone', 'mm/day']
+
+# Outputs that are needed by run (when neither the dump file nor the daily table
+# are saved)
+COUPLED_OUTPUTS = ['rain_on_snow', 'melt', 'SMC', 'ice_fraction_soil']
+
+# Parameters that are used by get_forcing_cligen (these can not change between
+# the members of an ensemble that share the same forcing data, see run_ensemble)
+FORCING_PARS = ['latitude', 'elevation', 'slope', 'aspect', 'CloudTransmission', 'RainThresh', 'RainThresh_dh', 'lrad_mult', 
+                'snow_mult', 'srad_mult', 'temp_adj', 'use_tdew_ppm']
+
+# Statistics of the reducers of run_model (see reduce_block): [ufunc that
+# combines the values of the days of a period, its identity, function that
+# gives the values that are combined from the daily values and the threshold
+# of the reducer (None: the daily values), and a flag whether the result is
+# divided by the number of days].  Other statistics can be added in the same way
+REDUCER_STATISTICS = {}
+REDUCER_STATISTICS['sum']   = [np.add, 0., None, False]
+REDUCER_STATISTICS['max']   = [np.maximum, -np.inf, None, False]
+REDUCER_STATISTICS['min']   = [np.minimum, np.inf, None, False]
+REDUCER_STATISTICS['mean']  = [np.add, 0., None, True]
+REDUCER_STATISTICS['count'] = [np.add, 0., np.greater, False]      # (days above the threshold)
+
+# Calendar periods of the reducers of run_model (see reducer_periods)
+REDUCER_PERIODS = ['year', 'month', 'all']
+
+# Order of the states, parameters, and constants passed to run_model_kernel and run_model_numpy
+KERNEL_STATES = ['swe', 'cansnowstor', 'swe_age_a', 'Tm', 'cc', 'density', 'sm_stor', 'Q_soil', 'ice_fraction_soil', 'x_vadose', 'x_phreatic']
+KERNEL_PARS = ['lai', 'elevation', 'albedo_snow_reset', 'minalbedo', 'albedo_i', 'albedo_decay', 'groundveght', 'albedo_0', 
+               'windlevel', 'sroughness', 'fstab', 'Ch', 'melt_drip_par', 'snow_unload_par', 'canopy_sub_mult', 'kappa_snow', 
+               'tempdampdepth', 'H', 'ground_sub_mult', 'kappa_soil', 'dampdepth', 'density_min', 'density_max', 'apar', 'dpar', 
+               'rpar', 'max_infil_mult', 'sm_min_infil', 'sm_max_infil', 'wp', 'cmc', 'k_soil', 'b_soil', 'psi_s', 'coef_vadose', 
+               'coef_vadose_exp', 'coef_vadose2phreatic', 'coef_phreatic', 'coef_phreatic_exp', 'sm_sat', 'sm_res']
+KERNEL_CONSTS = ['karman', 'subheat', 'fusheat', 'specheat_a', 'specheat_w', 'specheat_i', 'Rd', 'g', 'emiss_snow', 'sigma', 
+                 'M2MM', 'TS', 'DAY', 'K', 'rhoi', 'rhow', 'P0', 'L', 'rhos', 'specheat_s']
+
+# Cold contents that are closer to zero than CC_ROUNDING times the machine
+# epsilon of the arithmetic times the size of the terms of the energy balance
+# (the rounding errors of the sum) are set to zero, so that the compiled and
+# numpy versions agree on the days on which the snowpack becomes isothermal
+CC_ROUNDING = 64
+
 # @profile
-def run_model(TS_vec, forcing_data, model_pars):
+def run_model(TS_vec, forcing_data, model_pars, outputs=None, columns=None, checkpoint_days=None, checkpoint_file='checkpoint_%d.npz', restart_file=None, first_day=0, reducers=None):
+    # Function to run RHEM-Snow
+    #
+    # Inputs
+    #   TS_vec, forcing_data: dates and forcing data (from get_forcing_cligen)
+    #   model_pars: model parameters
+    #   outputs: names of the outputs to compute (see MODEL_OUTPUTS; all outputs
+    #   if None).  Outputs that are not requested are not stored
+    #   columns: column of forcing_data used for each column of model_pars and of
+    #   the outputs (None: one column per location of forcing_data), so that
+    #   several parameter sets can share the same forcing data (see run_ensemble)
+    #   checkpoint_days: days (indices of TS_vec) at the end of which the model
+    #   states are saved (see save_checkpoint)
+    #   checkpoint_file: name of the checkpoint files (%d is replaced by the day)
+    #   restart_file: checkpoint file to start from (the run continues on the day
+    #   after the checkpoint; the outputs of earlier days are nan)
+    #   first_day: day of the checkpoint files that TS_vec starts on (e.g. when
+    #   TS_vec holds the days that were added to a record; checkpoint_days are
+    #   still indices of TS_vec)
+    #   reducers: statistics of outputs over calendar periods that are computed
+    #   in the time loop, as a dictionary {name: [output, statistic, period]}, or
+    #   [output, statistic, period, threshold] (see REDUCER_STATISTICS and
+    #   REDUCER_PERIODS), e.g. {'peak_swe': ['swe', 'max', 'year']}.  The daily
+    #   values of the outputs are only kept for blocks of days, so with
+    #   outputs=[] the memory used does not grow with the length of the record
+    #
+    # Outputs
+    #   model_output: daily outputs [day x location] of each requested variable,
+    #   and the statistics [period x location] of each reducer (nan for periods
+    #   without days; the first day of each period is given by reducer_periods)
+
+    if outputs is None:
+        outputs = list(MODEL_OUTPUTS)
+    for var in outputs:
+        if var not in MODEL_OUTPUTS:
+            raise ValueError('Unknown model output: ' + str(var))
+    outputs = [var for var in MODEL_OUTPUTS if var in outputs]
+    reducers = {} if reducers is None else dict(reducers)
+    for name in reducers:
+        reducers[name] = list(reducers[name]) + [0.] * (4 - len(reducers[name]))
+        var, statistic, period, threshold = reducers[name]
+        if name in MODEL_OUTPUTS:
+            raise ValueError('Reducer ' + str(name) + ' has the name of a model output')
+        if var not in MODEL_OUTPUTS:
+            raise ValueError('Unknown model output: ' + str(var))
+        if statistic not in REDUCER_STATISTICS:
+            raise ValueError('Unknown reducer statistic: ' + str(statistic))
+        if period not in REDUCER_PERIODS:
+            raise ValueError('Unknown reducer period: ' + str(period))
+    stored = [var for var in MODEL_OUTPUTS if var in outputs or any(var == reducers[name][0] for name in reducers)]
+
     print('Running RHEM-Snow')
     # Model Constants
     modelconst = {}
@@ -480,7 +901,10 @@ def run_model(TS_vec, forcing_data, model_pars):
     # Initialization
 
     #  Size of state (for simultaneous execution on multiple cells)
-    sz = forcing_data['rainfall'][1, :].shape
+    if columns is None:
+        columns = np.arange(forcing_data['rainfall'].shape[1])
+    columns = np.asarray(columns, dtype=int)
+    sz = columns.shape
 
     # Initialize snow states to zero
     state = {}
@@ -498,455 +922,1648 @@ def run_model(TS_vec, forcing_data, model_pars):
     state['x_vadose'] = model_pars['q_vadose_i'] / model_pars['coef_vadose']  # Water in Vadose Zone
     state['x_phreatic'] = model_pars['q_phreatic_i'] / model_pars['coef_phreatic']  # Water in Phreatic Zone
 
-    depth = state['swe'] / state['density']
-    depth_p = depth
     sm_sat = model_pars['ssat'] * model_pars['H']  # Saturated soil water content
     sr = (0.1 + 0.3/(1.+(1./(model_pars['g']/1000.))**4.)**.25)
     sm_res = sr * model_pars['H'] * np.ones(sz)
-    cc_p = state['cc']  # Previous cold content
+
+    # Keep the states and parameters in the precision of the forcing data
+    dtype = forcing_data['tmean'].dtype
+    model_pars = dict(model_pars)
+    for par in KERNEL_PARS[:-2]:
+        model_pars[par] = np.asarray(model_pars[par], dtype=dtype)
+    for var in state:
+        state[var] = np.asarray(state[var], dtype=dtype)
+    Tm = np.asarray(Tm, dtype=dtype)
+    sm_sat = np.asarray(sm_sat, dtype=dtype)
+    sm_res = np.asarray(sm_res, dtype=dtype)
     # Tm = state['cc']/((np.maximum(1, state['swe']) / modelconst['M2MM']) * modelconst['rhow'] * modelconst['specheat_i'])
 
     # Initialize the model output variables based on the size of the forcing data
-    model_output = {}
-    model_output['swe'] = np.zeros(forcing_data['tmean'].shape)  # Snow Water Equivalent [mm]
-    model_output['depth'] = np.zeros(forcing_data['tmean'].shape)  # Snow Depth [mm]
-    model_output['density'] = np.zeros(forcing_data['tmean'].shape)  # Snow Density [g/cm3]
-    model_output['rain_on_snow'] = np.zeros(forcing_data['tmean'].shape)  # Rain on Snow [mm/day]
-    model_output['snowpack_sublimation'] = np.zeros(forcing_data['tmean'].shape)  # Sublimation (from snowpack) [mm/day]
-    model_output['tsfall'] = np.zeros(forcing_data['tmean'].shape)  # Snow throughfall (below canopy) [mm/day]
-    model_output['snow_unload'] = np.zeros(forcing_data['tmean'].shape)  # Snow unloading (from canopy) [mm/day]
-    model_output['melt_drip'] = np.zeros(forcing_data['tmean'].shape)  # Melt Drip (from canopy) [mm/day]
-    model_output['canopy_sublimation'] = np.zeros(forcing_data['tmean'].shape)  # Sublimation (from canopy) [mm/day]
-    model_output['canopy_snow_storage'] = np.zeros(forcing_data['tmean'].shape)  # Canopy Snow Storage [mm]
-    model_output['melt'] = np.zeros(forcing_data['tmean'].shape)  # Snowmelt [mm/day]
-    model_output['albedo'] = np.zeros(forcing_data['tmean'].shape)  # Surface albedo [-]
-    model_output['Tm'] = np.zeros(forcing_data['tmean'].shape)  # Integrated snowpack temperature [C]
-    model_output['Ts'] = np.zeros(forcing_data['tmean'].shape)  # Surface temperature [C]
-    model_output['Qsn'] = np.zeros(forcing_data['tmean'].shape)  # Net shortwave radiation [W/m2]
-    model_output['Qle'] = np.zeros(forcing_data['tmean'].shape)  # Outgoing Longwave Radiation [W/m2]
-    model_output['Qn'] = np.zeros(forcing_data['tmean'].shape)  # Net Radiation [W/m2]
-    model_output['Qn_snow'] = np.zeros(forcing_data['tmean'].shape)  # Net Radiation over snowpack [W/m2]
-    model_output['Qh'] = np.zeros(forcing_data['tmean'].shape)  # Sensible heat [W/m2]
-    model_output['Qg'] = np.zeros(forcing_data['tmean'].shape)  # Ground heat [W/m2]
-    model_output['Qe'] = np.zeros(forcing_data['tmean'].shape)  # Latent heat [W/m2]
-    model_output['Qp'] = np.zeros(forcing_data['tmean'].shape)  # Heat from precip [W/m2]
-    model_output['Qm'] = np.zeros(forcing_data['tmean'].shape)  # Melt heat [W/m2]
-    model_output['Q'] = np.zeros(forcing_data['tmean'].shape)  # Cold Content [J/m2]
-    model_output['T_soil'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['ice_fraction_soil'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['ET'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['SMC'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['infil_runoff'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['sat_runoff'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['perc'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['caprise'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['infiltration'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['x_vadose'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['x_phreatic'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['q_vadose'] = np.zeros(forcing_data['tmean'].shape)
-    model_output['q_phreatic'] = np.zeros(forcing_data['tmean'].shape)
-
+    # (only the requested outputs are allocated; out_index gives the position of
+    # each variable of MODEL_OUTPUTS in out, or -1 if it is not requested).  With
+    # reducers, out only holds a block of nblock days of the outputs and of the
+    # variables of the reducers, which are copied to the daily outputs and
+    # reduced after each block
     NDays = len(TS_vec)
+    model_output = {}
+    nblock = max(1, min(NDays, 2 ** 16 // max(1, len(columns)))) if reducers else max(1, NDays)
+    out = np.zeros((len(stored),) + (nblock if reducers else NDays,) + sz, dtype=dtype)
+    out_index = np.zeros(len(MODEL_OUTPUTS), dtype=int) - 1
+    for i, var in enumerate(stored):
+        if var in outputs:
+            model_output[var] = np.zeros((NDays,) + sz, dtype=dtype) if reducers else out[i]
+        out_index[list(MODEL_OUTPUTS).index(var)] = i
+    calendar = forcing_data['calendar'] if reducers else None
+    period_days = {}
+    for name in reducers:
+        var, statistic, period, threshold = reducers[name]
+        nperiods = period_index(calendar, period, NDays - 1, NDays)[0] + 1 if NDays > 0 else 0
+        if period not in period_days:
+            period_days[period] = np.zeros((nperiods,) + sz)
+        model_output[name] = np.full((nperiods,) + sz, REDUCER_STATISTICS[statistic][1])
     
-    tmean_all = copy.deepcopy(forcing_data['tmean'])
-    wind_all = copy.deepcopy(forcing_data['wind'])
-    srad_all = copy.deepcopy(forcing_data['srad'])
-    lrad_all = copy.deepcopy(forcing_data['lrad'])
-    vapp_all = copy.deepcopy(forcing_data['vapp'])
-    rainfall_all = copy.deepcopy(forcing_data['rainfall'])
-    snowfall_all = copy.deepcopy(forcing_data['snowfall'])
-    PET_all = copy.deepcopy(forcing_data['PET'])
-
-    # st = time.time()
-    # c = 0
-    # print(tmean_all.shape)
-    
-    
-    ## Main Time Loop
-    for TS in range(NDays):
-
-        # c = c+1
-        # Extract forcing data for a particular day
-        airt = tmean_all[TS, :]        # Mean temperature [C]
-        wind = wind_all[TS, :]          # Wind speed [m/s]
-        srad = srad_all[TS, :]          # Solar radiation [W/m2]
-        lrad = lrad_all[TS, :]          # Incoming longwave radiation [W/m2]
-        vapp = vapp_all[TS, :]          # Vapor Pressure [pa]
-        rainfall = rainfall_all[TS, :]  # Rainfall [mm]
-        snowfall = snowfall_all[TS, :]  # Snowfall [mm]
-        PET = PET_all[TS, :]            # Potential Evaporation [mm]
-        # doy = forcing_data['doys'][TS]            # Potential Evaporation [mm]
-        
-        svapp = 0.6108 * np.exp(17.27 * airt / (237.3 + airt)) * 1000
-        rh = vapp/svapp*100
-        rh[rh > 100] = 100
-        
-        swe_p = state['swe']  # Previous SWE
-
-        # Albedo
-
-        # Increment age of snow surface
-        state['swe_age_a'][state['swe'] == 0] = 0
-        state['swe_age_a'] = state['swe_age_a'] + (modelconst['TS'] / modelconst['DAY'])
-
-        # Reset the age of the snowpack based on the size of the storm
-        state['swe_age_a'] = state['swe_age_a'] * np.maximum(0, (model_pars['albedo_snow_reset'] - snowfall) / model_pars['albedo_snow_reset'])
-
-        # Compute albedo based on the snowpack age
-        depth = state['swe'] / state['density']
-        
-        albedosnow = np.maximum(model_pars['minalbedo'], model_pars['albedo_i'] - (state['swe_age_a'] * model_pars['albedo_decay']))
-        snowfrac = np.minimum(1, depth / model_pars['groundveght'] * 100)
-        albedo = snowfrac * albedosnow + (1 - snowfrac) * model_pars['albedo_0']
-
-        ## Net Radiation
-
-        # Net shortwave radiation
-        Qsn = srad * (1 - albedo)
-
-        # Incoming longwave radiation (given as forcing variable)
-        Qli = lrad
-
-        Ts_nosnow = airt + 0.0192 * (Qsn + Qli) - 0.0428 * rh - 4.1790
-        Ts_snow = np.minimum(0, airt + 0.0258 * (Qsn + Qli) + 0.0648 * rh - 14.5601)
-        Ts = Ts_snow * snowfrac + Ts_nosnow * (1 - snowfrac)
-
-        # Computed based on snow temperature
-        Qle = modelconst['emiss_snow'] * modelconst['sigma'] * (Ts + modelconst['K']) ** 4
-
-        # Net Radiation
-        Qn = Qsn + Qli - Qle
-
-        # Architectural resistance
-
-        # Resistance for equilibrium conditions
-        k0 = modelconst['karman'] ** 2 * wind / (np.log(model_pars['windlevel'] / model_pars['sroughness'])) ** 2
-
-        # Richardson number (for stability correction)
-        Ri = modelconst['g'] * (airt - Ts) * model_pars['windlevel'] / (wind **2 * airt)
-        ka = k0 * 1
-        ka[Ri > 0] = ka[Ri > 0] / (1 + 10 * Ri[Ri > 0])
-        ka[Ri < 0] = ka[Ri < 0] * (1 - 10 * Ri[Ri < 0])
-        ka = k0 + model_pars['fstab'] * (ka - k0)
-        ka[np.isnan(ka)] = 0
-        # model_pars['fstab']: Stability parameter (0-1, where 0 means no richardson number adjustment and 1 means full richardson number adjustment
-
-        # ka = k0  # For now, do not apply stability corrections
-
-        ## Sensible heat flux
-
-        # Estimate how air density changes with altitude by assuming a station
-        # pressure based on elevation
-        pres = modelconst['P0'] * np.exp(-modelconst['g'] * model_pars['elevation'] / (modelconst['Rd'] * (airt + modelconst['K'] + modelconst['L'] * model_pars['elevation'])))
-        rhoa = pres / (modelconst['Rd'] * (airt + modelconst['K']))
-
-        Qh = ka * rhoa * modelconst['specheat_a'] * (airt - Ts) * model_pars['Ch']
-        ## Latent heat flux and Sublimation
-
-        # Saturated vapor pressure
-        svapp = 0.6108 * np.exp(17.27 * Ts_nosnow / (237.3 + Ts_nosnow)) * 1000
-
-        # Sublimation heat
-        Qe = k0 * (modelconst['subheat'] * 0.622) / (modelconst['Rd'] * (airt + modelconst['K'])) * (vapp - svapp)
-        Qe[Qe > 0] = 0  # Limit to mass losses
-
-        # Convert to actual sublimation amount, later we will need to adjust if SWE is not enough
-        sublimation_potential = -(Qe / (modelconst['subheat'] * modelconst['rhow'])) * modelconst['TS'] * modelconst['M2MM']
-
-        # Canopy Snow Interception
-
-        # Canopy Storage capacity
-        cansnowstorcap = 4.4 * model_pars['lai']  # model_pars['lai']: Leaf area index (mm/mm)
-
-        # Snow that is caught in canopy
-
-        L = 0.7 * (cansnowstorcap - state['cansnowstor']) * (1 - np.exp(-snowfall / (cansnowstorcap + 1E-6)))
-        L[np.isnan(L)] = 0  # Throughfall is snow that falls through canopy
-        tsfall = snowfall - L
-        state['cansnowstor'] = state['cansnowstor'] + L
-
-        # Snow Drip Rate
-        melt_drip = np.maximum(0, model_pars['melt_drip_par'] * airt)
-        # model_pars['melt_drip_par']: Melt Drip Rate (mm/day / deg-C above freezing
-
-        # Snow Unloading from the canopy
-        snow_unload = np.maximum(model_pars['snow_unload_par'] * state['cansnowstor'] * modelconst['TS'] / modelconst['DAY'], 0)  # Snow Unload Rate
-        # model_pars['snow_unload_par']:
-
-        # Canopy sublimation
-        acsub = np.maximum(0, sublimation_potential) * model_pars['canopy_sub_mult']
-        # model_pars['canopy_sub_mult']: Canopy sublimation multiplier applied to potential sublimation rate [-]
-
-        r = 5E-4
-        a = 0.9
-        C_e = 0.01 * (state['cansnowstor'] / (cansnowstorcap + 1E-6)) ** 0.4    # Calculate Canopy Sublimation
-        C_e[np.isnan(C_e)] = 0
-        m = modelconst['rhoi'] * 4/3 * np.pi * r ** 3                       # Mass of Ice Sphere (kg)
-        rho_v = 0.622 * vapp / (287 * (airt + modelconst['K']))        # Water Vapor Density (kg/m3)
-        S_p = np.pi * r ** 2 * (1-a) * srad                                 # Radiation absorbed by partical (W/m2)
-        D = 2.06E-5 * ((airt + modelconst['K'])/modelconst['K']) ** 1.75 # Diffusivity of air (m2/s)
-        nu = 1.3E-5                                                   # Kinematic viscosity of air (m2/s)
-        a_flow = 0.9 * model_pars['lai']                               # Canopy flow index
-        u_c = wind * np.exp(-a_flow * (1-0.6))                           # ventilation velocity
-        Re = 2 * r * u_c/nu                                           # Reynolds number
-        Sh = 1.79 + 0.606 * Re ** 0.5                                 # Sherwood number
-        Nu = Sh                                                       # Nusset number
-        M = 18.01E-3                                                  # Molecular weight of water(kg/mol)
-        k_t = 0.024                                                   # Thermal conductivity of air (W/m2-K)
-        R_const = 8314                                                # Universal gas constant (J/mol-K)
-    
-        omega = (1 / (k_t * (airt + modelconst['K']) * Nu)) * ((modelconst['subheat'] * M) / (R_const * (airt + modelconst['K'])) -1)        # Ventilation factor
-        dmdt = (2*np.pi*r*((vapp/svapp)-1) - S_p * omega) / (modelconst['subheat'] * omega + 1 / (D * rho_v * Sh))
-        psi_s = dmdt/m
-        # Sublimation rate loss coefficient
-        acsub = np.real(np.maximum(0,-C_e * state['cansnowstor'] * psi_s * modelconst['TS'])*model_pars['canopy_sub_mult'])
-        acsub[np.isnan(acsub)] = 0
-
-        # Figure out total ablation demand, and scale based on how much snow is
-        # available (to avoid over-emptying of canopy snow storage)
-        
-        p_canopy_abl = acsub + melt_drip + snow_unload
-        
-                                              
-        multiplier = state['cansnowstor'] / (np.maximum(1E-6,p_canopy_abl))
-        multiplier[multiplier > 1] = 1                                                                              
-        melt_drip = melt_drip * multiplier
-        snow_unload = snow_unload * multiplier
-        acsub = acsub * multiplier
-
-        # Revised canopy snow storage
-        state['cansnowstor'] = np.maximum(0, state['cansnowstor'] - acsub - melt_drip - snow_unload)  # Subtract evaporated snow from the canopy
-
-        # If canopy snow storage is exceeded (e.g. due to deposition), then unload
-        snow_unload = snow_unload + np.maximum(0, state['cansnowstor'] - cansnowstorcap)
-
-        # Add all solid and liquid precipitation to SWE
-        rain_on_snow = copy.deepcopy(rainfall)
-        rain_on_snow[np.logical_and(state['swe'] == 0, snowfall == 0)] = 0
-        
-        state['swe'] = state['swe'] + tsfall + rain_on_snow + melt_drip + snow_unload
+    # Put the parameters, states and constants into arrays (one row for each
+    # variable of KERNEL_PARS, KERNEL_STATES and KERNEL_CONSTS), and run the time loop
+    pars = dict(model_pars, sm_sat=sm_sat, sm_res=sm_res)
+    pars = np.array([np.broadcast_to(pars[par], sz) for par in KERNEL_PARS], dtype=float)
+    state['Tm'] = Tm
+    state = np.array([np.broadcast_to(state[var], sz) for var in KERNEL_STATES], dtype=dtype)
+    const = np.array([modelconst[var] for var in KERNEL_CONSTS], dtype=float)
+    forcing = [np.ascontiguousarray(forcing_data[var], dtype=dtype) for var in ['tmean', 'wind', 'srad', 'lrad', 'vapp', 'rainfall', 'snowfall', 'PET']]
+
+    # Start from a checkpoint (if specified), and run the time loop in segments
+    start = 0
+    if restart_file is not None:
+        start = load_checkpoint(restart_file, state) - first_day
+        if start < 0 or start > NDays:
+            raise ValueError('Checkpoint ' + restart_file + ' is not within the days of this run')
+    saves = set(int(day) + 1 for day in (checkpoint_days if checkpoint_days is not None else []) if start <= int(day) < NDays)
+    # that end on the checkpoint days (with reducers, in blocks of days that
+    # start on day b0 of the forcing data and of day 0 of out)
+    d0 = start
+    for d1 in sorted(saves | {NDays}):
+        for b0 in range(d0, d1, nblock):
+            b1 = min(d1, b0 + nblock)
+            offset = b0 if reducers else 0
+            block = [var[offset:] for var in forcing]
+            if UseNumba and numba is not None:
+                run_model_kernel(b0 - offset, b1 - offset, *block, columns, pars, state, const, out_index, out)
+            else:
+                run_model_numpy(b0 - offset, b1 - offset, *block, columns, pars, state, const, out_index, out)
+            if reducers:
+                valid = forcing_data['valid'][b0:b1][:, columns]
+                for i, var in enumerate(stored):
+                    if var in outputs:
+                        model_output[var][b0:b1] = out[i, :b1-b0]
+                index = {period: period_index(calendar, period, b0, b1) for period in period_days}
+                for period in period_days:
+                    reduce_block(valid, valid, index[period], 'sum', 0., period_days[period])
+                for name in reducers:
+                    var, statistic, period, threshold = reducers[name]
+                    reduce_block(out[stored.index(var), :b1-b0], valid, index[period], statistic, threshold, model_output[name])
+        if d1 in saves:
+            save_checkpoint(checkpoint_file % (first_day + d1 - 1), first_day + d1, state)
+        d0 = d1
+
+    # Days without forcing data (padding at the end of shorter records), and
+    # days before the restart day, have no outputs
+    for var in outputs:
+        model_output[var][~forcing_data['valid'][:, columns]] = np.nan
+        model_output[var][:start] = np.nan
+
+    # Reducers: mean over the days of each period, and no value for periods
+    # without days
+    for name in reducers:
+        var, statistic, period, threshold = reducers[name]
+        days = period_days[period]
+        if REDUCER_STATISTICS[statistic][3]:
+            np.divide(model_output[name], days, out=model_output[name], where=days > 0)
+        model_output[name][days == 0] = np.nan
 
-        # Heat from precip
-
-        Qp_r = ((rainfall + melt_drip) / (modelconst['M2MM'] * modelconst['TS'])) * (modelconst['fusheat'] * modelconst['rhow'] + modelconst['specheat_w'] * modelconst['rhow'] * np.maximum(0, airt))
-        Qp_s = ((tsfall + snow_unload) / (modelconst['M2MM'] * modelconst['TS'])) * (modelconst['specheat_i'] * modelconst['rhow'] * np.minimum(0, airt))
-        Qp = Qp_s + Qp_r
-        
-        # Ground Heat
-        Qg = model_pars['kappa_snow'] * (model_pars['tempdampdepth'] - Tm) / (model_pars['H'] / modelconst['M2MM'] + (swe_p / state['density']) / (2 * modelconst['M2MM']))
-
-        # Adjust if not enough SWE
-        sublimation_potential = sublimation_potential * model_pars['ground_sub_mult']
-        sublimation = np.minimum(state['swe'], sublimation_potential)
-        state['swe'] = state['swe'] - sublimation
-        
-        # Recompute sublimation heat and melt heat
-        Qe = -sublimation * (modelconst['subheat'] * modelconst['rhow']) / (modelconst['TS'] * modelconst['M2MM'])
-        
-        # Melt
-
-        # Potential melt based on known energy inputs
-        pdq = -np.maximum(0, state['cc'] + (Qn + Qe + Qh + Qp + Qg) * modelconst['TS'])
-        melt_potential = -pdq / (modelconst['rhow'] * modelconst['fusheat']) * modelconst['M2MM']
-
-        # Adjust if not enough SWE
-                                                      
-        melt = np.minimum(state['swe'], melt_potential)    
-        min_melt = 0.2*(np.maximum(-5,airt)+5) ** 2 + rainfall # Lower bound approx 2x 75th%ile melt in Broxton et al., 2016, fig.11
-        melt = np.minimum(min_melt,melt)                                                                                        
-        state['swe'] = state['swe'] - melt
-
-        # Recompute sublimation heat and melt heat
-                                                                                                                  
-        Qm = (-melt / modelconst['M2MM']) * (modelconst['rhow'] * modelconst['fusheat']) / modelconst['TS']
-
-        # Frozen soil model
-        ice_soil_0 = state['ice_fraction_soil'] * model_pars['H']
-        T_soil = state['Q_soil'] / ((state['sm_stor'] / 1000 * modelconst['specheat_w'] * modelconst['rhow']) + ((model_pars['H'] - state['sm_stor']) / 1000 * modelconst['specheat_s'] * modelconst['rhos']))
-        g_abv = model_pars['kappa_soil'] / (model_pars['H'] / 2 / 1000) * (Ts - T_soil) * modelconst['TS']
-        g_blw = model_pars['kappa_soil'] / (model_pars['dampdepth'] - (model_pars['H'] / 2 / 1000)) * (model_pars['tempdampdepth'] - T_soil) * modelconst['TS']
-        g_abv_snow = -Qg * modelconst['TS']
-        g_abv[state['swe'] > 0] = 0
-        g_abv_snow[state['swe'] <= 0] = 0
-        g_abv = g_abv + g_abv_snow
-        p_dQ = (g_abv + g_blw)
-        gtlocs = state['Q_soil'] > 0
-        ltlocs = state['Q_soil'] < 0
-        Q_soil_gtlocs = np.maximum(0, state['Q_soil'] + p_dQ)
-        Q_soil_ltlocs = np.minimum(0, state['Q_soil'] + p_dQ)
-        Q_soil_gtlocs[gtlocs == 0] = 0
-        Q_soil_ltlocs[ltlocs == 0] = 0
-        Q_soil = Q_soil_gtlocs + Q_soil_ltlocs
-        residual = state['Q_soil'] + p_dQ - Q_soil
-        soil_melt = (residual / (modelconst['rhow'] * modelconst['fusheat'])) * 1000
-
-        p_ice_soil = state['sm_stor']
-        ice_soil_0 = ice_soil_0 - soil_melt
-        ice_soil = np.maximum(0, np.minimum(p_ice_soil, ice_soil_0))
-        residual = ice_soil - ice_soil_0
-        Q_soil = Q_soil + residual * (modelconst['rhow'] * modelconst['fusheat']) / 1000
-
-        state['Q_soil'] = Q_soil
-        state['ice_fraction_soil'] = ice_soil / (model_pars['H'])
-        T_soil = state['Q_soil'] / (((state['sm_stor'] - ice_soil) / 1000 * modelconst['specheat_w'] * modelconst['rhow']) + ((ice_soil) / 1000 * modelconst['specheat_i'] * modelconst['rhoi']) + ((model_pars['H'] - state['sm_stor']) / 1000 * modelconst['specheat_s'] * modelconst['rhos']))
-
-        # Snow Density
-
-        # Reduce density based on new snow depth relative to old snow depth
-        depth_p = swe_p / state['density']
-        new_depth = np.maximum(1E-6, snowfall / model_pars['density_min'])
-        # model_pars['density_min']: Density of fresh snowfall [g/cm3]
-
-        new_frac = new_depth / (depth_p + new_depth)
-        density_p = state['density']
-        state['density'] = (1 - new_frac) * density_p + new_frac * model_pars['density_min']
-
-        # Densify snowpack based on age, overburdin, and warm snowpacks
-        state['density'] = state['density'] + ((model_pars['density_max'] - density_p) * model_pars['apar'] * modelconst['TS'] / modelconst['DAY'])
-        state['density'] = state['density'] + ((model_pars['density_max'] - density_p) * model_pars['dpar'] * state['swe'] / 10 * modelconst['TS'] / modelconst['DAY'])
-                       
-                                               
-        state['density'] = state['density'] + ((model_pars['density_max'] - density_p) * model_pars['rpar'] * (state['cc'] == 0) * modelconst['TS'] / modelconst['DAY'])
-        # model_pars['rpar']: Snow densfication rate due to liquid in snowpack [Fraction when isothermal snowpack]
-        if len(model_pars['density_min']) > 1:
-            state['density'][state['density'] > model_pars['density_max']] = model_pars['density_max'][state['density'] > model_pars['density_max']]
-        else:
-            state['density'][state['density'] > model_pars['density_max']] = model_pars['density_max']
+    return model_output
 
-        if len(model_pars['density_min']) > 1:
-            state['density'][state['density'] < model_pars['density_min']] = model_pars['density_min'][state['density'] < model_pars['density_min']]
+def period_index(calendar, period, d0, d1):
+    # Function to get the calendar period of days d0 to d1-1 for the reducers of
+    # run_model (the days of the calendar are consecutive, so the periods are
+    # numbered from the first day without gaps)
+    #
+    # Inputs
+    #   calendar: calendar of the forcing data (forcing_data['calendar'])
+    #   period: 'year', 'month' or 'all' (one period for the whole record)
+    #   d0, d1: first day and end of the days (indices of TS_vec)
+    #
+    # Outputs
+    #   index: period of each day (0, 1, ...; the rows of the reducer outputs)
+    year = calendar['year']
+    if period == 'year':
+        return year[d0:d1] - year[0]
+    elif period == 'month':
+        month = calendar['month']
+        return (year[d0:d1] - year[0]) * 12 + month[d0:d1] - month[0]
+    elif period == 'all':
+        return np.zeros(d1 - d0, dtype=int)
+    raise ValueError('Unknown reducer period: ' + str(period))
+
+def reducer_periods(calendar, period):
+    # Function to get the first day of each calendar period of the reducers of
+    # run_model (the rows of the reducer outputs)
+    #
+    # Inputs
+    #   calendar: calendar of the forcing data (forcing_data['calendar'])
+    #   period: 'year', 'month' or 'all'
+    #
+    # Outputs
+    #   first_day: first day (index of TS_vec) of each period
+    index = period_index(calendar, period, 0, len(calendar['year']))
+    return np.flatnonzero(np.diff(index, prepend=-1))
+
+def reduce_block(values, valid, index, statistic, threshold, result):
+    # Function to update the statistic of a reducer of run_model with a block of
+    # days (the days of a period are consecutive, so each period is reduced at
+    # once with reduceat)
+    #
+    # Inputs
+    #   values: daily values [day x cell] of the output of the reducer
+    #   valid: flag whether each day has forcing data [day x cell]
+    #   index: period of each day (see period_index)
+    #   statistic, threshold: statistic of the reducer (see REDUCER_STATISTICS)
+    #   result: statistic of each period [period x cell] (updated in place)
+    ufunc, identity, fun, per_day = REDUCER_STATISTICS[statistic]
+    if fun is not None:
+        values = fun(values, threshold)
+    values = np.where(valid, values, identity)
+    starts = np.flatnonzero(np.diff(index, prepend=-1))
+    periods = index[starts]
+    result[periods] = ufunc(result[periods], ufunc.reduceat(values, starts, axis=0))
+
+def forcing_terms(airt, wind, srad, vapp, lai, elevation, windlevel, sroughness, melt_drip_par, const):
+
+    # Function to compute the terms of the model equations that only depend on
+    # the forcing data and the parameters (not on the model states), for a block
+    # of days at once (used by run_model_numpy, with the same equations as in
+    # run_model_kernel)
+    #
+    # Inputs
+    #   airt, wind, srad, vapp: forcing data [day x cell]
+    #   lai, elevation, windlevel, sroughness, melt_drip_par: parameters [cell]
+    #   const: model constants [KERNEL_CONSTS]
+    #
+    # Outputs
+    #   terms: dictionary with the relative humidity (rh), resistance for
+    #   equilibrium conditions (k0), air density (rhoa), melt drip rate before it
+    #   is limited by the canopy snow storage (melt_drip_potential), and the water
+    #   vapor density (rho_v), absorbed radiation (S_p), diffusivity (D),
+    #   Sherwood number (Sh) and ventilation factor (omega) of canopy snow
+    #   particles [day x cell]
+
+    karman, subheat, fusheat, specheat_a, specheat_w, specheat_i, Rd, g, emiss_snow, sigma = const.tolist()[0:10]
+    M2MM, TSL, DAY, K, rhoi, rhow, P0, L_rate, rhos, specheat_s = const.tolist()[10:20]
+    terms = {}
+
+    # Relative humidity
+    svapp = 0.6108 * np.exp(17.27 * airt / (237.3 + airt)) * 1000
+    terms['rh'] = np.minimum(vapp/svapp*100, 100)
+
+    # Resistance for equilibrium conditions
+    terms['k0'] = karman ** 2 * wind / (np.log(windlevel / sroughness)) ** 2
+
+    # Air density (from the station pressure)
+    pres = P0 * np.exp(-g * elevation / (Rd * (airt + K + L_rate * elevation)))
+    terms['rhoa'] = pres / (Rd * (airt + K))
+
+    # Snow Drip Rate
+    terms['melt_drip_potential'] = np.maximum(0, melt_drip_par * airt)
+
+    # Canopy snow particles
+    r = 5E-4
+    a = 0.9
+    terms['rho_v'] = 0.622 * vapp / (287 * (airt + K))
+    terms['S_p'] = np.pi * r ** 2 * (1-a) * srad
+    terms['D'] = 2.06E-5 * ((airt + K)/K) ** 1.75
+    nu = 1.3E-5
+    a_flow = 0.9 * lai
+    u_c = wind * np.exp(-a_flow * (1-0.6))
+    Re = 2 * r * u_c/nu
+    Sh = 1.79 + 0.606 * Re ** 0.5
+    terms['Sh'] = Sh
+    M = 18.01E-3
+    k_t = 0.024
+    R_const = 8314
+    terms['omega'] = (1 / (k_t * (airt + K) * Sh)) * ((subheat * M) / (R_const * (airt + K)) -1)
+
+    return terms
+
+def save_checkpoint(fname, day, state):
+    # Function to save the model states to a checkpoint file (in numpy's .npz
+    # format), from which a run can be continued (see run_model)
+    #
+    # Inputs
+    #   fname: name of the checkpoint file
+    #   day: day (index of TS_vec) on which the run continues
+    #   state: model states [KERNEL_STATES x cell]
+    print('Saving ' + fname)
+    with open(fname, 'wb') as f:
+        np.savez(f, day=day, names=KERNEL_STATES, state=state)
+
+def load_checkpoint(fname, state):
+    # Function to read the model states from a checkpoint file (see
+    # save_checkpoint)
+    #
+    # Inputs
+    #   fname: name of the checkpoint file
+    #   state: model states [KERNEL_STATES x cell] (replaced in place)
+    # Outputs
+    #   day: day (index of TS_vec) on which the run continues
+    print('Loading ' + fname)
+    with np.load(fname) as checkpoint:
+        if list(checkpoint['names']) != KERNEL_STATES or checkpoint['state'].shape != state.shape:
+            raise ValueError('Checkpoint ' + fname + ' does not match the model states of this run')
+        state[:] = checkpoint['state']
+        return int(checkpoint['day'])
+
+
+def run_ensemble(TS_vec, forcing_data, model_pars, ensemble_pars, outputs=None, reducers=None):
+    # Function to run RHEM-Snow for an ensemble of parameter sets (e.g. for
+    # calibration or uncertainty analysis) that share the same forcing data, so
+    # that the forcing data are read and prepared only once.  Each member runs as
+    # an extra set of columns of run_model, which reads the forcing data of the
+    # locations through a column index (the forcing data are not copied)
+    #
+    # Inputs
+    #   TS_vec, forcing_data: dates and forcing data for nlocs locations (from
+    #   get_forcing_cligen)
+    #   model_pars: model parameters of the nlocs locations
+    #   ensemble_pars: parameters that change between members; each is an array
+    #   [member x location], or [member] (same value at all locations)
+    #   outputs, reducers: names of the outputs to compute, and statistics of the
+    #   outputs over calendar periods (see run_model)
+    #
+    # Outputs
+    #   model_output: daily outputs [day x member x location] of each requested
+    #   variable, and the statistics [period x member x location] of each reducer
+
+    nlocs = forcing_data['tmean'].shape[1]
+    n_members = len(np.atleast_1d(next(iter(ensemble_pars.values()))))
+    member_pars = {}
+    for par in ensemble_pars:
+        if par in FORCING_PARS:
+            raise ValueError('Parameter ' + par + ' is used by get_forcing_cligen, so it can not change between ensemble members')
+        if par not in model_pars:
+            raise ValueError('Unknown model parameter: ' + str(par))
+        value = np.asarray(ensemble_pars[par], dtype=float)
+        if value.ndim == 1:
+            value = value[:, None]
+        member_pars[par] = np.broadcast_to(value, (n_members, nlocs)).ravel()
+
+    # Parameters of all members (member after member, each with nlocs columns)
+    pars = {}
+    for par in model_pars:
+        if par in member_pars:
+            pars[par] = member_pars[par]
+        elif np.ndim(model_pars[par]) == 1:
+            pars[par] = np.tile(model_pars[par], n_members)
         else:
-            state['density'][state['density'] < model_pars['density_min']] = model_pars['density_min']
+            pars[par] = model_pars[par]
 
-        depth = state['swe'] / state['density']
-        density = state['density'] * 1
-        density[state['swe'] == 0] = np.nan
+    print('Running an ensemble of %d members' % n_members)
+    model_output = run_model(TS_vec, forcing_data, pars, outputs, columns=np.tile(np.arange(nlocs), n_members), reducers=reducers)
+    for var in model_output:
+        model_output[var] = model_output[var].reshape(-1, n_members, nlocs)
 
-        # Compute the energy balance
-        
-        Qn_snow = Qn * 1
-        Qn_snow[state['swe'] == 0] = 0
-
-        Tm_min = np.minimum(0,Ts)
-        cc_min = Tm_min * (state['swe'] / modelconst['M2MM']) * modelconst['rhow'] * modelconst['specheat_i']
-        cc_i = cc_p + (Qn_snow + Qh + Qe + Qp + Qm + Qg) * modelconst['TS']
-        state['cc'] = np.minimum(0,np.maximum(cc_min,cc_i))
-        Tm = state['cc'] / ((state['swe'] / modelconst['M2MM']) * modelconst['rhow'] * modelconst['specheat_i'])
-        Tm[state['swe'] == 0] = 0
-
-        # Clean up, prepare for next iteration, and fill output structure
-        
-        # Make sure that when SWE is zero, heats are not reported
-        state['cc'][state['swe'] == 0] = 0
-        state['cc'][state['cc'] > 0] = 0
-        Qe[state['swe'] == 0] = 0
-        Qp[state['swe'] == 0] = 0
-        Qm[state['swe'] == 0] = 0
-        Qg[state['swe'] == 0] = 0
-        Qh[state['swe'] == 0] = 0
-        density[state['swe'] == 0] = 0
-
-        # Compute energy imbalance caused by above acounting and add to sensible heat term
-        imbal = ((state['cc'] - cc_p) - (Qn_snow + Qh + Qe + Qp + Qm + Qg) * modelconst['TS']) / modelconst['TS']
-        Qh = Qh + imbal
-        cc_p = state['cc']
-
-        # Compute Infiltration excess runoff
-        net_input = rainfall - rain_on_snow + melt
-        infil_runoff = net_input * model_pars['max_infil_mult'] * (np.maximum(0, (state['sm_stor'] / model_pars['H']) - model_pars['sm_min_infil']) / (model_pars['sm_max_infil'] - model_pars['sm_min_infil']))
-        net_input = net_input - infil_runoff
-        state['sm_stor'] = state['sm_stor'] + net_input
-
-        # Compute actual ET
-        et = PET * np.minimum(1,((np.maximum(0,state['sm_stor'] / model_pars['H'])) - model_pars['wp']) / (model_pars['cmc'] - model_pars['wp']))
-
-        # Saturation excess runoff, if any
-        state['sm_stor'] = np.maximum(0, state['sm_stor'] - et)
-        sat_runoff = np.maximum(0, state['sm_stor'] - sm_sat)
-        state['sm_stor'] = state['sm_stor'] - sat_runoff
-        
-        # Compute percolation out of the top soil layer
-        
-        perc = np.minimum(state['sm_stor'] / 3, model_pars['k_soil'] * (np.maximum(0, (state['sm_stor']-sm_res) / (sm_sat-sm_res))) ** (2 * model_pars['b_soil'] + 3)) * modelconst['TS'] / modelconst['DAY']
-        
-        bw = 1-(state['sm_stor']-sm_res) / (sm_sat-sm_res)
-        bw[bw < 0] = 0
-        bw[bw > 1] = 1
-        beta = 2 + 3/model_pars['b_soil']
-        alpha = 1 + (3/2) / (beta -1);
-        caprise = bw * model_pars['k_soil'] * alpha * (model_pars['psi_s'] / (model_pars['H']) ** beta ) * modelconst['TS'] / modelconst['DAY']
-        locs = caprise > state['x_vadose']
-        caprise[locs] = state['x_vadose'][locs]
-        
-        state['sm_stor'] = state['sm_stor'] - perc + caprise
-        state['x_vadose'] = state['x_vadose'] + perc - caprise
-        q_vadose = model_pars['coef_vadose'] * (state['x_vadose'] ** model_pars['coef_vadose_exp']) * modelconst['TS'] / modelconst['DAY']
-        state['x_vadose'] = state['x_vadose'] - q_vadose
-        vadose_2_phreatic = model_pars['coef_vadose2phreatic'] * state['x_vadose'] * modelconst['TS'] / modelconst['DAY']
-        state['x_vadose'] = state['x_vadose'] - vadose_2_phreatic
-
-        state['x_phreatic'] = state['x_phreatic'] + vadose_2_phreatic
-        q_phreatic = model_pars['coef_phreatic'] * (state['x_phreatic'] ** model_pars['coef_phreatic_exp']) * modelconst['TS'] / modelconst['DAY']
-        state['x_phreatic'] = state['x_phreatic'] - q_phreatic
-
-        model_output['x_vadose'][TS, :] = state['x_vadose']
-        model_output['x_phreatic'][TS, :] = state['x_phreatic']
-        model_output['q_vadose'][TS, :] = q_vadose
-        model_output['q_phreatic'][TS, :] = q_phreatic
-
-        infiltration = net_input - infil_runoff - sat_runoff
-
-        model_output['ET'][TS, :] = et
-        model_output['SMC'][TS, :] = state['sm_stor'] / model_pars['H'] * 100
-        model_output['infil_runoff'][TS, :] = infil_runoff
-        model_output['sat_runoff'][TS, :] = sat_runoff
-        model_output['perc'][TS, :] = perc
-        model_output['infiltration'][TS, :] = infiltration
-        model_output['caprise'] [TS,:] = caprise
-
-        model_output['swe'][TS, :] = state['swe']  # Snow Water Equivalent [mm]
-        model_output['depth'][TS, :] = depth  # Snow Depth [mm]
-        model_output['density'][TS, :] = density  # Snow Density [g/cm3]
-        model_output['rain_on_snow'][TS, :] = rain_on_snow  # Rain on Snow [mm/day]
-        model_output['snowpack_sublimation'][TS, :] = sublimation  # Sublimation (from snowpack) [mm/day]
-        model_output['tsfall'][TS, :] = tsfall  # Snow throughfall (below canopy) [mm/day]
-        model_output['snow_unload'][TS, :] = snow_unload  # Snow unloading (from canopy) [mm/day]
-        model_output['melt_drip'][TS, :] = melt_drip  # Melt Drip (from canopy) [mm/day]
-        model_output['canopy_sublimation'][TS, :] = acsub  # Sublimation (from canopy) [mm/day]
-        model_output['canopy_snow_storage'][TS, :] = state['cansnowstor']  # Canopy Snow Storage [mm]
-        model_output['melt'][TS, :] = melt  # Snowmelt [mm/day]
-        model_output['albedo'][TS, :] = albedo  # Surface albedo [-]
-        model_output['Tm'][TS, :] = Tm  # Integrated snowpack temperature [C]
-        model_output['Ts'][TS, :] = Ts  # Surface temperature [C]
-        model_output['Qsn'][TS, :] = Qsn  # Net shortwave radiation [W/m2]
-        model_output['Qle'][TS,] = Qle  # Outgoing Longwave Radiation [W/m2]
-        model_output['Qn'][TS, :] = Qn  # Net Radiation [W/m2]
-        model_output['Qn_snow'][TS, :] = Qn_snow  # Net Radiation over snowpack [W/m2]
-        model_output['Qh'][TS, :] = Qh  # Sensible and ground heat [W/m2]
-        model_output['Qg'][TS, :] = Qg  # Ground heat [W/m2]
-        model_output['Qe'][TS, :] = Qe  # Latent heat [W/m2]
-        model_output['Qp'][TS, :] = Qp  # Heat from precip [W/m2]
-        model_output['Qm'][TS, :] = Qm  # Melt heat [W/m2]
-        model_output['Q'][TS, :] = state['cc']  # Cold Content [J/m2]
-        model_output['T_soil'][TS, :] = T_soil
-        model_output['ice_fraction_soil'][TS, :] = state['ice_fraction_soil'] * 100
-        
-        # print(time.time()-st)
-        # sys.exit()
-
-    # print((time.time()-st)/c)
-    
     return model_output
 
-
-def f(u, *a):
-    return 1 - np.exp(-u) - a * u
+step_allocations = np.zeros(0)     # Memory allocated in each time step of the last run of run_model_numpy [bytes] (if CountAllocations)
+
+# Inputs of snow_physics (rows of the inputs buffer of run_model_numpy): the
+# forcing data and the terms of forcing_terms of the day (copied from the block
+# of days at once), the surface temperatures and net radiation, the states at the
+# start of the day, and parameters
+SNOW_PHYSICS_INPUTS = ['airt', 'wind', 'srad', 'lrad', 'vapp', 'rainfall', 'snowfall', 'PET',
+                       'rh', 'k0', 'rhoa', 'melt_drip_potential', 'rho_v', 'S_p', 'D', 'Sh', 'omega',
+                       'Ts', 'Ts_nosnow', 'Qn', 'swe_p', 'cansnowstor_p', 'Tm_p', 'cc_p', 'density_p',
+                       'windlevel', 'fstab', 'Ch', 'cansnowstorcap', 'snow_unload_par', 'canopy_sub_mult', 'kappa_snow',
+                       'tempdampdepth', 'H_M2MM', 'ground_sub_mult']
+
+# Outputs of snow_physics: the snow states at the end of the time step, and the snow fluxes
+SNOW_PHYSICS_OUTPUTS = ['swe', 'cansnowstor', 'Tm', 'cc', 'rain_on_snow', 'sublimation', 'tsfall', 'snow_unload', 'melt_drip', 'acsub', 'melt',
+                        'Qn_snow', 'Qh', 'Qg', 'Qe', 'Qp', 'Qm']
+
+# Other outputs of the time steps of run_model_numpy (rows of its values buffer
+# after those of SNOW_PHYSICS_OUTPUTS), and the variables of all the rows in the
+# order of MODEL_OUTPUTS
+STEP_OUTPUTS = ['depth', 'density_out', 'albedo', 'Qsn', 'Qle', 'T_soil', 'ice_pct', 'et', 'SMC', 'infil_runoff', 'sat_runoff',
+                'perc', 'caprise', 'infiltration', 'q_vadose', 'q_phreatic', 'Ts', 'Qn', 'x_vadose', 'x_phreatic']
+STEP_MODEL_OUTPUTS = ['swe', 'depth', 'density_out', 'rain_on_snow', 'sublimation', 'tsfall', 'snow_unload', 'melt_drip', 'acsub', 'cansnowstor', 'melt',
+                      'albedo', 'Tm', 'Ts', 'Qsn', 'Qle', 'Qn', 'Qn_snow', 'Qh', 'Qg', 'Qe', 'Qp', 'Qm', 'cc', 'T_soil', 'ice_pct', 'et', 'SMC',
+                      'infil_runoff', 'sat_runoff', 'perc', 'caprise', 'infiltration', 'x_vadose', 'x_phreatic', 'q_vadose', 'q_phreatic']
+
+# Numbers that appear in the equations of the time steps of run_model_numpy (see equation_constants)
+EQUATION_NUMBERS = [-5, 0, 1, 2, 3, 4, 5, 10, 100, 1000, 1E-6, 0.01, 0.0192, 0.0258, 0.0428, 0.0648, 0.2, 0.4, 0.6108, 0.7, 4.1790, 14.5601, 17.27, 237.3]
+
+def equation_constants(const, dtype):
+
+    # Function to give the numbers and constants of the equations of the time
+    # steps of run_model_numpy as 0-d arrays of the precision of the model.
+    # ufuncs convert python numbers into new arrays at each call, so the time
+    # steps use these arrays instead (with the same values, so the results do
+    # not change)
+    #
+    # Inputs
+    #   const: model constants [KERNEL_CONSTS]
+    #   dtype: precision of the model
+    #
+    # Outputs
+    #   c: dictionary of 0-d arrays, with the numbers of EQUATION_NUMBERS (by
+    #   value, e.g. c[1000]), and the constants and the products of constants
+    #   in the equations (by name, e.g. c['rhow'] or c['rhow * fusheat'])
+
+    karman, subheat, fusheat, specheat_a, specheat_w, specheat_i, Rd, g, emiss_snow, sigma = const.tolist()[0:10]
+    M2MM, TSL, DAY, K, rhoi, rhow, P0, L_rate, rhos, specheat_s = const.tolist()[10:20]
+    r = 5E-4
+    values = dict(zip(KERNEL_CONSTS, const.tolist()), TSL=TSL)
+    values['TSL / DAY'] = TSL / DAY
+    values['emiss_snow * sigma'] = emiss_snow * sigma
+    values['rhow * fusheat'] = rhow * fusheat
+    values['subheat * 0.622'] = subheat * 0.622
+    values['subheat * rhow'] = subheat * rhow
+    values['2 * np.pi * r'] = 2 * np.pi * r
+    values['m'] = rhoi * 4/3 * np.pi * r ** 3.
+    values['M2MM * TSL'] = M2MM * TSL
+    values['fusheat * rhow'] = fusheat * rhow
+    values['specheat_w * rhow'] = specheat_w * rhow
+    values['specheat_i * rhow'] = specheat_i * rhow
+    values['2 * M2MM'] = 2 * M2MM
+    values['TSL * M2MM'] = TSL * M2MM
+    values['CC_ROUNDING * eps'] = CC_ROUNDING * np.finfo(dtype).eps
+    c = {name: np.array(values[name], dtype=dtype) for name in values}
+    c.update({number: np.array(number, dtype=dtype) for number in EQUATION_NUMBERS})
+    return c
+
+def run_model_numpy(d0, d1, tmean_all, wind_all, srad_all, lrad_all, vapp_all, rainfall_all, snowfall_all, PET_all, columns, pars, state, const, out_index, out):
+
+    # numpy version of run_model_kernel (same inputs and outputs), which
+    # computes each day for all cells at once, with the same equations.  All
+    # intermediate results are written into buffers that are allocated before
+    # the time loop (with out=, and with the numbers of the equations as 0-d
+    # arrays, see equation_constants), so that the time steps do not allocate
+    # any memory (CountAllocations checks this).  The terms that only depend on
+    # the forcing data and the parameters are computed for blocks of days at
+    # once (see forcing_terms), and the snow physics only for the cells with
+    # snow (see snow_physics).  Each equation is written as a sequence of
+    # operations, under a comment with the equation (as in run_model_kernel)
+    #
+    # Inputs and outputs: see run_model_kernel
+
+    if state.shape[1] == 1:
+        # The ufuncs of numpy allocate memory when their operands have a single
+        # element, so a single cell is computed as two copies of it
+        state_2, out_2 = np.repeat(state, 2, axis=1), np.repeat(out, 2, axis=2)
+        run_model_numpy(d0, d1, tmean_all, wind_all, srad_all, lrad_all, vapp_all, rainfall_all, snowfall_all, PET_all, np.repeat(columns, 2),
+                        np.repeat(pars, 2, axis=1), state_2, const, out_index, out_2)
+        np.copyto(state, state_2[:, :1])
+        np.copyto(out, out_2[:, :, :1])
+        return
+
+    M2MM, TSL, DAY, K, rhoi, rhow, P0, L_rate, rhos, specheat_s = const.tolist()[10:20]
+    c = equation_constants(const, out.dtype)
+    TSL, DAY, K, rhoi, rhow, specheat_w, specheat_i, specheat_s, rhos = [c[name] for name in ['TSL', 'DAY', 'K', 'rhoi', 'rhow', 'specheat_w', 'specheat_i', 'specheat_s', 'rhos']]
+
+    pars = pars.astype(out.dtype)
+    lai, elevation, albedo_snow_reset, minalbedo, albedo_i, albedo_decay, groundveght, albedo_0 = pars[0:8]
+    windlevel, sroughness, fstab, Ch, melt_drip_par, snow_unload_par, canopy_sub_mult, kappa_snow = pars[8:16]
+    tempdampdepth, H, ground_sub_mult, kappa_soil, dampdepth, density_min, density_max, apar = pars[16:24]
+    dpar, rpar, max_infil_mult, sm_min_infil, sm_max_infil, wp, cmc, k_soil = pars[24:32]
+    b_soil, psi_s, coef_vadose, coef_vadose_exp, coef_vadose2phreatic, coef_phreatic, coef_phreatic_exp, sm_sat, sm_res = pars[32:41]
+
+    # Terms of the equations that only depend on the parameters
+    g_abv_par = kappa_soil / (H / 2 / 1000)
+    g_blw_par = kappa_soil / (dampdepth - (H / 2 / 1000))
+    infil_range = sm_max_infil - sm_min_infil
+    et_range = cmc - wp
+    sm_range = sm_sat - sm_res
+    perc_exp = 2 * b_soil + 3
+    beta = 2 + 3/b_soil
+    alpha = 1 + (3/2) / (beta -1)
+    caprise_par = psi_s / (H) ** beta
+
+    # The memory allocated in each time step is traced from here on (if
+    # CountAllocations), so that start (the memory allocated at the start of
+    # the time step) already holds an integer that is freed when it is set in
+    # the first time step, like in the other time steps
+    global step_allocations
+    allocated = np.zeros(d1 - d0)
+    if CountAllocations:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+
+    # The states are views of the rows of state (updated in place), and the
+    # other variables are views of the rows of buffers: inputs (the inputs of
+    # snow_physics, see SNOW_PHYSICS_INPUTS), values (the outputs of each day,
+    # see STEP_OUTPUTS) and work (intermediate results)
+    ncells = state.shape[1]
+    swe_state, cansnowstor_state, swe_age_a, Tm_state, cc_state, density, sm_stor, Q_soil, ice_fraction_soil, x_vadose, x_phreatic = state
+    inputs = np.zeros((len(SNOW_PHYSICS_INPUTS), ncells), dtype=out.dtype)
+    airt, wind, srad, lrad, vapp, rainfall, snowfall, PET, rh, k0, rhoa, melt_drip_potential, rho_v, S_p, D, Sh, omega, \
+        Ts, Ts_nosnow, Qn, swe_p, cansnowstor_p, Tm_p, cc_p, density_p = inputs[:25]
+    snow_pars = {'windlevel': windlevel, 'fstab': fstab, 'Ch': Ch, 'cansnowstorcap': 4.4 * lai, 'snow_unload_par': snow_unload_par,
+                 'canopy_sub_mult': canopy_sub_mult, 'kappa_snow': kappa_snow, 'tempdampdepth': tempdampdepth, 'H_M2MM': H / M2MM,
+                 'ground_sub_mult': ground_sub_mult}
+    for var in snow_pars:
+        np.copyto(inputs[SNOW_PHYSICS_INPUTS.index(var)], snow_pars[var])
+    values = np.zeros((len(SNOW_PHYSICS_OUTPUTS) + len(STEP_OUTPUTS), ncells), dtype=out.dtype)
+    snow_outputs = values[:len(SNOW_PHYSICS_OUTPUTS)]
+    swe, cansnowstor, Tm, cc, rain_on_snow, sublimation, tsfall, snow_unload, melt_drip, acsub, melt, Qn_snow, Qh, Qg, Qe, Qp, Qm = snow_outputs
+    depth, density_out, albedo, Qsn, Qle, T_soil, ice_pct, et, SMC, infil_runoff, sat_runoff, perc, caprise, infiltration, q_vadose, q_phreatic, \
+        Ts_value, Qn_value, x_vadose_value, x_phreatic_value = values[len(SNOW_PHYSICS_OUTPUTS):]
+    albedosnow, snowfrac, Ts_snow, ice_soil_0, g_abv, g_blw, g_abv_snow, p_dQ, Q_soil_gtlocs, Q_soil_ltlocs, Q_soil_new, residual, ice_soil, \
+        depth_p, new_depth, new_frac, density_gap, net_input, bw, vadose_2_phreatic, t1, t2 = np.zeros((22, ncells), dtype=out.dtype)
+    m1, m2 = np.zeros((2, ncells), dtype=bool)
+
+    # Forcing data and terms of forcing_terms (the first rows of inputs) of
+    # blocks of days, and the values of the days of a block, which are copied
+    # to out at the end of the block
+    nblock = max(1, min(d1 - d0, 2 ** 12, 2 ** 16 // ncells))
+    block = np.zeros((17, nblock, ncells), dtype=out.dtype)
+    block_values = np.zeros((nblock, len(values), ncells), dtype=out.dtype)
+    day_inputs = inputs[:17]
+    block_days = [block[:, i] for i in range(nblock)]
+    value_days = list(block_values)
+    rows = [(SNOW_PHYSICS_OUTPUTS + STEP_OUTPUTS).index(var) for var in STEP_MODEL_OUTPUTS]
+
+    # Buffers of the snow physics.  The snow physics are computed for all cells,
+    # or (CompactSnowPhysics, when at most 3/4 of the cells are active; beyond
+    # that, gathering the inputs costs more than it saves) for the active cells
+    # gathered into the first columns of the buffers of the smallest bucket
+    # (2, 4, 8, ... cells) with room for them.  The number of active cells (the
+    # last value of rank) selects the bucket (see bucket_index): bucket 0 has no
+    # active cells, and the last bucket is all cells.  Each bucket holds the
+    # flat indices into inputs and snow_outputs of its columns, and the views
+    # that snow_physics is called with
+    work = np.zeros((18, ncells), dtype=out.dtype)
+    flat_inputs = inputs.reshape(-1)
+    masks = np.zeros((2, ncells), dtype=bool)
+    compact_max = ncells * 3 // 4 if CompactSnowPhysics else 0
+    sizes = [2]
+    while sizes[-1] < compact_max:
+        sizes.append(min(2 * sizes[-1], ncells))
+    active, inactive = np.zeros((2, ncells), dtype=bool)
+    flags, rank, position, cells = np.zeros(ncells, dtype=np.intp), np.zeros(ncells, dtype=np.intp), np.zeros(ncells, dtype=np.intp), np.arange(ncells)
+    index, slots, padding = np.arange(ncells + 1), np.arange(ncells + 1), np.zeros(ncells + 1, dtype=bool)
+    count, bucket, last, last_cell = rank[ncells - 1, ...], np.zeros((), dtype=np.intp), np.zeros((), dtype=np.intp), np.zeros((), dtype=np.intp)
+    one, dump = np.array(1, dtype=np.intp), np.array(ncells, dtype=np.intp)
+    buckets = [(None, None)]
+    for size in sizes:
+        index_rows = np.zeros((len(inputs), size), dtype=np.intp)
+        compact_inputs = np.zeros((len(inputs), size), dtype=out.dtype)
+        compact_outputs = np.zeros((len(snow_outputs), size), dtype=out.dtype)
+        gather = [index_rows, np.broadcast_to(index[:size], index_rows.shape), np.arange(len(inputs))[:, None] * ncells + np.zeros_like(index_rows),
+                  index_rows[:len(snow_outputs)], compact_inputs, compact_outputs]
+        buckets.append((gather, (list(compact_inputs), list(compact_outputs), [var[:size] for var in work] + [var[:size] for var in masks])))
+    buckets.append((None, (list(inputs), list(snow_outputs), list(work) + list(masks))))
+    bucket_index = np.full(ncells + 1, len(buckets) - 1, dtype=np.intp)
+    if CompactSnowPhysics:
+        bucket_index[0] = 0
+        bucket_index[1:compact_max + 1] = 1 + np.searchsorted(sizes, np.arange(1, compact_max + 1))
+    if CountAllocations:
+        start = tracemalloc.get_traced_memory()[0]
+
+    for b0 in range(d0, d1, nblock):
+        b1 = min(d1, b0 + nblock)
+
+        # Forcing data of each cell (see columns), and the terms that only depend
+        # on the forcing data and parameters, for a block of days
+        for i, forcing_all in enumerate([tmean_all, wind_all, srad_all, lrad_all, vapp_all, rainfall_all, snowfall_all, PET_all]):
+            np.copyto(block[i, :b1-b0], forcing_all[b0:b1][:, columns])
+        terms = forcing_terms(block[0, :b1-b0], block[1, :b1-b0], block[2, :b1-b0], block[4, :b1-b0], lai, elevation, windlevel, sroughness, melt_drip_par, const)
+        for var in terms:
+            np.copyto(block[SNOW_PHYSICS_INPUTS.index(var), :b1-b0], terms[var])
+
+        for TS, day, day_values in zip(range(b0, b1), block_days, value_days):
+
+            if CountAllocations:
+                start = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+
+            np.copyto(day_inputs, day)
+            np.copyto(swe_p, swe_state)
+            np.copyto(cansnowstor_p, cansnowstor_state)
+            np.copyto(Tm_p, Tm_state)
+            np.copyto(cc_p, cc_state)
+            np.copyto(density_p, density)
+
+            # Albedo
+            # swe_age_a = where(swe == 0, 0, swe_age_a) + TSL / DAY
+            np.equal(swe_p, c[0], out=m1)
+            np.putmask(swe_age_a, m1, c[0])
+            np.add(swe_age_a, c['TSL / DAY'], out=swe_age_a)
+            # swe_age_a = swe_age_a * maximum(0, (albedo_snow_reset - snowfall) / albedo_snow_reset)
+            np.subtract(albedo_snow_reset, snowfall, out=t1)
+            np.divide(t1, albedo_snow_reset, out=t1)
+            np.maximum(c[0], t1, out=t1)
+            np.multiply(swe_age_a, t1, out=swe_age_a)
+            # albedosnow = maximum(minalbedo, albedo_i - (swe_age_a * albedo_decay))
+            np.divide(swe_p, density_p, out=depth)
+            np.multiply(swe_age_a, albedo_decay, out=t1)
+            np.subtract(albedo_i, t1, out=t1)
+            np.maximum(minalbedo, t1, out=albedosnow)
+            # snowfrac = minimum(1, depth / groundveght * 100)
+            np.divide(depth, groundveght, out=t1)
+            np.multiply(t1, c[100], out=t1)
+            np.minimum(c[1], t1, out=snowfrac)
+            # albedo = snowfrac * albedosnow + (1 - snowfrac) * albedo_0
+            np.multiply(snowfrac, albedosnow, out=albedo)
+            np.subtract(c[1], snowfrac, out=t1)
+            np.multiply(t1, albedo_0, out=t1)
+            np.add(albedo, t1, out=albedo)
+
+            # Net Radiation
+            # Qsn = srad * (1 - albedo)
+            np.subtract(c[1], albedo, out=t1)
+            np.multiply(srad, t1, out=Qsn)
+            # Ts_nosnow = airt + 0.0192 * (Qsn + Qli) - 0.0428 * rh - 4.1790 (Qli = lrad)
+            np.add(Qsn, lrad, out=t1)
+            np.multiply(c[0.0192], t1, out=t2)
+            np.add(airt, t2, out=Ts_nosnow)
+            np.multiply(c[0.0428], rh, out=t2)
+            np.subtract(Ts_nosnow, t2, out=Ts_nosnow)
+            np.subtract(Ts_nosnow, c[4.1790], out=Ts_nosnow)
+            # Ts_snow = minimum(0, airt + 0.0258 * (Qsn + Qli) + 0.0648 * rh - 14.5601)
+            np.multiply(c[0.0258], t1, out=t2)
+            np.add(airt, t2, out=Ts_snow)
+            np.multiply(c[0.0648], rh, out=t2)
+            np.add(Ts_snow, t2, out=Ts_snow)
+            np.subtract(Ts_snow, c[14.5601], out=Ts_snow)
+            np.minimum(c[0], Ts_snow, out=Ts_snow)
+            # Ts = Ts_snow * snowfrac + Ts_nosnow * (1 - snowfrac)
+            np.multiply(Ts_snow, snowfrac, out=Ts)
+            np.subtract(c[1], snowfrac, out=t1)
+            np.multiply(Ts_nosnow, t1, out=t1)
+            np.add(Ts, t1, out=Ts)
+            # Qle = emiss_snow * sigma * (Ts + K) ** 4
+            np.add(Ts, K, out=t1)
+            np.power(t1, c[4], out=t1)
+            np.multiply(c['emiss_snow * sigma'], t1, out=Qle)
+            # Qn = Qsn + Qli - Qle
+            np.add(Qsn, lrad, out=Qn)
+            np.subtract(Qn, Qle, out=Qn)
+
+            # Snow physics (see snow_physics), for the cells with snow, canopy
+            # snow, snowfall or cold content (the others have no snow fluxes).
+            # For the buckets of the compact cells, index holds the active cells
+            # (in the order of the cells; inactive cells are put into its last
+            # element, which is not gathered), padded with copies of the last
+            # active cell, which give the same results as that cell
+            np.not_equal(swe_p, c[0], out=active)
+            np.logical_or(active, np.not_equal(cansnowstor_p, c[0], out=m1), out=active)
+            np.logical_or(active, np.not_equal(snowfall, c[0], out=m1), out=active)
+            np.logical_or(active, np.not_equal(cc_p, c[0], out=m1), out=active)
+            np.copyto(flags, active)
+            np.add.accumulate(flags, out=rank)
+            bucket_index.take(count, None, bucket, 'clip')
+            gather, views = buckets[bucket]
+            if views is None:
+                snow_outputs.fill(0)
+            elif gather is None:
+                snow_physics(views[0], views[1], views[2], c)
+            else:
+                index_rows, index_repeat, row_offsets, output_rows, compact_inputs, compact_outputs = gather
+                np.subtract(rank, one, out=position)
+                np.logical_not(active, out=inactive)
+                np.putmask(position, inactive, dump)
+                index.put(position, cells, 'clip')
+                np.subtract(count, one, out=last)
+                index.take(last, None, last_cell, 'clip')
+                np.greater_equal(slots, count, out=padding)
+                np.putmask(index, padding, last_cell)
+                np.copyto(index_rows, index_repeat)
+                np.add(index_rows, row_offsets, out=index_rows)
+                flat_inputs.take(index_rows, None, compact_inputs, 'clip')
+                snow_physics(views[0], views[1], views[2], c)
+                snow_outputs.fill(0)
+                snow_outputs.put(output_rows, compact_outputs, 'clip')
+            np.copyto(swe_state, swe)
+            np.copyto(cansnowstor_state, cansnowstor)
+            np.copyto(Tm_state, Tm)
+            np.copyto(cc_state, cc)
+
+            # Frozen soil model
+            # ice_soil_0 = ice_fraction_soil * H
+            np.multiply(ice_fraction_soil, H, out=ice_soil_0)
+            # T_soil = Q_soil / ((sm_stor / 1000 * specheat_w * rhow) + ((H - sm_stor) / 1000 * specheat_s * rhos))
+            np.divide(sm_stor, c[1000], out=t1)
+            np.multiply(t1, specheat_w, out=t1)
+            np.multiply(t1, rhow, out=t1)
+            np.subtract(H, sm_stor, out=t2)
+            np.divide(t2, c[1000], out=t2)
+            np.multiply(t2, specheat_s, out=t2)
+            np.multiply(t2, rhos, out=t2)
+            np.add(t1, t2, out=t1)
+            np.divide(Q_soil, t1, out=T_soil)
+            # g_abv = kappa_soil / (H / 2 / 1000) * (Ts - T_soil) * TSL
+            np.subtract(Ts, T_soil, out=t1)
+            np.multiply(g_abv_par, t1, out=g_abv)
+            np.multiply(g_abv, TSL, out=g_abv)
+            # g_blw = kappa_soil / (dampdepth - (H / 2 / 1000)) * (tempdampdepth - T_soil) * TSL
+            np.subtract(tempdampdepth, T_soil, out=t1)
+            np.multiply(g_blw_par, t1, out=g_blw)
+            np.multiply(g_blw, TSL, out=g_blw)
+            # g_abv_snow = -Qg * TSL
+            np.negative(Qg, out=g_abv_snow)
+            np.multiply(g_abv_snow, TSL, out=g_abv_snow)
+            # g_abv = where(swe > 0, 0, g_abv) + where(swe <= 0, 0, g_abv_snow)
+            np.putmask(g_abv, np.greater(swe, c[0], out=m1), c[0])
+            np.putmask(g_abv_snow, np.less_equal(swe, c[0], out=m1), c[0])
+            np.add(g_abv, g_abv_snow, out=g_abv)
+            # p_dQ = g_abv + g_blw
+            np.add(g_abv, g_blw, out=p_dQ)
+            # Q_soil_gtlocs = where(Q_soil > 0, maximum(0, Q_soil + p_dQ), 0)
+            np.add(Q_soil, p_dQ, out=t1)
+            np.maximum(c[0], t1, out=Q_soil_gtlocs)
+            np.putmask(Q_soil_gtlocs, np.logical_not(np.greater(Q_soil, c[0], out=m1), out=m1), c[0])
+            # Q_soil_ltlocs = where(Q_soil < 0, minimum(0, Q_soil + p_dQ), 0)
+            np.minimum(c[0], t1, out=Q_soil_ltlocs)
+            np.putmask(Q_soil_ltlocs, np.logical_not(np.less(Q_soil, c[0], out=m1), out=m1), c[0])
+            # Q_soil_new = Q_soil_gtlocs + Q_soil_ltlocs
+            np.add(Q_soil_gtlocs, Q_soil_ltlocs, out=Q_soil_new)
+            # residual = Q_soil + p_dQ - Q_soil_new
+            np.subtract(t1, Q_soil_new, out=residual)
+            # ice_soil_0 = ice_soil_0 - soil_melt (soil_melt = (residual / (rhow * fusheat)) * 1000)
+            np.divide(residual, c['rhow * fusheat'], out=t1)
+            np.multiply(t1, c[1000], out=t1)
+            np.subtract(ice_soil_0, t1, out=ice_soil_0)
+            # ice_soil = maximum(0, minimum(p_ice_soil, ice_soil_0)) (p_ice_soil = sm_stor)
+            np.minimum(sm_stor, ice_soil_0, out=ice_soil)
+            np.maximum(c[0], ice_soil, out=ice_soil)
+            # Q_soil = Q_soil_new + residual * (rhow * fusheat) / 1000 (residual = ice_soil - ice_soil_0)
+            np.subtract(ice_soil, ice_soil_0, out=residual)
+            np.multiply(residual, c['rhow * fusheat'], out=residual)
+            np.divide(residual, c[1000], out=residual)
+            np.add(Q_soil_new, residual, out=Q_soil)
+            # ice_fraction_soil = ice_soil / (H)
+            np.divide(ice_soil, H, out=ice_fraction_soil)
+            # T_soil = Q_soil / (((sm_stor - ice_soil) / 1000 * specheat_w * rhow) + ((ice_soil) / 1000 * specheat_i * rhoi) +
+            #          ((H - sm_stor) / 1000 * specheat_s * rhos))
+            np.subtract(sm_stor, ice_soil, out=t1)
+            np.divide(t1, c[1000], out=t1)
+            np.multiply(t1, specheat_w, out=t1)
+            np.multiply(t1, rhow, out=t1)
+            np.divide(ice_soil, c[1000], out=t2)
+            np.multiply(t2, specheat_i, out=t2)
+            np.multiply(t2, rhoi, out=t2)
+            np.add(t1, t2, out=t1)
+            np.subtract(H, sm_stor, out=t2)
+            np.divide(t2, c[1000], out=t2)
+            np.multiply(t2, specheat_s, out=t2)
+            np.multiply(t2, rhos, out=t2)
+            np.add(t1, t2, out=t1)
+            np.divide(Q_soil, t1, out=T_soil)
+
+            # Snow Density
+            # new_frac = new_depth / (depth_p + new_depth) (depth_p = swe_p / density, new_depth = maximum(1E-6, snowfall / density_min))
+            np.divide(swe_p, density_p, out=depth_p)
+            np.divide(snowfall, density_min, out=new_depth)
+            np.maximum(c[1E-6], new_depth, out=new_depth)
+            np.add(depth_p, new_depth, out=t1)
+            np.divide(new_depth, t1, out=new_frac)
+            # density = (1 - new_frac) * density_p + new_frac * density_min
+            np.subtract(c[1], new_frac, out=density)
+            np.multiply(density, density_p, out=density)
+            np.multiply(new_frac, density_min, out=t1)
+            np.add(density, t1, out=density)
+            # density = density + ((density_max - density_p) * apar * TSL / DAY)
+            np.subtract(density_max, density_p, out=density_gap)
+            np.multiply(density_gap, apar, out=t1)
+            np.multiply(t1, TSL, out=t1)
+            np.divide(t1, DAY, out=t1)
+            np.add(density, t1, out=density)
+            # density = density + ((density_max - density_p) * dpar * swe / 10 * TSL / DAY)
+            np.multiply(density_gap, dpar, out=t1)
+            np.multiply(t1, swe, out=t1)
+            np.divide(t1, c[10], out=t1)
+            np.multiply(t1, TSL, out=t1)
+            np.divide(t1, DAY, out=t1)
+            np.add(density, t1, out=density)
+            # density = density + ((density_max - density_p) * rpar * (cc_p == 0) * TSL / DAY)
+            np.multiply(density_gap, rpar, out=t1)
+            np.copyto(t2, np.equal(cc_p, c[0], out=m1))
+            np.multiply(t1, t2, out=t1)
+            np.multiply(t1, TSL, out=t1)
+            np.divide(t1, DAY, out=t1)
+            np.add(density, t1, out=density)
+            # density = where(density > density_max, density_max, density), and where(density < density_min, density_min, density)
+            np.putmask(density, np.greater(density, density_max, out=m1), density_max)
+            np.putmask(density, np.less(density, density_min, out=m1), density_min)
+            # depth = swe / density; density_out = where(swe == 0, 0, density)
+            np.divide(swe, density, out=depth)
+            np.copyto(density_out, density)
+            np.putmask(density_out, np.equal(swe, c[0], out=m1), c[0])
+
+            # Compute Infiltration excess runoff
+            # net_input = rainfall - rain_on_snow + melt
+            np.subtract(rainfall, rain_on_snow, out=net_input)
+            np.add(net_input, melt, out=net_input)
+            # infil_runoff = net_input * max_infil_mult * (maximum(0, (sm_stor / H) - sm_min_infil) / (sm_max_infil - sm_min_infil))
+            np.divide(sm_stor, H, out=t1)
+            np.subtract(t1, sm_min_infil, out=t1)
+            np.maximum(c[0], t1, out=t1)
+            np.divide(t1, infil_range, out=t1)
+            np.multiply(net_input, max_infil_mult, out=infil_runoff)
+            np.multiply(infil_runoff, t1, out=infil_runoff)
+            # net_input = net_input - infil_runoff; sm_stor = sm_stor + net_input
+            np.subtract(net_input, infil_runoff, out=net_input)
+            np.add(sm_stor, net_input, out=sm_stor)
+
+            # Compute actual ET
+            # et = PET * minimum(1, ((maximum(0, sm_stor / H)) - wp) / (cmc - wp))
+            np.divide(sm_stor, H, out=t1)
+            np.maximum(c[0], t1, out=t1)
+            np.subtract(t1, wp, out=t1)
+            np.divide(t1, et_range, out=t1)
+            np.minimum(c[1], t1, out=t1)
+            np.multiply(PET, t1, out=et)
+
+            # Saturation excess runoff, if any
+            # sm_stor = maximum(0, sm_stor - et); sat_runoff = maximum(0, sm_stor - sm_sat); sm_stor = sm_stor - sat_runoff
+            np.subtract(sm_stor, et, out=sm_stor)
+            np.maximum(c[0], sm_stor, out=sm_stor)
+            np.subtract(sm_stor, sm_sat, out=sat_runoff)
+            np.maximum(c[0], sat_runoff, out=sat_runoff)
+            np.subtract(sm_stor, sat_runoff, out=sm_stor)
+
+            # Compute percolation out of the top soil layer
+            # perc = minimum(sm_stor / 3, k_soil * (maximum(0, (sm_stor-sm_res) / (sm_sat-sm_res))) ** (2 * b_soil + 3)) * TSL / DAY
+            np.subtract(sm_stor, sm_res, out=t1)
+            np.divide(t1, sm_range, out=t1)
+            np.maximum(c[0], t1, out=t1)
+            np.power(t1, perc_exp, out=t1)
+            np.multiply(k_soil, t1, out=t1)
+            np.divide(sm_stor, c[3], out=perc)
+            np.minimum(perc, t1, out=perc)
+            np.multiply(perc, TSL, out=perc)
+            np.divide(perc, DAY, out=perc)
+            # bw = 1-(sm_stor-sm_res) / (sm_sat-sm_res), limited to [0, 1]
+            np.subtract(sm_stor, sm_res, out=t1)
+            np.divide(t1, sm_range, out=bw)
+            np.subtract(c[1], bw, out=bw)
+            np.putmask(bw, np.less(bw, c[0], out=m1), c[0])
+            np.putmask(bw, np.greater(bw, c[1], out=m1), c[1])
+            # caprise = bw * k_soil * alpha * (psi_s / (H) ** beta ) * TSL / DAY, limited to x_vadose
+            np.multiply(bw, k_soil, out=caprise)
+            np.multiply(caprise, alpha, out=caprise)
+            np.multiply(caprise, caprise_par, out=caprise)
+            np.multiply(caprise, TSL, out=caprise)
+            np.divide(caprise, DAY, out=caprise)
+            np.putmask(caprise, np.greater(caprise, x_vadose, out=m1), x_vadose)
+            # sm_stor = sm_stor - perc + caprise; x_vadose = x_vadose + perc - caprise
+            np.subtract(sm_stor, perc, out=sm_stor)
+            np.add(sm_stor, caprise, out=sm_stor)
+            np.add(x_vadose, perc, out=x_vadose)
+            np.subtract(x_vadose, caprise, out=x_vadose)
+            # q_vadose = coef_vadose * (x_vadose ** coef_vadose_exp) * TSL / DAY; x_vadose = x_vadose - q_vadose
+            np.power(x_vadose, coef_vadose_exp, out=q_vadose)
+            np.multiply(coef_vadose, q_vadose, out=q_vadose)
+            np.multiply(q_vadose, TSL, out=q_vadose)
+            np.divide(q_vadose, DAY, out=q_vadose)
+            np.subtract(x_vadose, q_vadose, out=x_vadose)
+            # vadose_2_phreatic = coef_vadose2phreatic * x_vadose * TSL / DAY, from x_vadose to x_phreatic
+            np.multiply(coef_vadose2phreatic, x_vadose, out=vadose_2_phreatic)
+            np.multiply(vadose_2_phreatic, TSL, out=vadose_2_phreatic)
+            np.divide(vadose_2_phreatic, DAY, out=vadose_2_phreatic)
+            np.subtract(x_vadose, vadose_2_phreatic, out=x_vadose)
+            np.add(x_phreatic, vadose_2_phreatic, out=x_phreatic)
+            # q_phreatic = coef_phreatic * (x_phreatic ** coef_phreatic_exp) * TSL / DAY; x_phreatic = x_phreatic - q_phreatic
+            np.power(x_phreatic, coef_phreatic_exp, out=q_phreatic)
+            np.multiply(coef_phreatic, q_phreatic, out=q_phreatic)
+            np.multiply(q_phreatic, TSL, out=q_phreatic)
+            np.divide(q_phreatic, DAY, out=q_phreatic)
+            np.subtract(x_phreatic, q_phreatic, out=x_phreatic)
+            # infiltration = net_input - infil_runoff - sat_runoff
+            np.subtract(net_input, infil_runoff, out=infiltration)
+            np.subtract(infiltration, sat_runoff, out=infiltration)
+
+            # Values of the day (outputs in percent: ice_fraction_soil * 100 and sm_stor / H * 100)
+            np.multiply(ice_fraction_soil, c[100], out=ice_pct)
+            np.divide(sm_stor, H, out=SMC)
+            np.multiply(SMC, c[100], out=SMC)
+            np.copyto(Ts_value, Ts)
+            np.copyto(Qn_value, Qn)
+            np.copyto(x_vadose_value, x_vadose)
+            np.copyto(x_phreatic_value, x_phreatic)
+            np.copyto(day_values, values)
+
+            if CountAllocations:
+                allocated[TS - d0] = tracemalloc.get_traced_memory()[1] - start
+
+        # Store the requested outputs (in the order of MODEL_OUTPUTS) of the block
+        for i in range(len(rows)):
+            if out_index[i] >= 0:
+                np.copyto(out[out_index[i], b0:b1], block_values[:b1-b0, rows[i]])
+
+    if CountAllocations:
+        if not tracing:
+            tracemalloc.stop()
+        print('Memory allocated in the time steps: %.0f bytes (largest), on %d of %d days' % (np.max(allocated, initial=0), np.count_nonzero(allocated), len(allocated)))
+        step_allocations = allocated
+
+def snow_physics(inputs, outputs, work, c):
+
+    # Function to compute the snow physics of one time step of run_model_numpy
+    # (aerodynamic resistance, turbulent and precipitation heat fluxes, canopy
+    # interception, unloading and sublimation, ground heat, sublimation and
+    # melt of the snowpack, and its energy balance) for a set of cells, with
+    # the same equations as run_model_kernel, written into buffers (as in
+    # run_model_numpy).  It is called with all cells, or with the cells that
+    # have snow, canopy snow, snowfall or cold content gathered into compact
+    # buffers; the others have zero snow fluxes, which is what this function
+    # gives for them, so that both give the same results
+    #
+    # Inputs
+    #   inputs: rows of the inputs of each cell (see SNOW_PHYSICS_INPUTS)
+    #   work: 18 buffers for intermediate results, and two boolean buffers
+    #   c: numbers and constants of the equations (see equation_constants)
+    #
+    # Outputs
+    #   outputs: rows of the states at the end of the day and the snow fluxes of
+    #   each cell (see SNOW_PHYSICS_OUTPUTS, filled in place)
+
+    subheat, specheat_a, specheat_i, Rd, g = c['subheat'], c['specheat_a'], c['specheat_i'], c['Rd'], c['g']
+    M2MM, TSL, DAY, K, rhow = c['M2MM'], c['TSL'], c['DAY'], c['K'], c['rhow']
+    airt, wind, srad, lrad, vapp, rainfall, snowfall, PET, rh, k0, rhoa, melt_drip_potential, rho_v, S_p, D, Sh, omega, \
+        Ts, Ts_nosnow, Qn, swe_p, cansnowstor_p, Tm_p, cc_p, density_p, \
+        windlevel, fstab, Ch, cansnowstorcap, snow_unload_par, canopy_sub_mult, kappa_snow, tempdampdepth, H_M2MM, ground_sub_mult = inputs
+    swe, cansnowstor, Tm, cc, rain_on_snow, sublimation, tsfall, snow_unload, melt_drip, acsub, melt, Qn_snow, Qh, Qg, Qe, Qp, Qm = outputs
+    svapp, Ri, ka, sublimation_potential, L, C_e, dmdt, multiplier, Qp_r, Qp_s, pdq, melt_potential, Tm_min, cc_min, cc_i, imbal, t1, t2, m1, m2 = work
+
+    # Architectural resistance
+    # Ri = g * (airt - Ts) * windlevel / (wind **2 * airt)
+    np.subtract(airt, Ts, out=Ri)
+    np.multiply(g, Ri, out=Ri)
+    np.multiply(Ri, windlevel, out=Ri)
+    np.square(wind, out=t1)
+    np.multiply(t1, airt, out=t1)
+    np.divide(Ri, t1, out=Ri)
+    # ka = where(Ri > 0, k0 / (1 + 10 * Ri), k0)
+    np.copyto(ka, k0)
+    np.multiply(c[10], Ri, out=t1)
+    np.add(c[1], t1, out=t1)
+    np.divide(ka, t1, out=t1)
+    np.putmask(ka, np.greater(Ri, c[0], out=m1), t1)
+    # ka = where(Ri < 0, ka * (1 - 10 * Ri), ka)
+    np.multiply(c[10], Ri, out=t1)
+    np.subtract(c[1], t1, out=t1)
+    np.multiply(ka, t1, out=t1)
+    np.putmask(ka, np.less(Ri, c[0], out=m1), t1)
+    # ka = k0 + fstab * (ka - k0), 0 where nan
+    np.subtract(ka, k0, out=ka)
+    np.multiply(fstab, ka, out=ka)
+    np.add(k0, ka, out=ka)
+    np.putmask(ka, np.isnan(ka, out=m1), c[0])
+
+    # Sensible heat flux
+    # Qh = ka * rhoa * specheat_a * (airt - Ts) * Ch
+    np.multiply(ka, rhoa, out=Qh)
+    np.multiply(Qh, specheat_a, out=Qh)
+    np.subtract(airt, Ts, out=t1)
+    np.multiply(Qh, t1, out=Qh)
+    np.multiply(Qh, Ch, out=Qh)
+
+    # Latent heat flux and Sublimation
+    # svapp = 0.6108 * exp(17.27 * Ts_nosnow / (237.3 + Ts_nosnow)) * 1000
+    np.multiply(c[17.27], Ts_nosnow, out=svapp)
+    np.add(c[237.3], Ts_nosnow, out=t1)
+    np.divide(svapp, t1, out=svapp)
+    np.exp(svapp, out=svapp)
+    np.multiply(c[0.6108], svapp, out=svapp)
+    np.multiply(svapp, c[1000], out=svapp)
+    # Qe = k0 * (subheat * 0.622) / (Rd * (airt + K)) * (vapp - svapp), limited to 0
+    np.multiply(k0, c['subheat * 0.622'], out=Qe)
+    np.add(airt, K, out=t1)
+    np.multiply(Rd, t1, out=t1)
+    np.divide(Qe, t1, out=Qe)
+    np.subtract(vapp, svapp, out=t1)
+    np.multiply(Qe, t1, out=Qe)
+    np.putmask(Qe, np.greater(Qe, c[0], out=m1), c[0])
+    # sublimation_potential = -(Qe / (subheat * rhow)) * TSL * M2MM
+    np.divide(Qe, c['subheat * rhow'], out=sublimation_potential)
+    np.negative(sublimation_potential, out=sublimation_potential)
+    np.multiply(sublimation_potential, TSL, out=sublimation_potential)
+    np.multiply(sublimation_potential, M2MM, out=sublimation_potential)
+
+    # Canopy Snow Interception
+    # L = 0.7 * (cansnowstorcap - cansnowstor) * (1 - exp(-snowfall / (cansnowstorcap + 1E-6))), 0 where nan
+    np.subtract(cansnowstorcap, cansnowstor_p, out=L)
+    np.multiply(c[0.7], L, out=L)
+    np.negative(snowfall, out=t1)
+    np.add(cansnowstorcap, c[1E-6], out=t2)
+    np.divide(t1, t2, out=t1)
+    np.exp(t1, out=t1)
+    np.subtract(c[1], t1, out=t1)
+    np.multiply(L, t1, out=L)
+    np.putmask(L, np.isnan(L, out=m1), c[0])
+    # tsfall = snowfall - L; cansnowstor = cansnowstor + L
+    np.subtract(snowfall, L, out=tsfall)
+    np.add(cansnowstor_p, L, out=cansnowstor)
+    # snow_unload = maximum(snow_unload_par * cansnowstor * TSL / DAY, 0)
+    np.multiply(snow_unload_par, cansnowstor, out=snow_unload)
+    np.multiply(snow_unload, TSL, out=snow_unload)
+    np.divide(snow_unload, DAY, out=snow_unload)
+    np.maximum(snow_unload, c[0], out=snow_unload)
+
+    # Canopy sublimation
+    # C_e = 0.01 * (cansnowstor / (cansnowstorcap + 1E-6)) ** 0.4, 0 where nan
+    np.add(cansnowstorcap, c[1E-6], out=t1)
+    np.divide(cansnowstor, t1, out=C_e)
+    np.power(C_e, c[0.4], out=C_e)
+    np.multiply(c[0.01], C_e, out=C_e)
+    np.putmask(C_e, np.isnan(C_e, out=m1), c[0])
+    # dmdt = (2*np.pi*r*((vapp/svapp)-1) - S_p * omega) / (subheat * omega + 1 / (D * rho_v * Sh))
+    np.divide(vapp, svapp, out=dmdt)
+    np.subtract(dmdt, c[1], out=dmdt)
+    np.multiply(c['2 * np.pi * r'], dmdt, out=dmdt)
+    np.multiply(S_p, omega, out=t1)
+    np.subtract(dmdt, t1, out=dmdt)
+    np.multiply(subheat, omega, out=t1)
+    np.multiply(D, rho_v, out=t2)
+    np.multiply(t2, Sh, out=t2)
+    np.divide(c[1], t2, out=t2)
+    np.add(t1, t2, out=t1)
+    np.divide(dmdt, t1, out=dmdt)
+    # acsub = maximum(0, -C_e * cansnowstor * psi_s_c * TSL) * canopy_sub_mult, 0 where nan (psi_s_c = dmdt/m)
+    np.divide(dmdt, c['m'], out=dmdt)
+    np.negative(C_e, out=acsub)
+    np.multiply(acsub, cansnowstor, out=acsub)
+    np.multiply(acsub, dmdt, out=acsub)
+    np.multiply(acsub, TSL, out=acsub)
+    np.maximum(c[0], acsub, out=acsub)
+    np.multiply(acsub, canopy_sub_mult, out=acsub)
+    np.putmask(acsub, np.isnan(acsub, out=m1), c[0])
+
+    # multiplier = cansnowstor / (maximum(1E-6, acsub + melt_drip + snow_unload)), limited to 1
+    np.add(acsub, melt_drip_potential, out=t1)
+    np.add(t1, snow_unload, out=t1)
+    np.maximum(c[1E-6], t1, out=t1)
+    np.divide(cansnowstor, t1, out=multiplier)
+    np.putmask(multiplier, np.greater(multiplier, c[1], out=m1), c[1])
+    np.multiply(melt_drip_potential, multiplier, out=melt_drip)
+    np.multiply(snow_unload, multiplier, out=snow_unload)
+    np.multiply(acsub, multiplier, out=acsub)
+    # cansnowstor = maximum(0, cansnowstor - acsub - melt_drip - snow_unload)
+    np.subtract(cansnowstor, acsub, out=cansnowstor)
+    np.subtract(cansnowstor, melt_drip, out=cansnowstor)
+    np.subtract(cansnowstor, snow_unload, out=cansnowstor)
+    np.maximum(c[0], cansnowstor, out=cansnowstor)
+    # snow_unload = snow_unload + maximum(0, cansnowstor - cansnowstorcap)
+    np.subtract(cansnowstor, cansnowstorcap, out=t1)
+    np.maximum(c[0], t1, out=t1)
+    np.add(snow_unload, t1, out=snow_unload)
+
+    # Add all solid and liquid precipitation to SWE
+    # rain_on_snow = where((swe == 0) & (snowfall == 0), 0, rainfall)
+    np.copyto(rain_on_snow, rainfall)
+    np.equal(swe_p, c[0], out=m1)
+    np.logical_and(m1, np.equal(snowfall, c[0], out=m2), out=m1)
+    np.putmask(rain_on_snow, m1, c[0])
+    # swe = swe + tsfall + rain_on_snow + melt_drip + snow_unload
+    np.add(swe_p, tsfall, out=swe)
+    np.add(swe, rain_on_snow, out=swe)
+    np.add(swe, melt_drip, out=swe)
+    np.add(swe, snow_unload, out=swe)
+
+    # Heat from precip
+    # Qp_r = ((rainfall + melt_drip) / (M2MM * TSL)) * (fusheat * rhow + specheat_w * rhow * maximum(0, airt))
+    np.add(rainfall, melt_drip, out=Qp_r)
+    np.divide(Qp_r, c['M2MM * TSL'], out=Qp_r)
+    np.maximum(c[0], airt, out=t1)
+    np.multiply(c['specheat_w * rhow'], t1, out=t1)
+    np.add(c['fusheat * rhow'], t1, out=t1)
+    np.multiply(Qp_r, t1, out=Qp_r)
+    # Qp_s = ((tsfall + snow_unload) / (M2MM * TSL)) * (specheat_i * rhow * minimum(0, airt))
+    np.add(tsfall, snow_unload, out=Qp_s)
+    np.divide(Qp_s, c['M2MM * TSL'], out=Qp_s)
+    np.minimum(c[0], airt, out=t1)
+    np.multiply(c['specheat_i * rhow'], t1, out=t1)
+    np.multiply(Qp_s, t1, out=Qp_s)
+    # Qp = Qp_s + Qp_r
+    np.add(Qp_s, Qp_r, out=Qp)
+
+    # Ground Heat
+    # Qg = kappa_snow * (tempdampdepth - Tm) / (H / M2MM + (swe_p / density) / (2 * M2MM))
+    np.subtract(tempdampdepth, Tm_p, out=Qg)
+    np.multiply(kappa_snow, Qg, out=Qg)
+    np.divide(swe_p, density_p, out=t2)
+    np.divide(t2, c['2 * M2MM'], out=t2)
+    np.add(H_M2MM, t2, out=t1)
+    np.divide(Qg, t1, out=Qg)
+
+    # Sublimation
+    # sublimation = minimum(swe, sublimation_potential * ground_sub_mult); swe = swe - sublimation
+    np.multiply(sublimation_potential, ground_sub_mult, out=sublimation_potential)
+    np.minimum(swe, sublimation_potential, out=sublimation)
+    np.subtract(swe, sublimation, out=swe)
+    # Qe = -sublimation * (subheat * rhow) / (TSL * M2MM)
+    np.negative(sublimation, out=Qe)
+    np.multiply(Qe, c['subheat * rhow'], out=Qe)
+    np.divide(Qe, c['TSL * M2MM'], out=Qe)
+
+    # Melt
+    # pdq = -maximum(0, cc + (Qn + Qe + Qh + Qp + Qg) * TSL)
+    np.add(Qn, Qe, out=t1)
+    np.add(t1, Qh, out=t1)
+    np.add(t1, Qp, out=t1)
+    np.add(t1, Qg, out=t1)
+    np.multiply(t1, TSL, out=t1)
+    np.add(cc_p, t1, out=t1)
+    np.maximum(c[0], t1, out=t1)
+    np.negative(t1, out=pdq)
+    # melt = minimum(min_melt, minimum(swe, melt_potential)) (melt_potential = -pdq / (rhow * fusheat) * M2MM,
+    # min_melt = 0.2*(maximum(-5, airt)+5) ** 2 + rainfall)
+    np.negative(pdq, out=melt_potential)
+    np.divide(melt_potential, c['rhow * fusheat'], out=melt_potential)
+    np.multiply(melt_potential, M2MM, out=melt_potential)
+    np.minimum(swe, melt_potential, out=melt)
+    np.maximum(c[-5], airt, out=t1)
+    np.add(t1, c[5], out=t1)
+    np.square(t1, out=t1)
+    np.multiply(c[0.2], t1, out=t1)
+    np.add(t1, rainfall, out=t1)
+    np.minimum(t1, melt, out=melt)
+    # swe = swe - melt; Qm = (-melt / M2MM) * (rhow * fusheat) / TSL
+    np.subtract(swe, melt, out=swe)
+    np.negative(melt, out=Qm)
+    np.divide(Qm, M2MM, out=Qm)
+    np.multiply(Qm, c['rhow * fusheat'], out=Qm)
+    np.divide(Qm, TSL, out=Qm)
+
+    # Compute the energy balance (cold contents within the rounding errors of
+    # zero are set to zero, see run_model_kernel)
+    # Qn_snow = where(nosnow, 0, Qn) (nosnow = swe == 0)
+    np.equal(swe, c[0], out=m2)
+    np.copyto(Qn_snow, Qn)
+    np.putmask(Qn_snow, m2, c[0])
+    # cc = minimum(0, maximum(cc_min, cc_i)) (cc_min = minimum(0, Ts) * (swe / M2MM) * rhow * specheat_i,
+    # cc_i = cc_p + (Qn_snow + Qh + Qe + Qp + Qm + Qg) * TSL)
+    np.minimum(c[0], Ts, out=Tm_min)
+    np.divide(swe, M2MM, out=t1)
+    np.multiply(Tm_min, t1, out=cc_min)
+    np.multiply(cc_min, rhow, out=cc_min)
+    np.multiply(cc_min, specheat_i, out=cc_min)
+    np.add(Qn_snow, Qh, out=t1)
+    np.add(t1, Qe, out=t1)
+    np.add(t1, Qp, out=t1)
+    np.add(t1, Qm, out=t1)
+    np.add(t1, Qg, out=t1)
+    np.multiply(t1, TSL, out=t1)
+    np.add(cc_p, t1, out=cc_i)
+    np.maximum(cc_min, cc_i, out=cc)
+    np.minimum(c[0], cc, out=cc)
+    # cc = where(cc > -cc_tol, 0, cc) (cc_tol = CC_ROUNDING * eps * (abs(cc_p) + (abs(Qn_snow) + abs(Qh) + abs(Qe) + abs(Qp) +
+    # abs(Qm) + abs(Qg)) * TSL))
+    np.absolute(Qn_snow, out=t1)
+    np.add(t1, np.absolute(Qh, out=t2), out=t1)
+    np.add(t1, np.absolute(Qe, out=t2), out=t1)
+    np.add(t1, np.absolute(Qp, out=t2), out=t1)
+    np.add(t1, np.absolute(Qm, out=t2), out=t1)
+    np.add(t1, np.absolute(Qg, out=t2), out=t1)
+    np.multiply(t1, TSL, out=t1)
+    np.add(np.absolute(cc_p, out=t2), t1, out=t1)
+    np.multiply(c['CC_ROUNDING * eps'], t1, out=t1)
+    np.negative(t1, out=t1)
+    np.putmask(cc, np.greater(cc, t1, out=m1), c[0])
+    # Tm = where(nosnow, 0, cc / ((swe / M2MM) * rhow * specheat_i))
+    np.divide(swe, M2MM, out=t1)
+    np.multiply(t1, rhow, out=t1)
+    np.multiply(t1, specheat_i, out=t1)
+    np.divide(cc, t1, out=Tm)
+    np.putmask(Tm, m2, c[0])
+    # cc, Qe, Qp, Qm, Qg and Qh are 0 where nosnow (and cc where cc > 0)
+    np.putmask(cc, np.logical_or(m2, np.greater(cc, c[0], out=m1), out=m1), c[0])
+    np.putmask(Qe, m2, c[0])
+    np.putmask(Qp, m2, c[0])
+    np.putmask(Qm, m2, c[0])
+    np.putmask(Qg, m2, c[0])
+    np.putmask(Qh, m2, c[0])
+    # Qh = Qh + imbal (imbal = ((cc - cc_p) - (Qn_snow + Qh + Qe + Qp + Qm + Qg) * TSL) / TSL)
+    np.subtract(cc, cc_p, out=imbal)
+    np.add(Qn_snow, Qh, out=t1)
+    np.add(t1, Qe, out=t1)
+    np.add(t1, Qp, out=t1)
+    np.add(t1, Qm, out=t1)
+    np.add(t1, Qg, out=t1)
+    np.multiply(t1, TSL, out=t1)
+    np.subtract(imbal, t1, out=t1)
+    np.divide(t1, TSL, out=t1)
+    np.add(Qh, t1, out=Qh)
+
+def maximum(a, b):
+    # np.maximum for two numbers (nan if either is nan)
+    if np.isnan(a) or np.isnan(b):
+        return np.nan
+    return a if a > b else b
+
+def minimum(a, b):
+    # np.minimum for two numbers (nan if either is nan)
+    if np.isnan(a) or np.isnan(b):
+        return np.nan
+    return a if a < b else b
+
+def run_model_kernel(d0, d1, tmean_all, wind_all, srad_all, lrad_all, vapp_all, rainfall_all, snowfall_all, PET_all, columns, pars, state, const, out_index, out):
+
+    # Compiled (numba) version of the main time loop of run_model.  It runs days
+    # d0 to d1-1 one cell at a time (so no temporary arrays are needed), and
+    # follows the same equations as run_model_numpy, in the same order of
+    # operations (so that both give the same results, up to the rounding errors
+    # of numpy's exp, log and power functions).  Powers are written with
+    # float exponents (e.g. ** 4.) so that numba evaluates them with pow, as
+    # numpy does, rather than by repeated multiplication
+    #
+    # Inputs
+    #   tmean_all ... PET_all: forcing data [day x forcing column]
+    #   columns: forcing column of each cell
+    #   pars: model parameters [KERNEL_PARS x cell]
+    #   state: model states [KERNEL_STATES x cell] (updated in place)
+    #   const: model constants [KERNEL_CONSTS]
+    #   out_index: position in out of each variable of MODEL_OUTPUTS (-1: not stored)
+    #   out: requested model outputs [output x day x cell] (filled in place)
+
+    karman, subheat, fusheat, specheat_a, specheat_w, specheat_i, Rd, g, emiss_snow, sigma = const[0:10]
+    M2MM, TSL, DAY, K, rhoi, rhow, P0, L_rate, rhos, specheat_s = const[10:20]
+    values = np.zeros(len(out_index))
+
+    for TS in range(d0, d1):
+        for c in range(len(columns)):
+
+            lai, elevation, albedo_snow_reset, minalbedo, albedo_i, albedo_decay, groundveght, albedo_0 = pars[0:8, c]
+            windlevel, sroughness, fstab, Ch, melt_drip_par, snow_unload_par, canopy_sub_mult, kappa_snow = pars[8:16, c]
+            tempdampdepth, H, ground_sub_mult, kappa_soil, dampdepth, density_min, density_max, apar = pars[16:24, c]
+            dpar, rpar, max_infil_mult, sm_min_infil, sm_max_infil, wp, cmc, k_soil = pars[24:32, c]
+            b_soil, psi_s, coef_vadose, coef_vadose_exp, coef_vadose2phreatic, coef_phreatic, coef_phreatic_exp, sm_sat, sm_res = pars[32:41, c]
+            swe, cansnowstor, swe_age_a, Tm, cc, density, sm_stor, Q_soil, ice_fraction_soil, x_vadose, x_phreatic = state[:, c]
+
+            airt = tmean_all[TS, columns[c]]
+            wind = wind_all[TS, columns[c]]
+            srad = srad_all[TS, columns[c]]
+            lrad = lrad_all[TS, columns[c]]
+            vapp = vapp_all[TS, columns[c]]
+            rainfall = rainfall_all[TS, columns[c]]
+            snowfall = snowfall_all[TS, columns[c]]
+            PET = PET_all[TS, columns[c]]
+
+            svapp = 0.6108 * np.exp(17.27 * airt / (237.3 + airt)) * 1000
+            rh = vapp/svapp*100
+            if rh > 100:
+                rh = 100.
+
+            swe_p = swe
+            cc_p = cc
+
+            # Albedo
+            if swe == 0:
+                swe_age_a = 0.
+            swe_age_a = swe_age_a + (TSL / DAY)
+            swe_age_a = swe_age_a * maximum(0., (albedo_snow_reset - snowfall) / albedo_snow_reset)
+            depth = swe / density
+            albedosnow = maximum(minalbedo, albedo_i - (swe_age_a * albedo_decay))
+            snowfrac = minimum(1., depth / groundveght * 100)
+            albedo = snowfrac * albedosnow + (1 - snowfrac) * albedo_0
+
+            # Net Radiation
+            Qsn = srad * (1 - albedo)
+            Qli = lrad
+            Ts_nosnow = airt + 0.0192 * (Qsn + Qli) - 0.0428 * rh - 4.1790
+            Ts_snow = minimum(0., airt + 0.0258 * (Qsn + Qli) + 0.0648 * rh - 14.5601)
+            Ts = Ts_snow * snowfrac + Ts_nosnow * (1 - snowfrac)
+            Qle = emiss_snow * sigma * (Ts + K) ** 4.
+            Qn = Qsn + Qli - Qle
+
+            # Snow physics, which are skipped for cells without snow, canopy snow,
+            # snowfall or cold content (bare ground), as these have no snow
+            # fluxes (the same results as the full equations)
+            if swe == 0 and cansnowstor == 0 and snowfall == 0 and cc == 0:
+                rain_on_snow = 0.
+                sublimation = 0.
+                tsfall = 0.
+                snow_unload = 0.
+                melt_drip = 0.
+                acsub = 0.
+                melt = 0.
+                Qn_snow = 0.
+                Qh = 0.
+                Qg = 0.
+                Qe = 0.
+                Qp = 0.
+                Qm = 0.
+                Tm = 0.
+            else:
+                # Architectural resistance
+                k0 = karman ** 2 * wind / (np.log(windlevel / sroughness)) ** 2
+                Ri = g * (airt - Ts) * windlevel / (wind **2 * airt)
+                ka = k0 * 1
+                if Ri > 0:
+                    ka = ka / (1 + 10 * Ri)
+                if Ri < 0:
+                    ka = ka * (1 - 10 * Ri)
+                ka = k0 + fstab * (ka - k0)
+                if np.isnan(ka):
+                    ka = 0.
+
+                # Sensible heat flux
+                pres = P0 * np.exp(-g * elevation / (Rd * (airt + K + L_rate * elevation)))
+                rhoa = pres / (Rd * (airt + K))
+                Qh = ka * rhoa * specheat_a * (airt - Ts) * Ch
+
+                # Latent heat flux and Sublimation
+                svapp = 0.6108 * np.exp(17.27 * Ts_nosnow / (237.3 + Ts_nosnow)) * 1000
+                Qe = k0 * (subheat * 0.622) / (Rd * (airt + K)) * (vapp - svapp)
+                if Qe > 0:
+                    Qe = 0.
+                sublimation_potential = -(Qe / (subheat * rhow)) * TSL * M2MM
+
+                # Canopy Snow Interception
+                cansnowstorcap = 4.4 * lai
+                L = 0.7 * (cansnowstorcap - cansnowstor) * (1 - np.exp(-snowfall / (cansnowstorcap + 1E-6)))
+                if np.isnan(L):
+                    L = 0.
+                tsfall = snowfall - L
+                cansnowstor = cansnowstor + L
+                melt_drip = maximum(0., melt_drip_par * airt)
+                snow_unload = maximum(snow_unload_par * cansnowstor * TSL / DAY, 0.)
+
+                # Canopy sublimation
+                r = 5E-4
+                a = 0.9
+                C_e = 0.01 * (cansnowstor / (cansnowstorcap + 1E-6)) ** 0.4
+                if np.isnan(C_e):
+                    C_e = 0.
+                m = rhoi * 4/3 * np.pi * r ** 3.
+                rho_v = 0.622 * vapp / (287 * (airt + K))
+                S_p = np.pi * r ** 2 * (1-a) * srad
+                D = 2.06E-5 * ((airt + K)/K) ** 1.75
+                nu = 1.3E-5
+                a_flow = 0.9 * lai
+                u_c = wind * np.exp(-a_flow * (1-0.6))
+                Re = 2 * r * u_c/nu
+                Sh = 1.79 + 0.606 * Re ** 0.5
+                Nu = Sh
+                M = 18.01E-3
+                k_t = 0.024
+                R_const = 8314
+                omega = (1 / (k_t * (airt + K) * Nu)) * ((subheat * M) / (R_const * (airt + K)) -1)
+                dmdt = (2*np.pi*r*((vapp/svapp)-1) - S_p * omega) / (subheat * omega + 1 / (D * rho_v * Sh))
+                psi_s_c = dmdt/m
+                acsub = maximum(0., -C_e * cansnowstor * psi_s_c * TSL) * canopy_sub_mult
+                if np.isnan(acsub):
+                    acsub = 0.
+
+                p_canopy_abl = acsub + melt_drip + snow_unload
+                multiplier = cansnowstor / (maximum(1E-6, p_canopy_abl))
+                if multiplier > 1:
+                    multiplier = 1.
+                melt_drip = melt_drip * multiplier
+                snow_unload = snow_unload * multiplier
+                acsub = acsub * multiplier
+                cansnowstor = maximum(0., cansnowstor - acsub - melt_drip - snow_unload)
+                snow_unload = snow_unload + maximum(0., cansnowstor - cansnowstorcap)
+
+                # Add all solid and liquid precipitation to SWE
+                rain_on_snow = rainfall
+                if swe == 0 and snowfall == 0:
+                    rain_on_snow = 0.
+                swe = swe + tsfall + rain_on_snow + melt_drip + snow_unload
+
+                # Heat from precip
+                Qp_r = ((rainfall + melt_drip) / (M2MM * TSL)) * (fusheat * rhow + specheat_w * rhow * maximum(0., airt))
+                Qp_s = ((tsfall + snow_unload) / (M2MM * TSL)) * (specheat_i * rhow * minimum(0., airt))
+                Qp = Qp_s + Qp_r
+
+                # Ground Heat
+                Qg = kappa_snow * (tempdampdepth - Tm) / (H / M2MM + (swe_p / density) / (2 * M2MM))
+
+                # Sublimation
+                sublimation_potential = sublimation_potential * ground_sub_mult
+                sublimation = minimum(swe, sublimation_potential)
+                swe = swe - sublimation
+                Qe = -sublimation * (subheat * rhow) / (TSL * M2MM)
+
+                # Melt
+                pdq = -maximum(0., cc + (Qn + Qe + Qh + Qp + Qg) * TSL)
+                melt_potential = -pdq / (rhow * fusheat) * M2MM
+                melt = minimum(swe, melt_potential)
+                min_melt = 0.2*(maximum(-5., airt)+5) ** 2 + rainfall
+                melt = minimum(min_melt, melt)
+                swe = swe - melt
+                Qm = (-melt / M2MM) * (rhow * fusheat) / TSL
+
+                # Compute the energy balance
+                Qn_snow = Qn
+                if swe == 0:
+                    Qn_snow = 0.
+                Tm_min = minimum(0., Ts)
+                cc_min = Tm_min * (swe / M2MM) * rhow * specheat_i
+                cc_i = cc_p + (Qn_snow + Qh + Qe + Qp + Qm + Qg) * TSL
+                cc = minimum(0., maximum(cc_min, cc_i))
+                # When melt is limited by the available energy, cc_i is zero up to
+                # the rounding errors of the sum above, and its sign would decide
+                # whether the snowpack is isothermal (see Snow Density), so cold
+                # contents within these errors are set to zero (see CC_ROUNDING)
+                cc_tol = CC_ROUNDING * np.finfo(np.float64).eps * (abs(cc_p) + (abs(Qn_snow) + abs(Qh) + abs(Qe) + abs(Qp) + abs(Qm) + abs(Qg)) * TSL)
+                if cc > -cc_tol:
+                    cc = 0.
+                Tm = cc / ((swe / M2MM) * rhow * specheat_i)
+                if swe == 0:
+                    Tm = 0.
+                    cc = 0.
+                if cc > 0:
+                    cc = 0.
+                if swe == 0:
+                    Qe = 0.
+                    Qp = 0.
+                    Qm = 0.
+                    Qg = 0.
+                    Qh = 0.
+                imbal = ((cc - cc_p) - (Qn_snow + Qh + Qe + Qp + Qm + Qg) * TSL) / TSL
+                Qh = Qh + imbal
+
+            # Frozen soil model
+            ice_soil_0 = ice_fraction_soil * H
+            T_soil = Q_soil / ((sm_stor / 1000 * specheat_w * rhow) + ((H - sm_stor) / 1000 * specheat_s * rhos))
+            g_abv = kappa_soil / (H / 2 / 1000) * (Ts - T_soil) * TSL
+            g_blw = kappa_soil / (dampdepth - (H / 2 / 1000)) * (tempdampdepth - T_soil) * TSL
+            g_abv_snow = -Qg * TSL
+            if swe > 0:
+                g_abv = 0.
+            if swe <= 0:
+                g_abv_snow = 0.
+            g_abv = g_abv + g_abv_snow
+            p_dQ = (g_abv + g_blw)
+            Q_soil_gtlocs = maximum(0., Q_soil + p_dQ)
+            Q_soil_ltlocs = minimum(0., Q_soil + p_dQ)
+            if not Q_soil > 0:
+                Q_soil_gtlocs = 0.
+            if not Q_soil < 0:
+                Q_soil_ltlocs = 0.
+            Q_soil_new = Q_soil_gtlocs + Q_soil_ltlocs
+            residual = Q_soil + p_dQ - Q_soil_new
+            soil_melt = (residual / (rhow * fusheat)) * 1000
+            p_ice_soil = sm_stor
+            ice_soil_0 = ice_soil_0 - soil_melt
+            ice_soil = maximum(0., minimum(p_ice_soil, ice_soil_0))
+            residual = ice_soil - ice_soil_0
+            Q_soil = Q_soil_new + residual * (rhow * fusheat) / 1000
+            ice_fraction_soil = ice_soil / (H)
+            T_soil = Q_soil / (((sm_stor - ice_soil) / 1000 * specheat_w * rhow) + ((ice_soil) / 1000 * specheat_i * rhoi) + ((H - sm_stor) / 1000 * specheat_s * rhos))
+
+            # Snow Density
+            depth_p = swe_p / density
+            new_depth = maximum(1E-6, snowfall / density_min)
+            new_frac = new_depth / (depth_p + new_depth)
+            density_p = density
+            density = (1 - new_frac) * density_p + new_frac * density_min
+            density = density + ((density_max - density_p) * apar * TSL / DAY)
+            density = density + ((density_max - density_p) * dpar * swe / 10 * TSL / DAY)
+            density = density + ((density_max - density_p) * rpar * (1. if cc_p == 0 else 0.) * TSL / DAY)
+            if density > density_max:
+                density = density_max
+            if density < density_min:
+                density = density_min
+            depth = swe / density
+            density_out = density
+            if swe == 0:
+                density_out = 0.
+
+            # Compute Infiltration excess runoff
+            net_input = rainfall - rain_on_snow + melt
+            infil_runoff = net_input * max_infil_mult * (maximum(0., (sm_stor / H) - sm_min_infil) / (sm_max_infil - sm_min_infil))
+            net_input = net_input - infil_runoff
+            sm_stor = sm_stor + net_input
+
+            # Compute actual ET
+            et = PET * minimum(1., ((maximum(0., sm_stor / H)) - wp) / (cmc - wp))
+
+            # Saturation excess runoff, if any
+            sm_stor = maximum(0., sm_stor - et)
+            sat_runoff = maximum(0., sm_stor - sm_sat)
+            sm_stor = sm_stor - sat_runoff
+
+            # Compute percolation out of the top soil layer
+            perc = minimum(sm_stor / 3, k_soil * (maximum(0., (sm_stor-sm_res) / (sm_sat-sm_res))) ** (2 * b_soil + 3)) * TSL / DAY
+            bw = 1-(sm_stor-sm_res) / (sm_sat-sm_res)
+            if bw < 0:
+                bw = 0.
+            if bw > 1:
+                bw = 1.
+            beta = 2 + 3/b_soil
+            alpha = 1 + (3/2) / (beta -1)
+            caprise = bw * k_soil * alpha * (psi_s / (H) ** beta ) * TSL / DAY
+            if caprise > x_vadose:
+                caprise = x_vadose
+            sm_stor = sm_stor - perc + caprise
+            x_vadose = x_vadose + perc - caprise
+            q_vadose = coef_vadose * (x_vadose ** coef_vadose_exp) * TSL / DAY
+            x_vadose = x_vadose - q_vadose
+            vadose_2_phreatic = coef_vadose2phreatic * x_vadose * TSL / DAY
+            x_vadose = x_vadose - vadose_2_phreatic
+            x_phreatic = x_phreatic + vadose_2_phreatic
+            q_phreatic = coef_phreatic * (x_phreatic ** coef_phreatic_exp) * TSL / DAY
+            x_phreatic = x_phreatic - q_phreatic
+            infiltration = net_input - infil_runoff - sat_runoff
+
+            state[0, c] = swe
+            state[1, c] = cansnowstor
+            state[2, c] = swe_age_a
+            state[3, c] = Tm
+            state[4, c] = cc
+            state[5, c] = density
+            state[6, c] = sm_stor
+            state[7, c] = Q_soil
+            state[8, c] = ice_fraction_soil
+            state[9, c] = x_vadose
+            state[10, c] = x_phreatic
+
+            values[0] = swe
+            values[1] = depth
+            values[2] = density_out
+            values[3] = rain_on_snow
+            values[4] = sublimation
+            values[5] = tsfall
+            values[6] = snow_unload
+            values[7] = melt_drip
+            values[8] = acsub
+            values[9] = cansnowstor
+            values[10] = melt
+            values[11] = albedo
+            values[12] = Tm
+            values[13] = Ts
+            values[14] = Qsn
+            values[15] = Qle
+            values[16] = Qn
+            values[17] = Qn_snow
+            values[18] = Qh
+            values[19] = Qg
+            values[20] = Qe
+            values[21] = Qp
+            values[22] = Qm
+            values[23] = cc
+            values[24] = T_soil
+            values[25] = ice_fraction_soil * 100
+            values[26] = et
+            values[27] = sm_stor / H * 100
+            values[28] = infil_runoff
+            values[29] = sat_runoff
+            values[30] = perc
+            values[31] = caprise
+            values[32] = infiltration
+            values[33] = x_vadose
+            values[34] = x_phreatic
+            values[35] = q_vadose
+            values[36] = q_phreatic
+            for i in range(len(out_index)):
+                if out_index[i] >= 0:
+                    out[out_index[i], TS, c] = values[i]
+
+if numba is not None:
+    maximum = numba.njit(cache=True)(maximum)
+    minimum = numba.njit(cache=True)(minimum)
+    run_model_kernel = numba.njit(cache=True, error_model='numpy')(run_model_kernel)
+
+
+def solve_storm_u(ip):
+    # Function to solve 1 - exp(-u) - u / ip = 0 for the shape parameter u of
+    # the double exponential storm (with ip the ratio of the peak to the mean
+    # intensity) for all storms at once, with Newton iterations that start at
+    # u = ip (the function is concave, so they decrease monotonically to the
+    # positive root)
+    #
+    # Inputs
+    #   ip: ratio of the peak to the mean intensity of each storm
+    # Outputs
+    #   u: shape parameter of each storm
+
+    ip = np.asarray(ip, dtype=float)
+    u = ip.copy()
+    for it in range(100):
+        du = (1 - np.exp(-u) - u / ip) / (np.exp(-u) - 1 / ip)
+        u = u - du
+        if not np.any(np.abs(du) > 1E-12 * np.abs(u)):
+            break
+    return u
 
 
-def eqroot(a, b):
-    u = sp_optim.fsolve(f, b, args=a)
-    return u
+melt_curves = {}        # Tables of diurnal melt curves that have already been computed (see melt_curve_table)
 
+def diurnal_melt_curves(day_length, nsteps):
+    # Function to compute the diurnal cycle of snowmelt (the fraction of the
+    # daily melt in each timestep) following Webb et al. (2017), who describe it
+    # with a beta distribution function (evaluated with log-gamma functions, so
+    # that it does not overflow)
+    #
+    # Inputs
+    #   day_length: day length [hours] of each curve
+    #   nsteps: number of timesteps in a day
+    # Outputs
+    #   curves: diurnal melt curves [curve x timestep] (each sums to one)
+
+    alpha = np.maximum(3, 50 - 3 * np.asarray(day_length, dtype=float))[:, None]  # For now, tie alpha parameter to the day length
+    beta = alpha * 0.75  # This keeps maximum temperature approximately 2-3 in the afternoon
+    t = np.arange(1, nsteps + 1) / nsteps
+    with np.errstate(divide='ignore'):
+        log_FDM = (alpha - 1) * np.log(t) + (beta - 1) * np.log1p(-t)
+    FDM = np.exp(log_FDM + sp_spec.gammaln(alpha + beta) - sp_spec.gammaln(alpha) - sp_spec.gammaln(beta))
+    return FDM / np.sum(FDM, axis=1, keepdims=True)  # Rescale so that it sums to one
+
+def melt_curve_table(day_length, nsteps):
+    # Function to get the diurnal melt curves (see diurnal_melt_curves) of a set
+    # of days from a table with one curve for each day length, rounded to
+    # MeltCurveStep hours (the table covers 0-24 hours, with a last row of nan
+    # for unknown (nan) day lengths, and is kept in memory for later calls), or
+    # with one curve for each different day length (if MeltCurveStep is 0)
+    #
+    # Inputs
+    #   day_length: day length [hours] of each day
+    #   nsteps: number of timesteps in a day
+    # Outputs
+    #   curves: diurnal melt curves [curve x timestep]
+    #   index: row of curves for each day
+
+    if MeltCurveStep > 0:
+        key = (MeltCurveStep, nsteps)
+        if key not in melt_curves:
+            melt_curves[key] = diurnal_melt_curves(np.append(np.arange(int(np.ceil(24 / MeltCurveStep)) + 1) * MeltCurveStep, np.nan), nsteps)
+        unknown = np.isnan(day_length)
+        index = np.rint(np.clip(np.where(unknown, 0, day_length), 0, 24) / MeltCurveStep).astype(int)
+        index[unknown] = len(melt_curves[key]) - 1
+        return melt_curves[key], index
+    lengths, index = np.unique(day_length, return_inverse=True)
+    return diurnal_melt_curves(lengths, nsteps), index
+
+def storm_hyetographs(stmdur, timep, ip, p):
+    # Function to get the double exponential hyetographs of a set of storms (20
+    # increments of equal depth)
+    #
+    # Inputs
+    #   stmdur: storm duration [hours]
+    #   timep: time to peak / storm duration (0.01 - 0.99)
+    #   ip: maximum intensity / average intensity
+    #   p: storm depth [mm]
+    # Outputs
+    #   timem: time of the start of each increment [storm x 21] (minutes)
+    #   intsty: intensity of each increment [storm x 21] (mm/hr)
+
+    # Run double exponential assuming 20 increments
+    u = solve_storm_u(ip)[:, None]
+    timep = timep[:, None]
+    ip = ip[:, None]
+    b = u / timep
+    a = ip * np.exp(-u)
+    d = u / (1 - timep)
+
+    ninten = 20
+    deltfq = 1 / ninten
+    fqx = np.cumsum(np.full(ninten, deltfq))
+
+    timedl = np.zeros([len(u), ninten + 1])
+    intdl = np.zeros([len(u), ninten + 1])
+    rising = (1.0 / b) * np.log(1.0 + (b / a) * fqx)
+    falling = 1.0 - (d / ip) * (fqx - timep)
+    falling = np.where(falling > 0, timep - (1.0 / d) * np.log(np.where(falling > 0, falling, 1.0)), 0)
+    timedl[:, 1:] = np.where(fqx < timep, rising, falling)
+    intdl[:, :ninten] = np.maximum(0, deltfq / (timedl[:, 1:] - timedl[:, :ninten]))
+    timedl[:, ninten] = 1
+    intdl[:, ninten] = 0
+
+    timem = timedl * stmdur[:, None] * 60  # Minutes
+    intsty = intdl * p[:, None] / stmdur[:, None]  # mm/hr
+    return timem, intsty
+
+def resample_hyetographs(timem, intsty, TS_increment, p):
+    # Function to resample storm hyetographs to the timestep of the
+    # disaggregated timeseries, for a set of storms at once: the intensities
+    # are interpolated to 1 minute intervals, accumulated, and the accumulated
+    # depth is interpolated to the timesteps (as np.interp would, for each storm)
+    #
+    # Inputs
+    #   timem, intsty: hyetographs [storm x node] (see storm_hyetographs)
+    #   TS_increment: the desired timestep (fraction of a day)
+    #   p: storm depth [mm]
+    # Outputs
+    #   i: depth in each timestep [storm x timestep] (mm; rescaled to p, and
+    #   zero after the nt timesteps of each storm)
+    #   nt: number of timesteps of each storm
+
+    nstorms, nnodes = timem.shape
+    rows = np.arange(nstorms)[:, None]
+    max_time = np.max(timem, axis=1)
+    nminutes = np.ceil(max_time).astype(int)
+    step = TS_increment * 1440
+    nt = np.ceil(max_time / step).astype(int)
+
+    # Interpolate intensity to 1 minute intervals (in the segment j of each
+    # minute, timem[j] <= minute < timem[j+1], or the last node)
+    minutes = np.arange(np.max(nminutes, initial=0), dtype=float)
+    counts = np.zeros((nstorms, len(minutes) + 1), dtype=int)
+    np.add.at(counts, (np.broadcast_to(rows, timem.shape), np.minimum(np.ceil(timem).astype(int), len(minutes))), 1)
+    j = np.cumsum(counts, axis=1)[:, :len(minutes)] - 1
+    fp = intsty / 60
+    slopes = np.zeros(timem.shape)
+    slopes[:, :-1] = (fp[:, 1:] - fp[:, :-1]) / (timem[:, 1:] - timem[:, :-1])
+    i_ = slopes[rows, j] * (minutes - timem[rows, j]) + fp[rows, j]
+    i_ = np.where(j == nnodes - 1, fp[:, -1:], i_)
+    i_[minutes >= nminutes[:, None]] = 0
+    a_ = np.cumsum(i_, axis=1)
+
+    # Interpolate the accumulated depth to the timesteps
+    t = np.arange(np.max(nt, initial=0)) * step
+    jj = np.minimum(np.floor(t).astype(int), nminutes[:, None] - 1)
+    last = jj >= nminutes[:, None] - 1
+    jj = np.maximum(jj, 0)
+    a = (a_[rows, np.minimum(jj + 1, len(minutes) - 1)] - a_[rows, jj]) / 1.0 * (t - jj) + a_[rows, jj]
+    a = np.where(last, a_[rows, np.maximum(nminutes[:, None] - 1, 0)], a)
+    i = np.zeros(a.shape)
+    i[:, :-1] = np.diff(a, axis=1)
+    i[np.arange(len(t)) >= nt[:, None] - 1] = 0
+    total = np.sum(i, axis=1)
+    i = np.where(total[:, None] > 0, i * p[:, None] / np.where(total > 0, total, 1)[:, None], i)
+    return i, nt
 
 def get_ts_data(forcing_data, model_output, TS_increment):
 
@@ -956,9 +2573,10 @@ def get_ts_data(forcing_data, model_output, TS_increment):
     #   forcing_data: structure will all of the forcing data that will be used
     #   model_output: structure containing all model outputs
     #   TS_increment: the desired timestep (fraction of a day)
+    #   [days that are not marked as valid in forcing_data are left at zero]
     # Outputs
-    #   AllTSRainfall: Disaggregated rainfall timeseries
-    #   AllTSMelt: Disaggregated snowmelt timeseries
+    #   AllTSRainfall: Disaggregated rainfall timeseries (sparse, see sparse_ts)
+    #   AllTSMelt: Disaggregated snowmelt timeseries (sparse, see sparse_ts)
     #
     # Patrick Broxton (broxtopd@arizona.edu) - December 2022
 
@@ -970,9 +2588,6 @@ def get_ts_data(forcing_data, model_output, TS_increment):
     rain_on_snow_g = np.minimum(model_output['rain_on_snow'], model_output['melt'])
     # Treat the rest as melt (which will have a diurnal cycle)
     melt_g = model_output['melt'] - rain_on_snow_g
-    # Daylight hourshours
-    day_length = copy.deepcopy(forcing_data['day_length'])
-
     # Set stmdur, timep, ip, and day_length to zero if the required rainfall or
     # snowmelt components are also zero
     stmdur = copy.deepcopy(forcing_data['stmdur'])
@@ -981,7 +2596,6 @@ def get_ts_data(forcing_data, model_output, TS_increment):
     stmdur[np.logical_and(rainfall_g == 0, rain_on_snow_g == 0)] = 0
     timep[np.logical_and(rainfall_g == 0, rain_on_snow_g == 0)] = 0
     ip[np.logical_and(rainfall_g == 0, rain_on_snow_g == 0)] = 0
-    day_length[melt_g == 0] = 0
 
     # The intent is to use the existing disaggregation method (based on Storm
     # Duration, time to peak/storm duration, and maximum intensity/average
@@ -989,192 +2603,437 @@ def get_ts_data(forcing_data, model_output, TS_increment):
     # different treatment if desired).  Melt, which is not directly caused by a
     # rainfall event should have a diurnal cycle.
 
-    AllTSRainfall = np.zeros([len(melt_g[:, 0]) * int(1 / TS_increment), len(melt_g[0, :])])
-    AllTSMelt = np.zeros([len(melt_g[:, 0]) * int(1 / TS_increment), len(melt_g[0, :])])
+    # Only the days with melt (or rainfall) are stored (see sparse_ts)
+    ndays, nlocs = melt_g.shape
+    dtype = forcing_data['rainfall'].dtype
     print('Dissaggregating net water input timeseries')
-    for loc in range(len(melt_g[1, :])):
-        
-        TSRainfall = np.zeros([len(melt_g[:, 0]) * int(1 / TS_increment), 1])
-        TSMelt = np.zeros([len(melt_g[:, 0]) * int(1 / TS_increment), 1])
-
-        for dy in range(len(melt_g[:, 0])):
-
-            melt = melt_g[dy, loc]
-            dlen = day_length[dy, loc]
-
-            if melt > 0:
-                t = np.arange(TS_increment, 1 + TS_increment, TS_increment)
-                alpha = np.maximum(3, 50 - 3 * dlen)  # For now, tie alpha parameter to the day length
-                beta = alpha * 0.75  # This keeps maximum temperature approximately 2-3 in the afternoon
-
-                # Based on Webb et al., 2017 - Defining Diurnal Pattern of Snowmelt using a
-                # beta distribution function
-
-                FDM = t ** (alpha - 1) * (1 - t) ** (beta - 1) * sp_spec.gamma(alpha + beta) / (
-                        sp_spec.gamma(alpha) * sp_spec.gamma(beta))
-                FDM = FDM / sum(FDM)  # Rescale so that it sums to one
-                # Compute ts melt as the product of the rescaled FDM and the daily melt
-                Melt_TS = FDM * melt
-
-                Melt_TS[Melt_TS < np.minimum(0.001, np.max(Melt_TS) / 3)] = 0
-                Melt_TS = Melt_TS * melt / np.sum(Melt_TS)
-
-                TSMelt[int(1 / TS_increment) * dy: int(1 / TS_increment) * (dy + 1), 0] = np.transpose(Melt_TS)
-
-            stmdur_day = float(stmdur[dy, loc])
-            timep_day = float(timep[dy, loc])
-            if timep_day < 0.01:
-                timep_day = 0.01
-            if timep_day > 0.99:
-                timep_day = 0.99
-            ip_day = float(ip[dy, loc])
-            if ip_day > 60:
-                ip_day = 60
-            p = np.sum(rainfall_g[dy, loc]) + rain_on_snow_g[dy, loc]
-
-            if stmdur_day > 0 and p > 1E-1:
-                # Run double exponential assuming 20 increments
-                u = eqroot(1 / ip_day, ip_day)
-                b = u / timep_day
-                a = ip_day * np.exp(-u)
-                d = u / (1 - timep_day)
-
-                ninten = 20
-                deltfq = 1 / ninten
-                fqx = 0
-
-                timedl = np.ones([ninten + 1, 1]) * np.nan
-                intdl = np.ones([ninten + 1, 1]) * np.nan
-                timedl[0] = 0
-                i1 = 0
-                for i in range(ninten):
-                    i1 = i + 1
-                    if i <= ninten - 1:
-                        fqx = fqx + deltfq
-                        if fqx < timep_day:
-                            timedl[i1] = (1.0 / b) * np.log(1.0 + (b / a) * fqx)
-                        else:
-                            if 1.0 - (d / ip_day) * (fqx - timep_day) > 0:
-                                timedl[i1] = timep_day - (1.0 / d) * np.log(1.0 - (d / ip_day) * (fqx - timep_day))
-                            else:
-                                timedl[i1] = 0
-
-                        intdl[i] = np.maximum(0, deltfq / (timedl[i1] - timedl[i]))
-
-                timedl[i1] = 1
-                intdl[i1] = 0
-
-                timem = np.real(timedl * stmdur_day * 60)  # Minutes
-                intsty = np.real(intdl * p / stmdur_day)  # mm/hr
-
-                # Interpolate intensity to mm/timestep
-                t_ = np.arange(0, np.max(timem), 1)  # Regular interval in minutes
-                i_ = np.interp(t_, timem[:, 0], intsty[:, 0] / 60)
-                a_ = np.cumsum(i_)
-                t = np.arange(0, np.max(timem), TS_increment * 1440)  # Regular interval in minutes
-                a = np.interp(t, t_, a_)
-                i = np.append(np.diff(a), 0)
-                if np.sum(i) > 0:
-                    i = i * p / np.sum(i)
-
-                start_time = 12 * int(1 / (TS_increment * 24)) - round(len(i) / 2)
-                TSRainfall[int(1 / TS_increment) * dy + start_time: int(1 / TS_increment) * dy + start_time + len(i), 0] = i
-
-        AllTSMelt[:, loc] = TSMelt[:, 0]
-        AllTSRainfall[:, loc] = TSRainfall[:, 0]
 
+    # Melt days of all locations, in blocks of consecutive days of a location
+    # (to limit the size of the [day x timestep] arrays)
+    nsteps = int(round(1 / TS_increment))
+    melt_locs, melt_days = np.nonzero(np.logical_and(melt_g > 0, forcing_data['valid']).T)
+    TSMelt_days = np.zeros([len(melt_days), nsteps], dtype=dtype)
+    melt = melt_g[melt_days, melt_locs]
+    day_length = forcing_data['day_length'][melt_days, melt_locs]
+    melt_blocks = [np.arange(b, min(b + 4096, len(melt_days))) for b in range(0, len(melt_days), 4096)]
+
+    # Storm days of all locations (double exponential storms, in blocks of
+    # storms of similar duration)
+    p = rainfall_g + rain_on_snow_g
+    storm_locs, storm_days = np.nonzero(np.logical_and(np.logical_and(stmdur > 0, p > 1E-1), forcing_data['valid']).T)
+    TSRainfall_days = np.zeros([len(storm_days), nsteps], dtype=dtype)
+    p = p[storm_days, storm_locs]
+    stmdur = stmdur[storm_days, storm_locs].astype(float)
+    timep = np.clip(timep[storm_days, storm_locs].astype(float), 0.01, 0.99)
+    ip = np.minimum(ip[storm_days, storm_locs].astype(float), 60)
+    timem, intsty = storm_hyetographs(stmdur, timep, ip, p)
+    nminutes = np.ceil(np.max(timem, axis=1)).astype(int)
+    order = np.argsort(nminutes, kind='stable')
+    storm_blocks = []
+    b1 = 0
+    while b1 < len(order):
+        b0 = b1
+        size = nminutes[order[b0:b0 + 2 ** 16]] * np.arange(1, len(order[b0:b0 + 2 ** 16]) + 1)
+        b1 = b0 + max(1, np.searchsorted(size, 2 ** 21, side='right'))
+        storm_blocks.append(order[b0:b1])
+
+    # The blocks are independent, and are written into different rows of
+    # TSMelt_days and TSRainfall_days (in a pool of threads)
+    nworkers = DisaggregationWorkers if DisaggregationWorkers > 0 else os.cpu_count()
+    with ThreadPoolExecutor(max_workers=max(1, nworkers)) as pool:
+        futures = [pool.submit(disaggregate_melt, rows, melt, day_length, nsteps, TSMelt_days) for rows in melt_blocks]
+        futures += [pool.submit(disaggregate_storms, rows, timem, intsty, p, TS_increment, TSRainfall_days) for rows in storm_blocks]
+        for future in futures:
+            future.result()
+
+    AllTSRainfall = sparse_ts(storm_days, storm_locs, TSRainfall_days, ndays, nlocs)
+    AllTSMelt = sparse_ts(melt_days, melt_locs, TSMelt_days, ndays, nlocs)
     return AllTSRainfall, AllTSMelt
 
+def disaggregate_melt(rows, melt, day_length, nsteps, TSMelt_days):
+    # Function to disaggregate the daily snowmelt of a block of melt days (rows)
+    # into TSMelt_days.  The diurnal cycle is based on Webb et al., 2017 -
+    # Defining Diurnal Pattern of Snowmelt using a beta distribution function
+    melt = melt[rows].astype(float)[:, None]
+    curves, index = melt_curve_table(day_length[rows], nsteps)
+    # Compute ts melt as the product of the rescaled FDM and the daily melt
+    Melt_TS = curves[index] * melt
+    Melt_TS[Melt_TS < np.minimum(0.001, np.max(Melt_TS, axis=1, keepdims=True) / 3)] = 0
+    Melt_TS = Melt_TS * melt / np.sum(Melt_TS, axis=1, keepdims=True)
+    TSMelt_days[rows] = Melt_TS
+
+def disaggregate_storms(rows, timem, intsty, p, TS_increment, TSRainfall_days):
+    # Function to disaggregate the storms of a block of storm days (rows) into
+    # TSRainfall_days (the storms are centered on noon)
+    nsteps = TSRainfall_days.shape[1]
+    i, nt = resample_hyetographs(timem[rows], intsty[rows], TS_increment, p[rows])
+    start_time = nsteps // 2 - np.round(nt / 2).astype(int)
+    k = np.arange(i.shape[1])
+    steps = start_time[:, None] + k
+    mask = np.logical_and(k < nt[:, None], steps < nsteps)
+    TSRainfall_days[np.broadcast_to(rows[:, None], mask.shape)[mask], steps[mask]] = i[mask]
+
+def sparse_ts(days, locs, values, ndays, nlocs):
+    # Function to store a disaggregated timeseries [ndays * nsteps x nlocs] as
+    # the values of the days that have any (most days have no net water input,
+    # and are not stored)
+    #
+    # Inputs
+    #   days, locs: day and location of each stored day (sorted by location,
+    #   then by day)
+    #   values: values of each stored day [stored day x timestep]
+    #   ndays, nlocs: number of days and locations of the timeseries
+    # Outputs
+    #   ts: sparse timeseries, a structure with days, locs, values, ndays and nlocs
+
+    ts = {}
+    ts['days'] = np.asarray(days, dtype=int)
+    ts['locs'] = np.asarray(locs, dtype=int)
+    ts['values'] = values
+    ts['ndays'] = ndays
+    ts['nlocs'] = nlocs
+    return ts
+
+def add_sparse_ts(a, b):
+    # Function to add two sparse timeseries (see sparse_ts) of the same size
+    # (days that are stored in either are stored in the sum)
+    key_a = a['locs'] * a['ndays'] + a['days']
+    key_b = b['locs'] * b['ndays'] + b['days']
+    keys = np.union1d(key_a, key_b)
+    values = np.zeros((len(keys), a['values'].shape[1]), dtype=np.result_type(a['values'], b['values']))
+    values[np.searchsorted(keys, key_a)] += a['values']
+    values[np.searchsorted(keys, key_b)] += b['values']
+    return sparse_ts(keys % a['ndays'], keys // a['ndays'], values, a['ndays'], a['nlocs'])
+
+def sparse_ts_location(ts, loc, ndays=None):
+    # Function to get the stored days of one location of a sparse timeseries
+    # (see sparse_ts), optionally only the days before ndays
+    #
+    # Outputs
+    #   days: the stored days of the location
+    #   values: their values [stored day x timestep]
+    r0, r1 = np.searchsorted(ts['locs'], [loc, loc + 1])
+    if ndays is not None:
+        r1 = r0 + np.searchsorted(ts['days'][r0:r1], ndays)
+    return ts['days'][r0:r1], ts['values'][r0:r1]
+
+def dense_ts(ts):
+    # Function to get a sparse timeseries (see sparse_ts) as a full array
+    # [ndays * nsteps x nlocs] (with zeros on the days that are not stored)
+    nsteps = ts['values'].shape[1]
+    dense = np.zeros((ts['ndays'], nsteps, ts['nlocs']), dtype=ts['values'].dtype)
+    dense[ts['days'], :, ts['locs']] = ts['values']
+    return dense.reshape(ts['ndays'] * nsteps, ts['nlocs'])
+
+
+def max_intensity(ts, nwindow, rolling=False):
+    # Function to find the daily maximum depth in windows of nwindow timesteps
+    # of a sparse timeseries (see sparse_ts), for all stored days at once
+    #
+    # Inputs
+    #   ts: sparse timeseries
+    #   nwindow: number of timesteps in a window (must divide the timesteps of a day)
+    #   rolling: False for the fixed windows of each day (timesteps 0 to
+    #   nwindow-1, nwindow to 2*nwindow-1, ...), True for any nwindow
+    #   consecutive timesteps of the day
+    # Outputs
+    #   MaxIntensity: maximum depth in a window [day x location] (zero on the
+    #   days that are not stored)
 
-def collect_ts_output(years, months, days, TS_increment, id, TSPrecip, DailyPrecip, sat, ice):
-
-    print('Putting data into output structure')
-
-    dicts = []
-    for d in range(len(years)):
-        year = str(int(years[d]))
-        if len(year) < 4:
-            year = '0' + year
-        if len(year) < 4:
-            year = '0' + year
-        if len(year) < 4:
-            year = '0' + year
-        month = str(int(months[d]))
-        if len(month) < 2:
-            month = '0' + month
-        day = str(int(days[d]))
-        if len(day) < 2:
-            day = '0' + day
-            
-        Locs = range(int(1 / TS_increment) * d + 1, int(1 / TS_increment) * (d + 1))
+    MaxIntensity = np.zeros((ts['ndays'], ts['nlocs']))
+    values = ts['values']
+    if rolling:
+        windows = np.lib.stride_tricks.sliding_window_view(values, nwindow, axis=1)
+    else:
+        windows = values.reshape(values.shape[0], values.shape[1] // nwindow, nwindow)
+    MaxIntensity[ts['days'], ts['locs']] = np.max(np.sum(windows, axis=2), axis=1, initial=-np.inf)
+    return MaxIntensity
 
-        if TSPrecip.ndim == 2:
-            truth = np.sum(np.amax(TSPrecip[Locs, :], axis=1)) > 1E-3
-        else:
-            truth = np.sum(np.amax(TSPrecip[Locs])) > 1E-3
 
-        if truth:
+def idf_annual_maxima(ts, years, valid, TS_increment, durations):
+    # Function to find the annual maximum intensities of a sparse timeseries
+    # (see sparse_ts) for several durations, in one pass over blocks of the
+    # stored days (the depths in the windows of each duration are differences
+    # of the cumulative sums of the day)
+    #
+    # Inputs
+    #   ts: sparse timeseries
+    #   years: calendar year of each day [day] (consecutive days)
+    #   valid: days of each location that were simulated [day x location]
+    #   TS_increment: the timestep of the timeseries (fraction of a day)
+    #   durations: durations of the windows [minutes]
+    # Outputs
+    #   maxima: annual maximum intensities [year x duration x location] (mm/h;
+    #   nan for years without valid days, and for durations that are not a
+    #   multiple of the timestep)
+
+    nsteps = ts['values'].shape[1]
+    year_index = years - years[0]
+    nyears = year_index[-1] + 1 if len(years) > 0 else 0
+    maxima = np.zeros((nyears, len(durations), ts['nlocs']))
+    windows = np.array(durations) / (TS_increment * 1440)
+    usable = np.logical_and(np.abs(windows - np.round(windows)) < 1E-6, np.logical_and(np.round(windows) >= 1, np.round(windows) <= nsteps))
+    windows = np.round(windows).astype(int)
+    block = 4096
+    for b in range(0, len(ts['days']), block):
+        days, locs = ts['days'][b:b+block], ts['locs'][b:b+block]
+        csum = np.zeros((len(days), nsteps + 1))
+        np.cumsum(ts['values'][b:b+block], axis=1, out=csum[:, 1:])
+        for k in np.flatnonzero(usable):
+            n = windows[k]
+            depth = np.max(csum[:, n:] - csum[:, :-n], axis=1)
+            np.maximum.at(maxima[:, k, :], (year_index[days], locs), depth * 60 / durations[k])
+
+    maxima[:, ~usable, :] = np.nan
+    ndays = np.zeros((nyears, ts['nlocs']))
+    np.add.at(ndays, year_index, valid[:len(years)])
+    maxima[np.broadcast_to((ndays == 0)[:, None, :], maxima.shape)] = np.nan
+    return maxima
+
+
+def merge_idf_tables(table, added):
+    # Function to add the annual maximum intensities of the days added in append
+    # mode to the table of the earlier days (the year in which the earlier days
+    # end can be in both tables, and gets the larger maxima of the two)
+    #
+    # Inputs
+    #   table, added: tables [year x (1 + duration)] with the year and the
+    #   maxima of each duration (see idf_annual_maxima)
+    #
+    # Outputs
+    #   merged: table with the years of both tables
+    years = np.union1d(table[:, 0], added[:, 0])
+    merged = np.full((len(years), table.shape[1]), np.nan)
+    merged[:, 0] = years
+    for rows in [table, added]:
+        index = np.searchsorted(years, rows[:, 0])
+        merged[index, 1:] = np.fmax(merged[index, 1:], rows[:, 1:])
+    return merged
+
+# Forcing data used by run_model and get_ts_data (the ones that run_shards puts in shared memory)
+SHARD_FORCING = ['tmean', 'wind', 'srad', 'lrad', 'vapp', 'rainfall', 'snowfall', 'PET', 'valid', 'day_length', 'stmdur', 'timep', 'ip']
+
+def new_shared(shape, dtype, blocks):
+    # Function to allocate an array in a new block of shared memory (appended to
+    # blocks, to be closed and unlinked by the caller); returns a description of
+    # the array that can be passed to other processes (see attach_shared), and
+    # the array itself
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    blocks.append(shm)
+    return (shm.name, shape, np.dtype(dtype).str), np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def attach_shared(desc, blocks):
+    # Function to get an array that was allocated with new_shared (in another
+    # process); the block of shared memory is appended to blocks (to be closed
+    # by the caller, once the array is no longer used)
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    blocks.append(shm)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def run_shard(shared, TS_vec, c0, c1, model_pars, outputs, TS_increment, use_numba):
+    # Function to run the model and disaggregate its outputs for locations c0
+    # to c1-1 (in a process started by run_shards), reading the forcing data
+    # from, and writing the results to, the shared arrays described by shared
+    global UseNumba
+    UseNumba = use_numba
+    blocks = []
+    arrays = {var: attach_shared(shared[var], blocks) for var in shared}
+    forcing_data = {var: arrays[var] for var in SHARD_FORCING}
+    model_output = run_model(TS_vec, forcing_data, model_pars, outputs, columns=np.arange(c0, c1))
+    for var in outputs:
+        arrays['output_' + var][:, c0:c1] = model_output[var]
+    forcing_data = {var: arrays[var][:, c0:c1] for var in SHARD_FORCING}
+    TSRainfall, TSMelt = get_ts_data(forcing_data, model_output, TS_increment)
+    del arrays, forcing_data, model_output
+    for shm in blocks:
+        shm.close()
+    return TSRainfall, TSMelt
+
+def run_shards(TS_vec, forcing_data, model_pars, outputs, TS_increment):
+    # Function to run RHEM-Snow (run_model) and disaggregate its outputs
+    # (get_ts_data) with a pool of ModelWorkers processes, each for a shard of
+    # the locations.  The forcing data are put in shared memory once, and the
+    # processes write their outputs into shared arrays, so that the large
+    # arrays are not pickled (the disaggregated timeseries are sparse, and are
+    # returned by the processes)
+    #
+    # Inputs
+    #   TS_vec, forcing_data, model_pars, outputs: as for run_model (outputs
+    #   must include rain_on_snow and melt)
+    #   TS_increment: the desired timestep of the disaggregated timeseries (fraction of a day)
+    #
+    # Outputs
+    #   model_output: as from run_model
+    #   AllTSRainfall, AllTSMelt: as from get_ts_data
+
+    if outputs is None:
+        outputs = list(MODEL_OUTPUTS)
+    ndays, nlocs = forcing_data['rainfall'].shape
+    dtype = forcing_data['rainfall'].dtype
+    nworkers = ModelWorkers if ModelWorkers > 0 else os.cpu_count()
+    bounds = np.linspace(0, nlocs, max(1, min(nworkers, nlocs)) + 1).astype(int)
+    print('Running RHEM-Snow in %d processes' % (len(bounds) - 1))
+
+    blocks = []
+    try:
+        shared = {}
+        arrays = {}
+        for var in SHARD_FORCING:
+            shared[var], arrays[var] = new_shared(forcing_data[var].shape, forcing_data[var].dtype, blocks)
+            arrays[var][:] = forcing_data[var]
+        for var in outputs:
+            shared['output_' + var], arrays['output_' + var] = new_shared((ndays, nlocs), dtype, blocks)
+
+        with ProcessPoolExecutor(max_workers=len(bounds) - 1) as pool:
+            futures = []
+            for c0, c1 in zip(bounds[:-1], bounds[1:]):
+                shard_pars = {par: (value[c0:c1] if np.ndim(value) == 1 else value) for par, value in model_pars.items()}
+                futures.append(pool.submit(run_shard, shared, TS_vec, c0, c1, shard_pars, outputs, TS_increment, UseNumba))
+            results = [future.result() for future in futures]
+
+        model_output = {var: arrays['output_' + var].copy() for var in outputs}
+        del arrays
+        AllTSRainfall, AllTSMelt = [sparse_ts(np.concatenate([result[k]['days'] for result in results]),
+                                              np.concatenate([result[k]['locs'] + c0 for result, c0 in zip(results, bounds)]),
+                                              np.concatenate([result[k]['values'] for result in results]), ndays, nlocs) for k in range(2)]
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    return model_output, AllTSRainfall, AllTSMelt
+
+
+def find_events(TSPrecip_days, TSPrecip, DailyPrecip, TS_increment):
+
+    # Function to find the events (days with net water input) of one location,
+    # all at once (only the days that have a timeseries can be events)
+    #
+    # Inputs
+    #   TSPrecip_days, TSPrecip: days with disaggregated net water input, and its
+    #   timeseries on these days [day x timestep] (see sparse_ts_location)
+    #   DailyPrecip: daily net water input
+    #   TS_increment: the timestep of TSPrecip (fraction of a day)
+    # Outputs
+    #   event_rows: the rows of TSPrecip that are events
 
-            if DailyPrecip[d] > 0:
+    # (timesteps with net water input are those above 1E-3 mm per 5 minutes, at
+    # any timestep)
+    threshold = 1E-3 * TS_increment * 288
+    return np.flatnonzero(np.logical_and(np.amax(TSPrecip, axis=1, initial=0) > threshold, DailyPrecip[TSPrecip_days] > 0))
 
-                if TSPrecip.ndim == 2:
-                    locs_gt = np.amax(TSPrecip[Locs, :], axis=1) > 1E-3
-                    Precip_day = TSPrecip[Locs, loc]
-                else:
-                    locs_gt = TSPrecip[Locs] > 1E-3
-                    Precip_day = TSPrecip[Locs]
-
-                indices_gt = [i for i, x in enumerate(locs_gt) if x]
-                first_ts = indices_gt[0]
-                last_ts = indices_gt[-1]
-                
-                hr_start = np.floor(first_ts*TS_increment*24)
-                mn_start = np.floor((first_ts*TS_increment*24 - hr_start)*60)
-                hr_start = str(int(hr_start))
-                mn_start = str(int(mn_start))
-                if len(hr_start) < 2:
-                    hr_start = '0' + hr_start
-                if len(mn_start) < 2:
-                    mn_start = '0' + mn_start
-            
-                dict = {}
-                dict['EventStarted'] = month + '/' + day + '/' + year + ' 00:00'
-                dict['ElementID'] = id
-                dict['SAT'] = float(sat[d])
-                dict['ICE'] = float(ice[d])
-                dict['N'] = last_ts - first_ts + 2
-
-                amount = 0
-                i = 0
-                Precip_day = Precip_day * DailyPrecip[d] / np.sum(Precip_day)
-                mult = np.sum(Precip_day) / np.sum(Precip_day[first_ts:last_ts+1])
-                
-                minutes = []
-                amounts = []
-
-                for ts in np.arange(first_ts, last_ts+2):
-                    i = i + 1
-                    minute = (i - 1) * 1440 * TS_increment
-                    minutes.append(minute)
-                    amounts.append(float(amount))
-                    amount = amount + Precip_day[min(len(Precip_day)-1, int(ts))] * mult
-               
-                dict['DEPTH'] = amounts
-                dict['TIME'] = minutes
-                    
-            dicts.append(dict)
+def collect_ts_output(years, months, days, TS_increment, id, TSPrecip_days, TSPrecip, DailyPrecip, sat, ice, event_rows, block=1024):
 
-    return dicts
+    # Function to collect the events of one location into the tables that are
+    # passed to the K2 program.  This is a generator: the events are built in
+    # blocks, when they are needed (see get_next_event)
+    #
+    # Inputs
+    #   years, months, days: calendar of the record (integer arrays)
+    #   TS_increment: the timestep of TSPrecip (fraction of a day)
+    #   id: element id of the location
+    #   TSPrecip_days, TSPrecip: days with disaggregated net water input, and its
+    #   timeseries on these days [day x timestep] (see sparse_ts_location)
+    #   DailyPrecip: daily net water input
+    #   sat, ice: daily saturation and ice fractions
+    #   event_rows: the rows of TSPrecip that are events (see find_events)
+    #   block: number of events in a table
+    # Outputs (for each block of events)
+    #   events: structure with ElementID and TS_increment, and arrays with the
+    #   year, month, day, SAT, ICE and N (number of points) of each event.  The
+    #   cumulative depths of all of the events are in one array (DEPTH), those
+    #   of event k are DEPTH[offset[k]:offset[k+1]] (their times are every
+    #   1440 * TS_increment minutes from 0)
+
+    threshold = 1E-3 * TS_increment * 288
+    for b in range(0, len(event_rows), block):
+
+        rows = event_rows[b:b+block]
+        d = TSPrecip_days[rows]
+        Precip_day = np.asarray(TSPrecip[rows, :], dtype=float)
+        locs_gt = Precip_day > threshold
+        first_ts = np.argmax(locs_gt, axis=1)
+        last_ts = Precip_day.shape[1] - 1 - np.argmax(locs_gt[:, ::-1], axis=1)
+
+        # Rescale to the daily net water input, and the timesteps from the
+        # first to the last with net water input to all of it
+        Precip_day = Precip_day * DailyPrecip[d][:, None] / np.sum(Precip_day, axis=1, keepdims=True)
+        n = last_ts - first_ts + 1
+        mult = np.sum(Precip_day, axis=1) / np.array([np.sum(Precip_day[r, first_ts[r]:last_ts[r]+1]) for r in range(len(rows))])
+
+        # Cumulative depths (from zero, at the start of the first timestep)
+        k = np.arange(np.max(n))
+        amounts = np.zeros((len(rows), len(k) + 1))
+        amounts[:, 1:] = np.where(k < n[:, None], Precip_day[np.arange(len(rows))[:, None], np.minimum(first_ts[:, None] + k, Precip_day.shape[1] - 1)] * mult[:, None], 0)
+        amounts = np.cumsum(amounts, axis=1)
+
+        events = {}
+        events['ElementID'] = id
+        events['TS_increment'] = TS_increment
+        events['year'] = years[d].astype(int)
+        events['month'] = months[d].astype(int)
+        events['day'] = days[d].astype(int)
+        events['SAT'] = sat[d].astype(float)
+        events['ICE'] = ice[d].astype(float)
+        events['N'] = n + 1
+        events['offset'] = np.concatenate([[0], np.cumsum(n + 1)])
+        events['DEPTH'] = amounts[np.arange(len(k) + 1) <= n[:, None]]
+        yield events
+
+def save_append_record(fname, ids, record, SMC, valid, events):
+    # Function to save what is needed to continue a run when rows are added to
+    # its cligen files (see AppendMode): the record of get_forcing_cligen, the
+    # soil moisture of the days so far (for the saturation fractions), and the
+    # events of the first location (passed to the K2 program again when no rows
+    # have been added, see merge_events).  The model states are in a separate
+    # checkpoint file
+    print('Saving ' + fname)
+    with open(fname, 'wb') as f:
+        np.savez(f, ids=ids, SMC=SMC, valid=valid, **record, **{'event_' + var: events[var] for var in events})
+
+def load_append_record(fname, ids):
+    # Function to read a file that was saved by save_append_record (for the
+    # locations in ids)
+    print('Loading ' + fname)
+    with np.load(fname) as f:
+        if list(f['ids']) != list(ids):
+            raise ValueError('The run in ' + fname + ' was for other cligen files')
+        return {var: f[var] for var in f.files if var != 'ids'}
+
+def cligen_file_hash(cligen_file, size):
+    # Function to get a hash of the first size bytes of a cligen file (in append
+    # mode, the rows that were run before must not have changed)
+    with open(cligen_file, 'rb') as f:
+        return hashlib.blake2b(f.read(size), digest_size=16).hexdigest()
+
+def merge_events(tables):
+    # Function to merge tables of events of a location (see collect_ts_output)
+    # into one table
+    events = {var: np.concatenate([table[var] for table in tables]) for var in ['year', 'month', 'day', 'SAT', 'ICE', 'N', 'DEPTH']}
+    events['offset'] = np.concatenate([[0], np.cumsum(events['N'])])
+    return events
+
+def reset_events(n):
+    # Function to pass the events of the first location (the tables of data[0])
+    # to the K2 program from the first one (n: number of events)
+    global event_index, n_events, events, event_row
+    event_index = -1
+    n_events = n
+    events = None
+    event_row = -1
 
 def run(forcing_files, OutDir, Soils, Slopes, Aspects):
     
     global GetSiteSpecificParameters
     global SaveDailyTable
     global SaveAllRHEMSnowOutputs
+    global SaveIDFTable
     global SetInitialSaturation
     global SetInitialIceContent
     global Sat_i
     global Ice_i
+    global data
     
     # Set up model parameters
     nlocs = len(forcing_files) 
@@ -1188,10 +3047,39 @@ def run(forcing_files, OutDir, Soils, Slopes, Aspects):
     for forcing_file in forcing_files:
         ids.append(os.path.splitext(os.path.basename(forcing_file))[0])
         
+    # Timestep of the disaggregated timeseries (fraction of a day)
+    if TSMinutes <= 0 or 30 % TSMinutes != 0:
+        raise ValueError('TSMinutes must divide 30 minutes (got %r)' % TSMinutes)
+    TS_increment = TSMinutes / 1440
+
     OutDir = OutDir[0]
     if OutDir == 'None':
         SaveDailyTable = 0
         SaveAllRHEMSnowOutputs = 0
+        SaveIDFTable = 0
+
+    # In append mode, continue the previous run in OutDir (if there is one)
+    append = AppendMode and OutDir != 'None'
+    record_file = OutDir + '/' + ids[0] + '_append.npz'
+    checkpoint_file = OutDir + '/' + ids[0] + '_checkpoint_%d.npz'
+    record = None
+    if append and os.path.exists(record_file):
+        record = load_append_record(record_file, ids)
+        offsets = [int(offset) for offset in record['offset']]
+        if 'prefix_hash' not in record or any(cligen_file_hash(forcing_file, offset) != prefix_hash for forcing_file, offset, prefix_hash in zip(forcing_files, offsets, record['prefix_hash'])):
+            # (the rows that were run before have changed)
+            print('Warning: the cligen files have changed before the added rows, running the whole record again')
+            record = None
+        elif all(os.path.getsize(forcing_file) == offset for forcing_file, offset in zip(forcing_files, offsets)):
+            # (the tables of the last run are kept, and its events are passed to
+            # the K2 program again)
+            print('No rows have been added to the cligen files, keeping the results of the last run')
+            last_events = {var[len('event_'):]: record[var] for var in record if var.startswith('event_')}
+            last_events.update(ElementID=ids[0], TS_increment=float(last_events['TS_increment']))
+            data = [iter([last_events])]
+            reset_events(len(last_events['N']))
+            return 0
+    first_day = int(record['nrows'][0]) if record is not None else 0
 
     # Get Site Specific Parameters if specified
     # Note: Any model parameters can be changed
@@ -1225,26 +3113,62 @@ def run(forcing_files, OutDir, Soils, Slopes, Aspects):
         
     # Read Forcing data
     t = time.time()
-    TS_vec, forcing_data = get_forcing_cligen(forcing_files,model_pars)
+    TS_vec, forcing_data = get_forcing_cligen(forcing_files,model_pars,record=record)
+    if record is not None and any(np.any(forcing_data['record'][var] != record[var]) for var in SOLAR_EXTREMES):
+        # (the added rows change the solar radiation correction of the earlier
+        # days, so the whole record is run again)
+        print('Warning: the added rows change the extremes of the solar radiation, running the whole record again')
+        record = None
+        first_day = 0
+        TS_vec, forcing_data = get_forcing_cligen(forcing_files,model_pars)
     print('Elapsed time is ' + str(time.time() - t) + ' seconds')
 
     # Run RHEM-Snow
     t = time.time()
-    model_output = run_model(TS_vec,forcing_data,model_pars)
-    print('Elapsed time is ' + str(time.time() - t) + ' seconds')
+    # (only the outputs that are used below are kept, unless all outputs are saved)
+    if SaveAllRHEMSnowOutputs:
+        outputs = None
+    elif SaveDailyTable:
+        outputs = COUPLED_OUTPUTS + ['swe', 'snowpack_sublimation']
+    else:
+        outputs = COUPLED_OUTPUTS
+    if ModelWorkers != 1 and nlocs > 1 and not append:
+        # (and disaggregate output timeseries, with a pool of processes)
+        [model_output,TSRainfall,TSMelt] = run_shards(TS_vec,forcing_data,model_pars,outputs,TS_increment)
+        TSPrecip = add_sparse_ts(TSMelt, TSRainfall)
+        print('Elapsed time is ' + str(time.time() - t) + ' seconds')
+    else:
+        if append:
+            # (starting from the states at the end of the previous run, and
+            # saving the states at the end of this one)
+            os.makedirs(OutDir, exist_ok=True)
+            restart_file = checkpoint_file % (first_day - 1) if record is not None else None
+            model_output = run_model(TS_vec,forcing_data,model_pars,outputs,checkpoint_days=[len(TS_vec)-1],checkpoint_file=checkpoint_file,restart_file=restart_file,first_day=first_day)
+        else:
+            model_output = run_model(TS_vec,forcing_data,model_pars,outputs)
+        print('Elapsed time is ' + str(time.time() - t) + ' seconds')
 
-    # Dissaggregate output timeseries
-    t = time.time()
-    [TSRainfall,TSMelt] = get_ts_data(forcing_data,model_output,1/288)
-    TSPrecip = TSMelt + TSRainfall
-    print('Elapsed time is ' + str(time.time() - t) + ' seconds')
+        # Dissaggregate output timeseries
+        t = time.time()
+        [TSRainfall,TSMelt] = get_ts_data(forcing_data,model_output,TS_increment)
+        TSPrecip = add_sparse_ts(TSMelt, TSRainfall)
+        print('Elapsed time is ' + str(time.time() - t) + ' seconds')
     
     # Get Additional values
+    # (in append mode, the soil moisture percentiles are over all of the days
+    # simulated so far)
+    valid = forcing_data['valid']
+    nvalid = np.sum(valid, axis=0)
+    SMC = model_output['SMC']
+    valid_all = valid
+    if record is not None:
+        SMC = np.concatenate([record['SMC'], SMC])
+        valid_all = np.concatenate([record['valid'], valid])
     sat = np.ones(model_output['SMC'].shape)
     ice = np.ones(model_output['SMC'].shape)
     for loc in range(len(model_output['SMC'][0,:])):
-        hi = np.percentile(model_output['SMC'][:,loc],99)
-        lo = np.percentile(model_output['SMC'][:,loc],1)
+        hi = np.percentile(SMC[valid_all[:,loc],loc],99)
+        lo = np.percentile(SMC[valid_all[:,loc],loc],1)
         sat[:,loc] = np.maximum(0,np.minimum(1,(model_output['SMC'][:,loc] - lo) / (hi-lo)))
         ice[:,loc] = np.maximum(0,np.minimum(1,(model_output['ice_fraction_soil'][:,loc] - lo) / (hi-lo))) * model_pars['ssat'][loc]
     
@@ -1261,7 +3185,7 @@ def run(forcing_files, OutDir, Soils, Slopes, Aspects):
     if SetInitialIceContent:
         ice[:] = Ice_i
     
-    # Find Maximum Intensity (if outputting dump file or daily table - note that this process takes some time, so only output this data if necessary)
+    # Find Maximum Intensity (if outputting dump file or daily table)
     
     if SaveAllRHEMSnowOutputs or SaveDailyTable:
         
@@ -1269,17 +3193,9 @@ def run(forcing_files, OutDir, Soils, Slopes, Aspects):
             os.makedirs(OutDir)
         
         t = time.time()
-        MaxIntensity = np.zeros(model_output['swe'].shape) * np.nan
-
         print('Finding Daily Maximum Intensities')
-        for i in range(len(TS_vec)):
-            precip = TSPrecip[i*288+1:(i+1)*288,:]
-            precip_30 = np.zeros([48, len(precip[0,:])]) * np.nan
-            
-            for j in range(48):
-                precip_30[j,:] = np.sum(precip[j*6+1:(j+1)*6,:],axis=0)
-
-            MaxIntensity[i,:] = np.max(precip_30,axis=0)
+        MaxIntensity = max_intensity(TSPrecip, int(30 // TSMinutes), RollingMaxIntensity)
+        MaxIntensity[~valid] = np.nan
         
         print('Elapsed time is ' + str(time.time() - t) + ' seconds')
 
@@ -1292,7 +3208,10 @@ def run(forcing_files, OutDir, Soils, Slopes, Aspects):
         a['MaxIntensity'] = MaxIntensity
         a['TSRainfall'] = TSRainfall
         a['TSMelt'] = TSMelt
-        fname = OutDir + '/' + ids[0] + '_dump.mat'
+        if record is None:
+            fname = OutDir + '/' + ids[0] + '_dump.mat'
+        else:
+            fname = OutDir + '/' + ids[0] + '_dump_%d.mat' % first_day
         print('Saving ' + fname)
         sio.savemat(fname,a)
 
@@ -1315,65 +3234,102 @@ def run(forcing_files, OutDir, Soils, Slopes, Aspects):
             net_water_input_ = rain_off_snow_ + melt_;
 
             OutTable = np.array([year_, mon_, day_, rain_off_snow_, rain_on_snow_, snowfall_, swe_, snowpack_sublimation_, melt_, net_water_input_, ice_, sat_, MaxIntensity[:,i]]).T
+            OutTable = OutTable[:nvalid[i], :]
             
             fname = OutDir + '/' + ids[i] + '_table.csv'
+            if record is None:
+                print('Saving ' + fname)
+                header = 'year,month,day,Rainfall Off Snow (mm),Rainfall On Snow (mm),Snowfall (mm),End of Day SWE (mm),Sublimation (mm),Snowmelt (mm),Net Water Input (mm),Ice Fraction,Saturation Fraction,Max Intensity (mm/30min)'
+                np.savetxt(fname, OutTable, fmt='%.3f', delimiter=',', header=header, comments='')
+            else:
+                # (the rows of the added days are appended to the table)
+                print('Appending to ' + fname)
+                with open(fname, 'a') as f:
+                    np.savetxt(f, OutTable, fmt='%.3f', delimiter=',')
+
+    # Output table of annual maximum intensities (if specified)
+
+    if SaveIDFTable:
+        if not os.path.exists(OutDir):
+            os.makedirs(OutDir)
+        calendar = forcing_data['calendar']
+        maxima = idf_annual_maxima(TSPrecip, calendar['year'], valid, TS_increment, IDFDurations)
+        years = np.arange(calendar['year'][0], calendar['year'][0] + len(maxima))
+        for i in range(len(ids)):
+            OutTable = np.column_stack([years, maxima[:,:,i]])
+            OutTable = OutTable[~np.all(np.isnan(maxima[:,:,i]), axis=1), :]
+            fname = OutDir + '/' + ids[i] + '_idf.csv'
+            if record is not None and os.path.exists(fname):
+                # (the years of the added days are merged into the table)
+                OutTable = merge_idf_tables(np.loadtxt(fname, delimiter=',', skiprows=1, ndmin=2), OutTable)
             print('Saving ' + fname)
-            header = 'year,month,day,Rainfall Off Snow (mm),Rainfall On Snow (mm),Snowfall (mm),End of Day SWE (mm),Sublimation (mm),Snowmelt (mm),Net Water Input (mm),Ice Fraction,Saturation Fraction,Max Intensity (mm/30min)'
-            np.savetxt(fname, OutTable, fmt='%.3f', delimiter=',', header=header, comments='')
-    
+            header = 'year,' + ','.join('%g min (mm/h)' % duration for duration in IDFDurations)
+            np.savetxt(fname, OutTable, fmt=['%d'] + ['%.3f'] * len(IDFDurations), delimiter=',', header=header, comments='')
 
     # Collect Data into output structure
     t = time.time()
-    global data
     data = []
+    calendar = forcing_data['calendar']
+    print('Putting data into output structure')
     for i in range(len(ids)):
-        data.append(collect_ts_output(forcing_data['year'][:,i], forcing_data['mon'][:,i], forcing_data['day'][:,i], 1/288, ids[i], TSPrecip[:, i], net_water_input[:, i], sat[:, i], ice[:, i]))
+        n = nvalid[i]
+        TSPrecip_days, TSPrecip_i = sparse_ts_location(TSPrecip, i, n)
+        event_rows = find_events(TSPrecip_days, TSPrecip_i, net_water_input[:n, i], TS_increment)
+        data.append(collect_ts_output(calendar['year'][:n], calendar['month'][:n], calendar['day'][:n], TS_increment, ids[i], TSPrecip_days, TSPrecip_i, net_water_input[:n, i], sat[:n, i], ice[:n, i], event_rows))
+        if i == 0:
+            n_events_0 = len(event_rows)
     print('Elapsed time is ' + str(time.time() - t) + ' seconds')
-    # Set up event index
-    global event_index
-    event_index = -1
 
-    global n_events
-    n_events = len(data[0])
+    if append:
+        # (with a hash of the rows that have been run, and the events of the
+        # first location, which are built now)
+        prefix_hash = [cligen_file_hash(forcing_file, int(offset)) for forcing_file, offset in zip(forcing_files, forcing_data['record']['offset'])]
+        tables = list(data[0])
+        data[0] = iter(tables)
+        last_events = merge_events(tables) if tables else {var: np.zeros(0) for var in ['year', 'month', 'day', 'SAT', 'ICE', 'N', 'DEPTH']}
+        save_append_record(record_file, ids, dict(forcing_data['record'], prefix_hash=np.array(prefix_hash)), SMC, valid_all, dict(last_events, TS_increment=TS_increment))
+
+    # Set up event index (the events of the first location are passed to the
+    # K2 program, in the current table of events)
+    reset_events(n_events_0)
 
     return 0
 
 def get_next_event():
 
-    global event_index
+    global event_index, events, event_row
     event_index = event_index + 1
     if event_index > n_events - 1:
         return [0, 0, 0]
-    EventStarted = data[0][event_index]['EventStarted']
-    mm, dd, yyyy = EventStarted.replace(' 00:00','').split('/')
-    month = int(mm)
-    day = int(dd)
-    year = int(yyyy)
-    return [year, month, day]
+    event_row = event_row + 1
+    if events is None or event_row == len(events['N']):
+        events = next(data[0])
+        event_row = 0
+    return [int(events['year'][event_row]), int(events['month'][event_row]), int(events['day'][event_row])]
 
 def get_npoints():
 
-    N = data[0][event_index]['N']
+    N = int(events['N'][event_row])
     return N
 
 def get_times():
 
-    time = data[0][event_index]['TIME']
+    time = (np.arange(events['N'][event_row]) * 1440 * events['TS_increment']).tolist()
     return time
 
 def get_depths():
 
-    depths = data[0][event_index]['DEPTH']
+    depths = events['DEPTH'][events['offset'][event_row]:events['offset'][event_row+1]].tolist()
     return depths
 
 def get_sat():
 
-    sat = data[0][event_index]['SAT']
+    sat = float(events['SAT'][event_row])
     return sat
 
 def get_ice(): 
 
-    ice = data[0][event_index]['ICE']
+    ice = float(events['ICE'][event_row])
     return ice
 
 if __name__ == "__main__":
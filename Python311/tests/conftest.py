@@ -0,0 +1,68 @@
+import os, sys
+import pytest
+
+# Fixtures for the tests of snow.py, which run the model on short synthetic
+# cligen records (written by benchmark.write_cligen_file)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import snow
+import benchmark
+
+WARMINGS = [-8, -4, 0, 4, 8, 12]   # Temperature shifts of the synthetic locations [C] (from snow most of the winter to rarely any snow)
+NYEARS = 20                        # Length of the synthetic records [years]
+
+def write_records(workdir, nyears=NYEARS, warmings=WARMINGS):
+    # Write one synthetic cligen record for each temperature shift, and return
+    # the file names
+    forcing_files = []
+    for warming in warmings:
+        fname = os.path.join(str(workdir), 'synthetic_%dyr_%+dC.stm' % (nyears, warming))
+        benchmark.write_cligen_file(fname, nyears, warming=warming)
+        forcing_files.append(fname)
+    return forcing_files
+
+def read_forcing(forcing_files):
+    # Read the forcing data of the records (without the cache of parsed cligen data)
+    model_pars = snow.default_model_pars(len(forcing_files))
+    UseCache = snow.UseCache
+    snow.UseCache = False
+    try:
+        with benchmark.quiet():
+            TS_vec, forcing_data = snow.get_forcing_cligen(forcing_files, model_pars)
+    finally:
+        snow.UseCache = UseCache
+    return TS_vec, forcing_data, model_pars
+
+def run_events(forcing_files, OutDir):
+    # Run snow.py as KINEROS2 does, and return the events of the first location
+    # as a list of [year, month, day, N, times, depths, sat, ice]
+    snow.GetSiteSpecificParameters = False
+    nlocs = len(forcing_files)
+    with benchmark.quiet():
+        snow.run(forcing_files, [OutDir], ['Loam'] * nlocs, [5.] * nlocs, [270.] * nlocs)
+    events = []
+    while True:
+        year, month, day = snow.get_next_event()
+        if year == 0:
+            return events
+        events.append([year, month, day, snow.get_npoints(), snow.get_times(), snow.get_depths(), snow.get_sat(), snow.get_ice()])
+
+@pytest.fixture(scope='session')
+def records(tmp_path_factory):
+    # Synthetic cligen records of the locations in WARMINGS
+    return write_records(tmp_path_factory.mktemp('cligen'))
+
+@pytest.fixture(scope='session')
+def forcing(records):
+    # TS_vec, forcing_data and model_pars of the synthetic records
+    return read_forcing(records)
+
+@pytest.fixture(autouse=True)
+def settings():
+    # The settings at the top of snow.py are restored after each test, and the
+    # parsed cligen data are not cached
+    saved = {name: value for name, value in vars(snow).items() if name[0].isupper() and not name.isupper()}
+    snow.UseCache = False
+    yield
+    for name, value in saved.items():
+        setattr(snow, name, value)
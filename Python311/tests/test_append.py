@@ -0,0 +1,122 @@
+import os
+import numpy as np
+import pytest
+import snow
+import benchmark
+from conftest import run_events
+
+# Tests of the append mode of run (AppendMode): rows added to the cligen files
+# are run from the states at the end of the previous run
+
+FMT = '%3d%3d%5d%6.1f%6.2f%5.2f%6.2f%6.1f%6.1f%5.0f.%5.1f%5.0f.%6.1f'    # Rows of benchmark.write_cligen_file
+
+def write_rows(fname, header, rows):
+    np.savetxt(fname, rows, fmt=FMT, header=''.join(header).rstrip('\n'), comments='')
+
+def extended_records(workdir, solar_change=0.):
+    # An 8 year synthetic record, and the same record extended with a copy of
+    # its first 4 years (as years 9 to 12), with the solar radiation of the
+    # copy increased by solar_change [langleys/day]
+    fname = os.path.join(str(workdir), 'synthetic_8yr.stm')
+    benchmark.write_cligen_file(fname, 8)
+    with open(fname) as f:
+        header = f.readlines()[:15]
+    rows = np.loadtxt(fname, skiprows=15)
+    added = rows[rows[:, 2] <= 4].copy()
+    added[:, 2] += 8
+    added[:, 9] += solar_change
+    return header, rows, np.concatenate([rows, added])
+
+def run_tables(forcing_file, OutDir, capsys):
+    # Run snow.py for one location, and return its daily table, its table of
+    # annual maximum intensities, and the messages that were printed
+    snow.GetSiteSpecificParameters = False
+    snow.SaveIDFTable = True
+    capsys.readouterr()
+    snow.run([forcing_file], [OutDir], ['Loam'], [5.], [270.])
+    id = os.path.splitext(os.path.basename(forcing_file))[0]
+    with open(os.path.join(OutDir, id + '_table.csv')) as f:
+        table = f.read()
+    with open(os.path.join(OutDir, id + '_idf.csv')) as f:
+        idf = f.read()
+    return table, idf, capsys.readouterr().out
+
+@pytest.mark.parametrize('solar_change', [0., 50.])
+def test_append_matches_complete_run(tmp_path, capsys, solar_change):
+    # The daily table and the table of annual maximum intensities of a run that
+    # is continued with the added rows (from the middle of the last year) are
+    # the same as those of a complete run.  When the added rows move the solar
+    # radiation extremes, the whole record is run again
+    header, rows, extended = extended_records(tmp_path, solar_change)
+    forcing_file = str(tmp_path / 'station.stm')
+    complete_dir = str(tmp_path / 'complete')
+    append_dir = str(tmp_path / 'append')
+    nrows = len(rows) - 100
+
+    write_rows(forcing_file, header, extended)
+    table, idf, out = run_tables(forcing_file, complete_dir, capsys)
+
+    snow.AppendMode = True
+    write_rows(forcing_file, header, extended[:nrows])
+    first_table, first_idf, out = run_tables(forcing_file, append_dir, capsys)
+    assert len(first_table.splitlines()) == nrows + 1
+    write_rows(forcing_file, header, extended)
+    append_table, append_idf, out = run_tables(forcing_file, append_dir, capsys)
+    assert append_table == table
+    assert append_idf == idf
+    assert ('Loading ' + os.path.join(append_dir, 'station_checkpoint_%d.npz' % (nrows - 1)) in out) == (solar_change == 0)
+    assert ('running the whole record again' in out) == (solar_change != 0)
+
+def test_append_without_added_rows(tmp_path, monkeypatch):
+    # A run in append mode on cligen files without added rows does not read
+    # them, keeps the tables of the last run, and passes its events to the K2
+    # program again
+    header, rows, extended = extended_records(tmp_path)
+    forcing_file = str(tmp_path / 'station.stm')
+    OutDir = str(tmp_path / 'append')
+    write_rows(forcing_file, header, rows)
+    snow.AppendMode = True
+    snow.SaveIDFTable = True
+    events = run_events([forcing_file], OutDir)
+    assert len(events) > 0
+    tables = {}
+    for fname in ['station_table.csv', 'station_idf.csv']:
+        with open(os.path.join(OutDir, fname)) as f:
+            tables[fname] = f.read()
+
+    def not_read(*args, **kwargs):
+        raise AssertionError('The cligen files are read again')
+    monkeypatch.setattr(snow, 'get_forcing_cligen', not_read)
+    again = run_events([forcing_file], OutDir)
+    assert [event[:4] + event[6:] for event in again] == [event[:4] + event[6:] for event in events]
+    for event, event_again in zip(events, again):
+        np.testing.assert_array_equal(event_again[4], event[4])
+        np.testing.assert_array_equal(event_again[5], event[5])
+    for fname in tables:
+        with open(os.path.join(OutDir, fname)) as f:
+            assert f.read() == tables[fname]
+
+def test_append_changed_rows(tmp_path, capsys):
+    # When rows that were run before have changed, the whole record is run again
+    header, rows, extended = extended_records(tmp_path)
+    forcing_file = str(tmp_path / 'station.stm')
+    changed = extended.copy()
+    changed[10, 3] += 10.
+    write_rows(forcing_file, header, changed)
+    table, idf, out = run_tables(forcing_file, str(tmp_path / 'complete'), capsys)
+
+    snow.AppendMode = True
+    append_dir = str(tmp_path / 'append')
+    write_rows(forcing_file, header, rows)
+    run_tables(forcing_file, append_dir, capsys)
+    write_rows(forcing_file, header, changed)
+    append_table, append_idf, out = run_tables(forcing_file, append_dir, capsys)
+    assert 'changed before the added rows' in out
+    assert append_table == table
+    assert append_idf == idf
+
+def test_merge_idf_tables():
+    table = np.array([[1, 1., np.nan], [2, 2., 3.]])
+    added = np.array([[2, 4., 1.], [3, 5., 6.]])
+    merged = snow.merge_idf_tables(table, added)
+    np.testing.assert_array_equal(merged, [[1, 1., np.nan], [2, 4., 3.], [3, 5., 6.]])
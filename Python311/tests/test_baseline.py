@@ -0,0 +1,93 @@
+import os, sys, importlib.util
+import numpy as np
+import pytest
+from conftest import run_events
+import snow
+import benchmark
+
+# Tests of the numpy version of the model against the results of the original
+# code (the snow.py of the first commit of the repository, 6c815b9), saved in
+# tests/data for the synthetic cligen records of test_golden.py.  With the
+# cold contents kept as computed (CC_ROUNDING = 0) and one melt curve for each
+# day length (MeltCurveStep = 0), the forcing data and the daily outputs are
+# the same (bit for bit), and so are the events passed to KINEROS2, except for
+# rounding errors of the order of 1E-13 mm in their cumulative depths (the
+# timeseries are summed in a different order).  The maximum intensities of the
+# daily table are not compared, as the original code left out the first
+# timestep of each 30 minute window (see README.md).  The baseline results are
+# written with
+#   git show 6c815b9:Python311/snow.py > snow_baseline.py
+#   python tests/test_baseline.py snow_baseline.py
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+IDS = ['synthetic_cold', 'synthetic_warm']
+FORCING_FILES = [os.path.join(DATA_DIR, id + '.stm') for id in IDS]
+FORCING = ['rainfall', 'snowfall', 'tmean', 'srad', 'lrad']     # Forcing data that are compared (as forcing_<name>)
+
+def model_pars(module):
+    # Model parameters of run (Loam, 5 degree slope facing west) for one location
+    model_pars = module.default_model_pars(1)
+    model_pars['Soil'] = ['Loam']
+    model_pars = module.get_soil_pars(model_pars)
+    model_pars['slope'][:] = 5.
+    model_pars['aspect'][:] = 270.
+    return model_pars
+
+def event_arrays(events):
+    # Events of run_events as arrays (the depths of all events concatenated)
+    return {'event_date': np.array([event[:3] for event in events]),
+            'event_N': np.array([event[3] for event in events]),
+            'event_sat': np.array([event[6] for event in events]),
+            'event_ice': np.array([event[7] for event in events]),
+            'event_depths': np.concatenate([event[5] for event in events])}
+
+@pytest.mark.parametrize('id', IDS)
+def test_baseline(id, monkeypatch):
+    monkeypatch.setattr(snow, 'CC_ROUNDING', 0)
+    snow.UseNumba = False
+    snow.MeltCurveStep = 0
+    forcing_file = FORCING_FILES[IDS.index(id)]
+    with np.load(os.path.join(DATA_DIR, id + '_baseline.npz')) as f:
+        baseline = dict(f)
+
+    pars = model_pars(snow)
+    with benchmark.quiet():
+        TS_vec, forcing_data = snow.get_forcing_cligen([forcing_file], pars)
+        model_output = snow.run_model(TS_vec, forcing_data, pars)
+    for var in FORCING:
+        np.testing.assert_array_equal(forcing_data[var], baseline['forcing_' + var], err_msg=var)
+    outputs = [var for var in baseline if not var.startswith('forcing_') and not var.startswith('event_')]
+    assert len(outputs) > 30
+    for var in outputs:
+        np.testing.assert_array_equal(model_output[var], baseline[var], err_msg=var)
+
+    events = event_arrays(run_events([forcing_file], 'None'))
+    for var in ['event_date', 'event_N', 'event_sat', 'event_ice']:
+        np.testing.assert_array_equal(events[var], baseline[var], err_msg=var)
+    np.testing.assert_allclose(events['event_depths'], baseline['event_depths'], rtol=1E-12, atol=1E-12)
+
+if __name__ == '__main__':
+    # Write the baseline results with the original snow.py (given as argument),
+    # one location at a time (the original code did not compute the clear sky
+    # radiation of locations at different latitudes correctly when they were
+    # run together, see README.md)
+    spec = importlib.util.spec_from_file_location('snow_baseline', sys.argv[1])
+    baseline_snow = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(baseline_snow)
+    baseline_snow.GetSiteSpecificParameters = False
+    for id, forcing_file in zip(IDS, FORCING_FILES):
+        pars = model_pars(baseline_snow)
+        with benchmark.quiet():
+            TS_vec, forcing_data = baseline_snow.get_forcing_cligen([forcing_file], pars)
+            model_output = baseline_snow.run_model(TS_vec, forcing_data, pars)
+            baseline_snow.run([forcing_file], ['None'], ['Loam'], [5.], [270.])
+        events = []
+        while True:
+            year, month, day = baseline_snow.get_next_event()
+            if year == 0:
+                break
+            events.append([year, month, day, baseline_snow.get_npoints(), baseline_snow.get_times(), baseline_snow.get_depths(), baseline_snow.get_sat(), baseline_snow.get_ice()])
+        baseline = {var: np.asarray(model_output[var]) for var in model_output}
+        baseline.update({'forcing_' + var: forcing_data[var] for var in FORCING})
+        baseline.update(event_arrays(events))
+        np.savez_compressed(os.path.join(DATA_DIR, id + '_baseline.npz'), **baseline)
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+import snow
+from conftest import run_events
+
+# Tests of the functions that pass the events to KINEROS2 (run, get_next_event,
+# get_npoints, get_times, get_depths, get_sat and get_ice)
+
+def test_event_types(records):
+    # KINEROS2 gets python ints, floats and lists of floats
+    events = run_events(records[:1], 'None')
+    assert len(events) > 100
+    for year, month, day, N, times, depths, sat, ice in events:
+        assert all(type(value) is int for value in [year, month, day, N])
+        assert type(sat) is float and type(ice) is float
+        assert type(times) is list and type(depths) is list
+        assert len(times) == N and len(depths) == N
+        assert all(type(value) is float for value in times + depths)
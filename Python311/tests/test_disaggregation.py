@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+import snow
+
+# Tests of the disaggregation of the daily rainfall and snowmelt (get_ts_data)
+
+DAY_LENGTH = np.array([0., 8.23, np.nan, 12.5, 16.07, 24., 8.23])
+
+@pytest.mark.parametrize('step', [0, 0.01, 0.5])
+def test_melt_curve_table(step):
+    # The melt curve of each day is that of its day length (rounded to
+    # MeltCurveStep hours), and nan for unknown day lengths
+    snow.MeltCurveStep = step
+    curves, index = snow.melt_curve_table(DAY_LENGTH, 288)
+    day_length = DAY_LENGTH if step == 0 else np.round(DAY_LENGTH / step) * step
+    expected = snow.diurnal_melt_curves(day_length, 288)
+    known = ~np.isnan(DAY_LENGTH)
+    np.testing.assert_allclose(curves[index[known]], expected[known], rtol=1E-12, atol=0)
+    assert np.all(np.isnan(curves[index[~known]]))
+    assert index.min() >= 0 and index.max() < len(curves)
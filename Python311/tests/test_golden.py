@@ -0,0 +1,109 @@
+import os, shutil, tempfile
+import numpy as np
+import pytest
+from conftest import run_events
+import snow
+
+# Tests of the daily tables and the events passed to KINEROS2 against the
+# results saved in tests/data (golden files), for two synthetic cligen records:
+# a cold location with snow most of the winter and a warm one.  The third year
+# of each record is a copy of its first year, so that its rows can be appended
+# without moving the extremes of the solar radiation (see test_append.py).
+# After an intended change of the results, write the golden files again with
+# python tests/test_golden.py
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+IDS = ['synthetic_cold', 'synthetic_warm']
+FORCING_FILES = [os.path.join(DATA_DIR, id + '.stm') for id in IDS]
+APPEND_ROWS = 800      # Days of the first run of the append test (to 10 March of the third year)
+
+TOLERANCE = 1E-3       # Largest difference from the golden tables and events [mm] (one unit of the last decimal of the tables, for rounding)
+TOLERANCE_FLOAT32 = 0.02   # Largest difference in single precision [mm] (see README.md)
+
+PATHS = {
+    'numba': {'UseNumba': True},
+    'numpy': {'UseNumba': False},
+    'shards': {'ModelWorkers': 2},
+    'float32': {'SinglePrecision': True},
+}
+
+def read_table(fname):
+    # Header and values of a daily table
+    with open(fname) as f:
+        header = f.readline().strip()
+    return header, np.loadtxt(fname, delimiter=',', skiprows=1)
+
+def read_events(fname):
+    # Events of an events file (see write_events), as a list of
+    # [year, month, day, N, depths, sat, ice]
+    events = []
+    with open(fname) as f:
+        f.readline()
+        for line in f:
+            values = line.strip().split(',')
+            events.append([int(value) for value in values[:4]] + [[float(value) for value in values[6].split()], float(values[4]), float(values[5])])
+    return events
+
+def write_events(fname, events):
+    # Write the events of run_events (one line per event, with the cumulative
+    # depths of the time steps separated by spaces)
+    with open(fname, 'w', newline='\r\n') as f:
+        f.write('year,month,day,npoints,sat,ice,depths (mm)\n')
+        for year, month, day, N, times, depths, sat, ice in events:
+            f.write('%d,%d,%d,%d,%.4f,%.4f,%s\n' % (year, month, day, N, sat, ice, ' '.join('%.4f' % depth for depth in depths)))
+
+def assert_tables(OutDir, tolerance):
+    for id in IDS:
+        header, table = read_table(os.path.join(OutDir, id + '_table.csv'))
+        golden_header, golden = read_table(os.path.join(DATA_DIR, id + '_table.csv'))
+        assert header == golden_header
+        np.testing.assert_allclose(table, golden, rtol=0, atol=tolerance + 1E-9, err_msg=id)
+
+def assert_events(events, golden, tolerance):
+    assert [event[:4] for event in events] == [event[:4] for event in golden]
+    for (year, month, day, N, times, depths, sat, ice), golden_event in zip(events, golden):
+        np.testing.assert_allclose(depths, golden_event[4], rtol=0, atol=tolerance, err_msg='%d-%d-%d' % (year, month, day))
+        assert [sat, ice] == pytest.approx(golden_event[5:], abs=1E-4)
+
+@pytest.mark.parametrize('path', [pytest.param(path, marks=pytest.mark.skipif(path == 'numba' and snow.numba is None, reason='numba is not installed')) for path in PATHS])
+def test_golden(tmp_path, path):
+    # The numpy and compiled versions of the model, the model run in shards,
+    # and single precision (within TOLERANCE_FLOAT32) give the golden results
+    for name, value in PATHS[path].items():
+        setattr(snow, name, value)
+    tolerance = TOLERANCE_FLOAT32 if snow.SinglePrecision else TOLERANCE
+    events = run_events(FORCING_FILES, str(tmp_path))
+    assert_tables(str(tmp_path), tolerance)
+    assert_events(events, read_events(os.path.join(DATA_DIR, IDS[0] + '_events.csv')), tolerance)
+
+def test_golden_append(tmp_path):
+    # A run that is continued from its checkpoint (AppendMode) with the rows
+    # after APPEND_ROWS gives the golden results, and the events of the two
+    # runs are those of the complete record (a run of the whole record again
+    # would repeat the events of the first run)
+    forcing_files = [str(tmp_path / os.path.basename(fname)) for fname in FORCING_FILES]
+    for fname, golden_fname in zip(forcing_files, FORCING_FILES):
+        with open(golden_fname, newline='') as f:
+            lines = f.readlines()
+        with open(fname, 'w', newline='') as f:
+            f.writelines(lines[:15 + APPEND_ROWS])
+    snow.AppendMode = True
+    OutDir = str(tmp_path / 'out')
+    events = run_events(forcing_files, OutDir)
+    for fname, golden_fname in zip(forcing_files, FORCING_FILES):
+        shutil.copy(golden_fname, fname)
+    added_events = run_events(forcing_files, OutDir)
+    assert 0 < len(added_events) and 0 < len(events)
+    assert_tables(OutDir, TOLERANCE)
+    assert_events(events + added_events, read_events(os.path.join(DATA_DIR, IDS[0] + '_events.csv')), TOLERANCE)
+
+if __name__ == '__main__':
+    # Write the golden files with the default settings of snow.py
+    snow.UseCache = False
+    OutDir = tempfile.mkdtemp()
+    events = run_events(FORCING_FILES, OutDir)
+    for id in IDS:
+        with open(os.path.join(OutDir, id + '_table.csv')) as f, open(os.path.join(DATA_DIR, id + '_table.csv'), 'w', newline='\r\n') as g:
+            g.write(f.read())
+    write_events(os.path.join(DATA_DIR, IDS[0] + '_events.csv'), events)
+    shutil.rmtree(OutDir)
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import snow
+import benchmark
+from conftest import read_forcing
+
+# Tests of run_model on the synthetic records of conftest.py
+
+def run(TS_vec, forcing_data, model_pars, **kwargs):
+    with benchmark.quiet():
+        return snow.run_model(TS_vec, forcing_data, model_pars, **kwargs)
+
+def assert_equal(output, expected):
+    assert sorted(output) == sorted(expected)
+    for var in expected:
+        np.testing.assert_array_equal(output[var], expected[var], err_msg=var)
+
+@pytest.mark.parametrize('single_precision', [False, True])
+def test_compact_snow_physics(forcing, single_precision):
+    # The numpy version gives the same results when the snow physics are only
+    # computed for the cells with snow (CompactSnowPhysics), with and without
+    # canopy snow and in single precision, and agrees with the compiled version
+    # in double precision (see test_numba.py)
+    TS_vec, forcing_data, model_pars = forcing
+    if single_precision:
+        # (as get_forcing_cligen stores them with SinglePrecision)
+        forcing_data = {var: value if var in ['valid', 'calendar', 'record'] else value.astype(np.float32) for var, value in forcing_data.items()}
+    model_pars = dict(model_pars, lai=np.where(np.arange(len(model_pars['lai'])) % 2, 2., 0.))
+    snow.UseNumba = False
+    snow.CompactSnowPhysics = False
+    full = run(TS_vec, forcing_data, model_pars)
+    snow.CompactSnowPhysics = True
+    compact = run(TS_vec, forcing_data, model_pars)
+    assert_equal(compact, full)
+    assert np.nanmax(compact['canopy_snow_storage']) > 0
+    if snow.numba is not None and not single_precision:
+        snow.UseNumba = True
+        kernel = run(TS_vec, forcing_data, model_pars)
+        for var in full:
+            np.testing.assert_allclose(full[var], kernel[var], rtol=0, atol=1E-9 * max(1., np.nanmax(np.abs(kernel[var]))), err_msg=var)
+
+@pytest.mark.parametrize('nlocs', [1, 6])
+def test_step_allocations(records, nlocs):
+    # The time steps of the numpy version do not allocate any memory (see
+    # CountAllocations), for a single cell and with the snow physics of the
+    # cells with snow (after a first run, which fills the caches that numpy and
+    # Python allocate the first time an operation is run)
+    TS_vec, forcing_data, model_pars = read_forcing(records[:nlocs])
+    snow.UseNumba = False
+    snow.CompactSnowPhysics = True
+    run(TS_vec, forcing_data, model_pars)
+    snow.CountAllocations = True
+    run(TS_vec, forcing_data, model_pars)
+    assert len(snow.step_allocations) == len(TS_vec)
+    assert np.count_nonzero(snow.step_allocations) == 0
+
+@pytest.mark.parametrize('use_numba', [False, pytest.param(True, marks=pytest.mark.skipif(snow.numba is None, reason='numba is not installed'))])
+def test_checkpoint_restart(forcing, tmp_path, use_numba):
+    # A run that is continued from a checkpoint gives the same outputs as an
+    # uninterrupted run after the checkpoint day (and nan before it)
+    TS_vec, forcing_data, model_pars = forcing
+    snow.UseNumba = use_numba
+    day = 3000
+    checkpoint_file = str(tmp_path / 'checkpoint_%d.npz')
+    full = run(TS_vec, forcing_data, model_pars, checkpoint_days=[day], checkpoint_file=checkpoint_file)
+    restart = run(TS_vec, forcing_data, model_pars, restart_file=checkpoint_file % day)
+    assert np.all(np.isnan(restart['swe'][:day+1]))
+    assert_equal({var: restart[var][day+1:] for var in restart}, {var: full[var][day+1:] for var in full})
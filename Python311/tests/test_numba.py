@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import snow
+import benchmark
+from conftest import read_forcing
+
+# Tests of the compiled (numba) version of the model time loop
+# (run_model_kernel) against the numpy version (run_model_numpy)
+
+pytestmark = pytest.mark.skipif(snow.numba is None, reason='numba is not installed')
+
+TOLERANCE = 1E-9    # Largest difference between the two versions, relative to the largest value of each output
+
+def run_both(TS_vec, forcing_data, model_pars, **kwargs):
+    outputs = {}
+    for use_numba in [False, True]:
+        snow.UseNumba = use_numba
+        with benchmark.quiet():
+            outputs[use_numba] = snow.run_model(TS_vec, forcing_data, model_pars, **kwargs)
+    return outputs[False], outputs[True]
+
+def assert_agree(numpy_output, kernel_output, tolerance=TOLERANCE):
+    for var in numpy_output:
+        scale = max(1., np.nanmax(np.abs(kernel_output[var])))
+        np.testing.assert_array_equal(np.isnan(numpy_output[var]), np.isnan(kernel_output[var]), err_msg=var)
+        np.testing.assert_allclose(numpy_output[var], kernel_output[var], rtol=0, atol=tolerance * scale, err_msg=var)
+
+def test_kernel_matches_numpy(forcing):
+    # All outputs, for a multi-year record at locations from cold to warm
+    TS_vec, forcing_data, model_pars = forcing
+    numpy_output, kernel_output = run_both(TS_vec, forcing_data, model_pars)
+    assert_agree(numpy_output, kernel_output)
+
+    # The records have days on which the snowpack is isothermal (cold content
+    # zero), which is where rounding errors used to make the two diverge
+    swe, cc = kernel_output['swe'], kernel_output['Q']
+    assert np.sum((swe > 0) & (cc == 0)) > 100
+
+def test_kernel_matches_numpy_long_record(tmp_path):
+    # One location over 30 years (the record on which the two versions used to
+    # diverge after about 4 years)
+    TS_vec, forcing_data, model_pars = read_forcing(benchmark.forcing_inputs(str(tmp_path), 30, 1)[0])
+    numpy_output, kernel_output = run_both(TS_vec, forcing_data, model_pars)
+    assert_agree(numpy_output, kernel_output)
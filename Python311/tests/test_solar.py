@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import snow
+
+# Tests of the clear sky radiation (clearsky_radiation)
+
+LATITUDE = np.array([75., 45., 70., 60., 30., -80.])
+SLOPE = np.array([0., 10., 30., 5., 45., 0.])
+ASPECT = np.array([0., 90., 180., 270., 45., 0.])
+
+@pytest.mark.parametrize('method', ['hourly', 'daily'])
+def test_locations_are_independent(method):
+    # The radiation of a location does not depend on the other locations that
+    # are computed with it
+    srad, day_length = snow.clearsky_radiation(LATITUDE.copy(), SLOPE.copy(), ASPECT.copy(), method)
+    for i in range(len(LATITUDE)):
+        srad_i, day_length_i = snow.clearsky_radiation(LATITUDE[i:i+1].copy(), SLOPE[i:i+1].copy(), ASPECT[i:i+1].copy(), method)
+        np.testing.assert_array_equal(srad[:, i], srad_i[:, 0])
+        np.testing.assert_array_equal(day_length[:, i], day_length_i[:, 0])
+
+def test_polar_days_and_nights():
+    # The hourly method gives no radiation (0, not nan) when the sun does not
+    # rise or set; the daily method gives radiation during polar days
+    srad, day_length = snow.clearsky_radiation(np.array([75., 45.]), np.zeros(2), np.zeros(2), 'hourly')
+    assert not np.any(np.isnan(srad))
+    polar = np.isnan(day_length[:, 0])
+    assert np.sum(polar) > 100
+    assert np.all(srad[polar, 0] == 0)
+    assert np.all(srad[:, 1] > 0)
+    srad, day_length = snow.clearsky_radiation(np.array([75.]), np.zeros(1), np.zeros(1), 'daily')
+    assert np.all(srad[day_length[:, 0] == 0] == 0)
+    assert np.all(srad[day_length[:, 0] == 24] > 0)